@@ -0,0 +1,78 @@
+"""
+Filter throughput over a synthetic table: the former AST walk over
+connection views against the compiled row closure, the vectorized
+NumPy mask, and the mask over the candidates of the secondary indexes
+(index build time reported separately).
+
+    python benchmarks/bench_filter.py [num_connections] [expression ...]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pytcptrace.filter import compile_filter, ast_eval
+from pytcptrace.table import ConnectionTable
+from pytcptrace.index import TableIndexes
+
+__author__ = 'huangyan13@baidu.com'
+
+EXPRESSIONS = [
+    'tcp.port_b == 80',
+    'tcp.a2b.unique_bytes_sent > 1000 && tcp.b2a.unique_bytes_sent < 50000',
+    'tcp.host_b == 192.168.0.1 || !(tcp.total_packets >= 10)',
+    'tcp.host_a == 10.0.1.7 && tcp.first_packet_time > 100',
+    'tcp.port_a == 4242 || tcp.port_a == 4243',
+]
+
+
+def synthetic_table(num_connections):
+    rand = np.random.RandomState(0)
+    hosts = np.array([u'10.0.%d.%d' % (idx >> 8, idx & 255) for idx in xrange(65536)])
+    columns = {
+        'host_a': hosts[rand.randint(0, len(hosts), num_connections)],
+        'port_a': rand.randint(1024, 65536, num_connections),
+        'host_b': np.array([u'192.168.0.1', u'192.168.0.2'])[rand.randint(0, 2, num_connections)],
+        'port_b': rand.choice([80, 443, 8080], num_connections),
+        'complete': rand.randint(0, 2, num_connections).astype(bool),
+        'total_packets': rand.randint(1, 100, num_connections),
+        'first_packet_time': np.sort(rand.uniform(0, 3600, num_connections)),
+        'a2b.unique_bytes_sent': rand.randint(0, 100000, num_connections),
+        'b2a.unique_bytes_sent': rand.randint(0, 100000, num_connections),
+    }
+    return ConnectionTable(columns, {}, num_connections)
+
+
+def measure(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def main():
+    num_connections = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    expressions = sys.argv[2:] or EXPRESSIONS
+    table = synthetic_table(num_connections)
+    indexes = TableIndexes(table)
+    elapsed, _ = measure(lambda: [indexes.get(name) for name in
+                                  TableIndexes.HASH_COLUMNS + TableIndexes.SORTED_COLUMNS])
+    print('index build: %.3fs' % elapsed)
+    for expr in expressions:
+        compiled = compile_filter(expr)
+        print(expr)
+        legacy, expected = measure(lambda: [idx for idx, conn in enumerate(table)
+                                            if ast_eval(compiled.ast, conn)])
+        for name, elapsed, result in (
+                ('ast walk', legacy, expected),
+                ('closure', ) + measure(lambda: compiled.indices(table, mode='row')),
+                ('vector', ) + measure(lambda: compiled.indices(table, mode='vector')),
+                ('indexed', ) + measure(lambda: compiled.indices(table, indexes=indexes))):
+            assert list(result) == list(expected)
+            print('    %-8s  matches: %8d  time: %8.3fs  %12.0f conns/s  speedup: %7.1fx' % (
+                name, len(result), elapsed, num_connections / elapsed, legacy / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Memory kept per 100k HTTP transactions of a pipelined connection: a
+pair of HttpParser objects per transaction as HttpDetail used to keep,
+a pair of lazy HttpMessage records, and one HttpTransaction record.
+The payload itself is shared and not counted.
+
+    python benchmarks/bench_http_memory.py [num_transactions]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pytcptrace.http_parser import HttpParser, split_messages, build_transactions, deep_size
+
+__author__ = 'huangyan13@baidu.com'
+
+REQUEST = ('GET /item/%d HTTP/1.1\r\n'
+           'Host: example.com\r\n'
+           'User-Agent: bench/1.0\r\n'
+           'Accept: */*\r\n'
+           '\r\n')
+RESPONSE = ('HTTP/1.1 200 OK\r\n'
+            'Content-Type: text/plain\r\n'
+            'Cache-Control: max-age=3600\r\n'
+            'Content-Length: 16\r\n'
+            '\r\n'
+            '%016d')
+
+
+def parsers(data, start, end):
+    result_list = []
+    while start < end:
+        r = HttpParser(decompress=True)
+        ret = r.execute(data[start:end])
+        if ret < 0:
+            break
+        start += ret
+        result_list.append(r)
+    return result_list
+
+
+def main():
+    num_transactions = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    requests = ''.join(REQUEST % idx for idx in xrange(num_transactions))
+    data = requests + ''.join(RESPONSE % idx for idx in xrange(num_transactions))
+    print('%d transactions, reported per 100k' % num_transactions)
+    for name, build in (
+            ('parsers', lambda: zip(parsers(data, 0, len(requests)), parsers(data, len(requests), len(data)))),
+            ('messages', lambda: zip(split_messages(data, 0, len(requests)), split_messages(data, len(requests)))),
+            ('records', lambda: build_transactions(data, split_messages(data, 0, len(requests)),
+                                                   split_messages(data, len(requests))))):
+        start = time.time()
+        result = build()
+        elapsed = time.time() - start
+        assert len(result) == num_transactions
+        size = deep_size(result, exclude=(data, )) * 100000.0 / num_transactions
+        print('    %-8s  build: %8.3fs  memory: %8.1f MB  (%5.0f bytes/transaction)' % (
+            name, elapsed, size / 1e6, size / 100000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+HttpParser on large messages: the copying execute() against the
+offset-based parse(), on a request with many headers and on a chunked
+response body (body joined once, by get_body).
+
+    python benchmarks/bench_http_parser.py [num_headers] [body_mb] [chunk_kb]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pytcptrace.http_parser import HttpParser
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def headers_message(num_headers):
+    headers = ''.join('X-Header-%d: value-%d\r\n' % (idx, idx) for idx in xrange(num_headers))
+    return 'GET /index.html HTTP/1.1\r\nHost: example.com\r\n%s\r\n' % headers
+
+
+def chunked_message(body_size, chunk_size):
+    chunk = '%x\r\n%s\r\n' % (chunk_size, 'x' * chunk_size)
+    return ('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n' +
+            chunk * (body_size // chunk_size) + '0\r\n\r\n')
+
+
+def measure(func, repeat):
+    start = time.time()
+    for _ in xrange(repeat):
+        result = func()
+    return (time.time() - start) / repeat, result
+
+
+def legacy(data):
+    parser = HttpParser()
+    parser.execute(data)
+    return len(parser.get_body())
+
+
+def offsets(data):
+    parser = HttpParser()
+    parser.parse(data)
+    return len(parser.get_body())
+
+
+def main():
+    num_headers = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    body_size = int(float(sys.argv[2]) * 1024 * 1024) if len(sys.argv) > 2 else 10 * 1024 * 1024
+    chunk_size = int(sys.argv[3]) * 1024 if len(sys.argv) > 3 else 16 * 1024
+    for name, data, repeat in (
+            ('%d headers' % num_headers, headers_message(num_headers), 2000),
+            ('%d KB chunked body' % (body_size // 1024), chunked_message(body_size, chunk_size), 3)):
+        print('%s (%d bytes)' % (name, len(data)))
+        execute, expected = measure(lambda: legacy(data), repeat)
+        for method, elapsed, result in (
+                ('execute', execute, expected),
+                ('parse', ) + measure(lambda: offsets(data), repeat)):
+            assert result == expected
+            print('    %-8s  time: %10.6fs  %10.1f MB/s  speedup: %7.1fx' % (
+                method, elapsed, len(data) / elapsed / 1e6, execute / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Splitting a pipelined keep-alive connection into messages: the former
+loop of one HttpParser per message over the rest of the stream against
+split_messages, one parser walking the stream with offsets. Memory
+per message is reported as split, and once headers and bodies of the
+lazy records have been materialized.
+
+    python benchmarks/bench_http_split.py [num_requests]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pytcptrace.http_parser import HttpParser, split_messages, deep_size
+
+__author__ = 'huangyan13@baidu.com'
+
+REQUEST = ('GET /item/%d HTTP/1.1\r\n'
+           'Host: example.com\r\n'
+           'User-Agent: bench/1.0\r\n'
+           'Connection: keep-alive\r\n'
+           'Content-Length: 16\r\n'
+           '\r\n'
+           '%016d')
+
+
+def legacy(raw_data):
+    result_list = []
+    start = 0
+    end = len(raw_data)
+    while start < end:
+        r = HttpParser(decompress=True)
+        ret = r.execute(raw_data[start:])
+        if ret < 0:
+            break
+        start += ret
+        result_list.append(r)
+    return result_list
+
+
+def measure(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def main():
+    num_requests = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    data = ''.join(REQUEST % (idx, idx) for idx in xrange(num_requests))
+    print('%d pipelined requests (%d bytes)' % (num_requests, len(data)))
+    execute, expected = measure(lambda: legacy(data))
+    for name, elapsed, result in (
+            ('execute', execute, expected),
+            ('split', ) + measure(lambda: split_messages(data, decompress=True))):
+        before = deep_size(result, exclude=(data, )) / float(num_requests)
+        assert [r.get_url() for r in result] == [r.get_url() for r in expected]
+        assert [r.get_body() for r in result] == [r.get_body() for r in expected]
+        assert [r.get_headers()['Host'] for r in result] == [r.get_headers()['Host'] for r in expected]
+        after = deep_size(result, exclude=(data, )) / float(num_requests)
+        print('    %-8s  time: %8.3fs  %10.0f msgs/s  speedup: %7.1fx  bytes/msg: %6.0f (%6.0f materialized)' % (
+            name, elapsed, num_requests / elapsed, execute / elapsed, before, after))
+
+
+if __name__ == '__main__':
+    main()
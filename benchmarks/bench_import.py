@@ -0,0 +1,53 @@
+"""
+Import-time benchmark, every measurement runs in a fresh interpreter:
+the headless `import pytcptrace.core`, the bare package import, and the
+first filter parse with the shipped LALR tables against generating them.
+
+    python benchmarks/bench_import.py [runs]
+"""
+import os
+import sys
+import subprocess
+
+__author__ = 'huangyan13@baidu.com'
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SNIPPETS = [
+    ('import pytcptrace.core', 'import pytcptrace.core', ''),
+    ('import pytcptrace', 'import pytcptrace', ''),
+    ('first parse, tables', 'from pytcptrace.filter import compile_filter',
+     'compile_filter("tcp.port_b == 80")'),
+    ('first parse, no tables', 'import ply.yacc, pytcptrace.filter as f',
+     'ply.yacc.yacc(module=f, tabmodule="no_parsetab", debug=False, write_tables=False, '
+     'errorlog=ply.yacc.NullLogger())'),
+]
+
+TEMPLATE = '''
+import sys, time
+sys.path.insert(0, %r)
+start = time.time()
+%s
+middle = time.time()
+%s
+print(repr((middle - start, time.time() - middle)))
+'''
+
+
+def measure(setup, statement, runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', TEMPLATE % (ROOT, setup, statement)])
+        results.append(eval(output.strip().splitlines()[-1]))
+    return sorted(results)[len(results) / 2]
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for name, setup, statement in SNIPPETS:
+        import_time, run_time = measure(setup, statement, runs)
+        print('%-24s  import: %8.1f ms  then: %8.1f ms' % (name, import_time * 1000, run_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Compare time-to-first-connection and peak RSS of the streaming ingest
+against the buffered (temporary file) one.
+
+    python benchmarks/bench_ingest.py capture.pcap
+"""
+import os
+import sys
+import time
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and in kilobytes on Linux
+    return rss / (1024. * 1024.) if sys.platform == 'darwin' else rss / 1024.
+
+
+def run(mode, pcap_file):
+    from pytcptrace.pytcptrace import TcpTrace
+    tcptrace = TcpTrace()
+    start = time.time()
+    first = None
+    if mode == 'streaming':
+        num_conn = 0
+        for _ in tcptrace.iter_connections(pcap_file):
+            if first is None:
+                first = time.time() - start
+            num_conn += 1
+    else:
+        handle = tcptrace.open(pcap_file, streaming=False)
+        first = time.time() - start
+        num_conn = len(handle.conn_data)
+    total = time.time() - start
+    print('%-10s connections: %8d  first: %8.3fs  total: %8.3fs  peak rss: %8.1f MB' %
+          (mode, num_conn, first or 0., total, peak_rss_mb()))
+
+
+def main():
+    if len(sys.argv) == 3:
+        run(sys.argv[1], sys.argv[2])
+        return
+    if len(sys.argv) != 2:
+        print(__doc__)
+        sys.exit(1)
+    # run every mode in a fresh interpreter so peak RSS is not shared
+    for mode in ('buffered', 'streaming'):
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), mode, sys.argv[1]])
+
+
+if __name__ == '__main__':
+    main()
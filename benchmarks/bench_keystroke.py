@@ -0,0 +1,61 @@
+"""
+Per-keystroke latency of the filter entry: every prefix of an expression
+is validated as if typed, first with the AST rendered to a PNG on each
+parse like before (skipped without pygraphviz), then parsed without
+rendering, then again from the memoized filters, as when editing the
+expression back and forth.
+
+    python benchmarks/bench_keystroke.py [expression]
+"""
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pytcptrace.filter import generate_filter, compile_filter, clear_filter_cache
+
+__author__ = 'huangyan13@baidu.com'
+
+EXPRESSION = 'tcp.host_a == 10.0.0.1 && (tcp.port_b == 80 || tcp.a2b.unique_bytes_sent >= 1000)'
+
+
+def type_expression(expr, validate):
+    latencies = []
+    for end in range(1, len(expr) + 1):
+        start = time.time()
+        try:
+            validate(expr[:end])
+        except Exception:
+            # incomplete expressions are expected while typing
+            pass
+        latencies.append(time.time() - start)
+    return latencies
+
+
+def render(expr):
+    compile_filter(expr).ast.show(os.path.join(tempfile.gettempdir(), 'AST.png'))
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    print('%-10s  keystrokes: %4d  mean: %8.3f ms  p95: %8.3f ms  max: %8.3f ms' % (
+        name, len(latencies), 1000 * sum(latencies) / len(latencies),
+        1000 * latencies[int(0.95 * (len(latencies) - 1))], 1000 * latencies[-1]))
+
+
+def main():
+    expr = sys.argv[1] if len(sys.argv) > 1 else EXPRESSION
+    try:
+        import pygraphviz
+        report('render', type_expression(expr, render))
+    except ImportError:
+        print('render      skipped, pygraphviz is not installed')
+    clear_filter_cache()
+    report('parse', type_expression(expr, generate_filter))
+    report('memoized', type_expression(expr, generate_filter))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Load-time benchmark over synthetic traces: time normalization and payload
+decoding of the former per-element dict loops against the columnar
+ConnectionTable path (vectorized shift, payloads decoded on access).
+The table build is reported separately, it also happens while streaming.
+
+    python benchmarks/bench_load.py [num_connections ...]
+"""
+import os
+import sys
+import time
+import base64
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pytcptrace.pytcptrace import PcapHandle
+from pytcptrace.table import ConnectionTable
+
+__author__ = 'huangyan13@baidu.com'
+
+POINTS_PER_DIRECTION = 20
+PAYLOAD = base64.b64encode(b'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+
+
+def synthetic_records(num_connections):
+    start = time.time()
+    records = []
+    for idx in xrange(num_connections):
+        first = start + idx * 0.01
+        conn = {
+            'host_a': u'10.0.%d.%d' % (idx >> 8 & 255, idx & 255), 'port_a': 1024 + idx % 60000,
+            'host_b': u'192.168.0.1', 'port_b': 80, 'complete': True,
+            'total_packets': 2 * POINTS_PER_DIRECTION,
+            'first_packet_time': first, 'last_packet_time': first + 1., 'elapsed_time': 1.,
+        }
+        for direct in ('a2b', 'b2a'):
+            points = [first + random.random() for _ in xrange(POINTS_PER_DIRECTION)]
+            conn[direct] = {
+                'FIN_pkts_sent': [1], 'packets_sent': [POINTS_PER_DIRECTION],
+                'unique_bytes_sent': [100], 'first_data_time': [points[0]],
+                'last_data_time': [points[-1]], 'data_trans_time': [points[-1] - points[0]],
+                'time': list(points), 'points_time': points,
+                'points_data': [25.] * POINTS_PER_DIRECTION, 'base64_data': PAYLOAD,
+            }
+        records.append(conn)
+    return records
+
+
+def legacy_load(conn_data):
+    """ the per-element loops PcapHandle used to run on the decoded JSON """
+    min_time = None
+    for conn in conn_data:
+        for t in (conn['first_packet_time'], conn['a2b']['first_data_time'][0],
+                  conn['b2a']['first_data_time'][0]):
+            if t > PcapHandle.TIME_MAGIC and (not min_time or t < min_time):
+                min_time = t
+
+    def time_wrapper(time_val):
+        return time_val if time_val < PcapHandle.TIME_MAGIC else time_val - min_time
+
+    for conn in conn_data:
+        for field in ('first_packet_time', 'last_packet_time'):
+            conn[field] = time_wrapper(conn[field])
+        for direct in ('a2b', 'b2a'):
+            for field in ('first_data_time', 'last_data_time'):
+                conn[direct][field][0] = time_wrapper(conn[direct][field][0])
+            for field in ('time', 'points_time'):
+                for i in range(len(conn[direct][field])):
+                    conn[direct][field][i] = time_wrapper(conn[direct][field][i])
+            conn[direct]['base64_data'] = PcapHandle.decode_base64(conn[direct]['base64_data'])
+
+
+def main():
+    sizes = map(int, sys.argv[1:]) or [10000, 100000, 1000000]
+    for size in sizes:
+        records = synthetic_records(size)
+        start = time.time()
+        legacy_load(records)
+        legacy = time.time() - start
+
+        records = synthetic_records(size)
+        start = time.time()
+        table = ConnectionTable.from_records(records)
+        build = time.time() - start
+        del records
+        start = time.time()
+        PcapHandle(table, '', '')
+        columnar = time.time() - start
+        print('%8d connections  legacy shift+decode: %7.2fs  '
+              'table build: %7.2fs  vectorized shift: %7.3fs' % (size, legacy, build, columnar))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Scaling of the parallel ingest over 1, 2, 4 and 8 tcptrace workers. The
+split of the capture into chunks, which runs before any worker starts, is
+timed on its own and reported apart from the analysis of the chunks.
+
+    python benchmarks/bench_parallel.py capture.pcap [flow|time]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pytcptrace.pytcptrace import TcpTrace
+from pytcptrace.pcap import split_pcap
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    pcap_file = sys.argv[1]
+    split = sys.argv[2] if len(sys.argv) > 2 else 'flow'
+    size = os.path.getsize(pcap_file)
+    base = None
+    for workers in (1, 2, 4, 8):
+        split_time = 0.
+        if workers > 1:
+            temp_dir = tempfile.mkdtemp()
+            try:
+                start = time.time()
+                split_pcap(pcap_file, workers, temp_dir, split)
+                split_time = time.time() - start
+            finally:
+                shutil.rmtree(temp_dir)
+        start = time.time()
+        handle = TcpTrace().open(pcap_file, workers=workers, split=split)
+        elapsed = time.time() - start
+        base = base or elapsed
+        print('%d workers  connections: %8d  split: %7.2fs (%6.0f MB/s)  analysis: %8.2fs  '
+              'total: %8.2fs  speedup: %5.2fx' % (
+                  workers, len(handle.conn_data), split_time, size / 1e6 / split_time if split_time else 0,
+                  elapsed - split_time, elapsed, base / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Throughput curves of a bulk transfer: the former loop over every packet
+against average_windows, one searchsorted per averaging window and
+prefix sums, for the instant and the cumulative average throughput.
+Cached is the Instant/Average switch once the windows are known.
+
+    python benchmarks/bench_throughput.py [num_packets] [aver_window]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pytcptrace.widgets import average_windows, throughput
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def legacy(t, val, aver_window, cumulative):
+    x_val = []
+    y_val = []
+    prev_idx = 0
+    cumsum = np.cumsum(val)
+    for i in xrange(1, len(t)):
+        if t[i] - t[prev_idx] > aver_window:
+            x_val.append((t[i] + t[prev_idx]) / 2.)
+            if cumulative:
+                y_val.append((cumsum[i] - cumsum[0]) / (t[i] - t[0]))
+            else:
+                y_val.append((cumsum[i] - cumsum[prev_idx]) / (t[i] - t[prev_idx]))
+            prev_idx = i
+    return np.array(x_val), np.array(y_val)
+
+
+def measure(func):
+    start = time.time()
+    result = func()
+    return time.time() - start, result
+
+
+def main():
+    num_packets = int(sys.argv[1]) if len(sys.argv) > 1 else 5000000
+    aver_window = float(sys.argv[2]) if len(sys.argv) > 2 else 0.2
+    # 100 seconds of 1448 byte segments, with bursts and gaps
+    t = np.random.exponential(size=num_packets).cumsum()
+    t *= 100. / t[-1]
+    val = np.full(num_packets, 1448, dtype=np.int64)
+    windows = average_windows(t, val, aver_window)
+    print('%d packets, %d windows of %.3fs' % (num_packets, len(windows[0]), aver_window))
+    for name, cumulative in (('instant', False), ('average', True)):
+        loop, expected = measure(lambda: legacy(t, val, aver_window, cumulative))
+        for method, elapsed, result in (
+                ('loop', loop, expected),
+                ('numpy', ) + measure(lambda: throughput(average_windows(t, val, aver_window), cumulative)),
+                ('cached', ) + measure(lambda: throughput(windows, cumulative))):
+            assert np.allclose(result[0], expected[0]) and np.allclose(result[1], expected[1])
+            print('    %-8s %-7s  time: %10.6fs  speedup: %9.1fx' % (
+                name, method, elapsed, loop / elapsed))
+
+
+if __name__ == '__main__':
+    main()
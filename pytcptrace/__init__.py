@@ -1,3 +1,4 @@
+# only the headless API, the GUI classes are in pytcptrace.container and
+# pytcptrace.widgets, import them from there so that Tkinter and matplotlib
+# are not loaded by `import pytcptrace.core`
 from pytcptrace import *
-from container import *
-from widgets import *
@@ -0,0 +1,251 @@
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import unittest
+from tempfile import mkdtemp, NamedTemporaryFile
+import numpy as np
+from table import ConnectionTable
+from payload import PayloadStore
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class ResultCache:
+    """
+        On-disk cache of analyzed captures. Every entry is a directory holding
+        one .npy file per table column (loaded memory-mapped), the payload
+        blob, and tcptrace stdout/stderr. Entries are keyed by the pcap path,
+        size, mtime, a sampled content hash and the tcptrace flags, and the
+        least recently used ones are evicted above `max_bytes`.
+    """
+    DEFAULT_DIR = os.path.join(os.path.expanduser('~'), '.pytcptrace', 'cache')
+    DEFAULT_SIZE = 4 * 1024 * 1024 * 1024
+    # bytes hashed at the head, middle and tail of the capture
+    HASH_BLOCK = 1024 * 1024
+    # 3: http.status is the highest status of a connection
+    VERSION = 3
+
+    def __init__(self, cache_dir=None, max_bytes=DEFAULT_SIZE):
+        self.cache_dir = cache_dir or os.environ.get('PYTCPTRACE_CACHE', self.DEFAULT_DIR)
+        self.max_bytes = max_bytes
+
+    def content_hash(self, pcap_file):
+        # hashing a multi-GB capture would cost as much as analyzing it,
+        # so only sample it, size and mtime are part of the key anyway
+        size = os.path.getsize(pcap_file)
+        sha = hashlib.sha1()
+        with open(pcap_file, 'rb') as fid:
+            for offset in (0, max(0, size / 2 - self.HASH_BLOCK / 2), max(0, size - self.HASH_BLOCK)):
+                fid.seek(offset)
+                sha.update(fid.read(self.HASH_BLOCK))
+        return sha.hexdigest()
+
+    def make_key(self, pcap_file, flags):
+        pcap_file = os.path.abspath(pcap_file)
+        stat = os.stat(pcap_file)
+        key = json.dumps([self.VERSION, pcap_file, stat.st_size, stat.st_mtime,
+                          self.content_hash(pcap_file), list(flags)])
+        return hashlib.sha1(key).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def get(self, pcap_file, flags):
+        """ return (table, stdout, stderr) for a cached capture, or None """
+        path = self.entry_path(self.make_key(pcap_file, flags))
+        try:
+            with open(os.path.join(path, 'meta.json')) as fid:
+                meta = json.load(fid)
+            columns = {}
+            for name in meta['columns']:
+                columns[name] = self._load_array(path, 'col', name)
+            series = {}
+            for name in meta['series']:
+                series[name] = (self._load_array(path, 'val', name),
+                                self._load_array(path, 'off', name))
+            with open(os.path.join(path, 'stdout')) as fid:
+                stdout = fid.read()
+            with open(os.path.join(path, 'stderr')) as fid:
+                stderr = fid.read()
+            payloads = PayloadStore(path=os.path.join(path, 'payload'))
+        except (IOError, OSError, ValueError, KeyError):
+            # corrupt or partial, drop it so that put can write it again
+            if os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+            return None
+        # mark as recently used
+        os.utime(path, None)
+        return ConnectionTable(columns, series, meta['size'], payloads), stdout, stderr
+
+    @staticmethod
+    def _load_array(path, prefix, name):
+        file_name = os.path.join(path, '%s.%s.npy' % (prefix, name))
+        try:
+            # copy-on-write, so the loaded table can still be modified in memory
+            return np.load(file_name, mmap_mode='c')
+        except ValueError:
+            # object columns can't be memory-mapped
+            return np.load(file_name, allow_pickle=True)
+
+    def put(self, pcap_file, flags, table, stdout, stderr):
+        key = self.make_key(pcap_file, flags)
+        path = self.entry_path(key)
+        temp_path = path + '.%d.tmp' % os.getpid()
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(temp_path)
+            for name, values in table.columns.items():
+                np.save(os.path.join(temp_path, 'col.%s.npy' % name), values, allow_pickle=True)
+            for name, (values, offsets) in table.series.items():
+                np.save(os.path.join(temp_path, 'val.%s.npy' % name), values)
+                np.save(os.path.join(temp_path, 'off.%s.npy' % name), offsets)
+            table.payloads.save(os.path.join(temp_path, 'payload'))
+            with open(os.path.join(temp_path, 'stdout'), 'wb') as fid:
+                fid.write(stdout)
+            with open(os.path.join(temp_path, 'stderr'), 'wb') as fid:
+                fid.write(stderr)
+            with open(os.path.join(temp_path, 'meta.json'), 'w') as fid:
+                json.dump({'pcap_file': os.path.abspath(pcap_file), 'flags': list(flags),
+                           'size': len(table), 'columns': table.columns.keys(),
+                           'series': table.series.keys(), 'created': time.time()}, fid)
+            # make the entry visible at once
+            os.rename(temp_path, path)
+        except (IOError, OSError):
+            shutil.rmtree(temp_path, ignore_errors=True)
+            return
+        self.evict(keep=key)
+
+    def entries(self):
+        """ list of (key, meta, bytes, last use) from least recently used """
+        result = []
+        if not os.path.isdir(self.cache_dir):
+            return result
+        for key in os.listdir(self.cache_dir):
+            path = self.entry_path(key)
+            if key.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            try:
+                with open(os.path.join(path, 'meta.json')) as fid:
+                    meta = json.load(fid)
+            except (IOError, ValueError):
+                meta = {}
+            size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+            result.append((key, meta, size, os.path.getmtime(path)))
+        return sorted(result, key=lambda x: x[3])
+
+    def remove(self, key):
+        shutil.rmtree(self.entry_path(key), ignore_errors=True)
+
+    def evict(self, keep=None):
+        """ remove the least recently used entries above max_bytes, except `keep` """
+        entries = self.entries()
+        total = sum(entry[2] for entry in entries)
+        for key, meta, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            self.remove(key)
+            total -= size
+
+    def purge(self):
+        for entry in self.entries():
+            self.remove(entry[0])
+
+
+class TestResultCache(unittest.TestCase):
+    records = [
+        {'host_a': u'10.0.0.1', 'port_a': 1234,
+         'a2b': {'unique_bytes_sent': [10], 'points_time': [1.0, 2.0], 'base64_data': 'YWJj'}},
+        {'host_a': u'10.0.0.2', 'port_a': 80,
+         'a2b': {'unique_bytes_sent': [30], 'points_time': []}},
+    ]
+
+    def setUp(self):
+        self.cache = ResultCache(mkdtemp())
+        self.pcap = NamedTemporaryFile()
+        self.pcap.write('\xd4\xc3\xb2\xa1' + 'x' * 100)
+        self.pcap.flush()
+        self.table = ConnectionTable.from_records(self.records)
+
+    def tearDown(self):
+        self.pcap.close()
+        shutil.rmtree(self.cache.cache_dir, ignore_errors=True)
+
+    def test_round_trip(self):
+        self.assertEqual(self.cache.get(self.pcap.name, ['-l']), None)
+        # object columns are stored too, just not memory-mapped
+        self.table.columns['note'] = np.array([None, 'x'], dtype=object)
+        self.cache.put(self.pcap.name, ['-l'], self.table, 'out', 'err')
+        table, stdout, stderr = self.cache.get(self.pcap.name, ['-l'])
+        self.assertEqual((stdout, stderr, len(table)), ('out', 'err', 2))
+        self.assertEqual(list(table.column('port_a')), [1234, 80])
+        self.assertEqual(list(table.column('note')), [None, 'x'])
+        self.assertEqual(list(table.get_series('a2b.points_time', 0)), [1.0, 2.0])
+        self.assertEqual(table.get_payload('a2b', 0), 'abc')
+        # other flags, other entry
+        self.assertEqual(self.cache.get(self.pcap.name, ['-n']), None)
+
+    def test_evict(self):
+        self.cache.put(self.pcap.name, ['-l'], self.table, 'out', 'err')
+        key = self.cache.make_key(self.pcap.name, ['-l'])
+        self.cache.max_bytes = self.cache.entries()[0][2]
+        # the older entry goes, the one just written stays
+        os.utime(self.cache.entry_path(key), (0, 0))
+        self.cache.put(self.pcap.name, ['-n'], self.table, 'out', 'err')
+        self.assertEqual([entry[0] for entry in self.cache.entries()],
+                         [self.cache.make_key(self.pcap.name, ['-n'])])
+        # even when it alone is above the limit
+        self.cache.max_bytes = 1
+        self.cache.put(self.pcap.name, ['-l'], self.table, 'out', 'err')
+        self.assertEqual([entry[0] for entry in self.cache.entries()], [key])
+        self.assertNotEqual(self.cache.get(self.pcap.name, ['-l']), None)
+
+    def test_corrupt_entry(self):
+        self.cache.put(self.pcap.name, ['-l'], self.table, 'out', 'err')
+        path = self.cache.entry_path(self.cache.make_key(self.pcap.name, ['-l']))
+        with open(os.path.join(path, 'col.port_a.npy'), 'r+b') as fid:
+            fid.truncate(10)
+        self.assertEqual(self.cache.get(self.pcap.name, ['-l']), None)
+        self.assertFalse(os.path.exists(path))
+        # cached again on the next run
+        self.cache.put(self.pcap.name, ['-l'], self.table, 'out', 'err')
+        self.assertEqual(list(self.cache.get(self.pcap.name, ['-l'])[0].column('port_a')), [1234, 80])
+        os.remove(os.path.join(path, 'meta.json'))
+        self.assertEqual(self.cache.get(self.pcap.name, ['-l']), None)
+        self.assertEqual(self.cache.entries(), [])
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Inspect or purge the pytcptrace result cache.')
+    parser.add_argument('--dir', help='cache directory')
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('list', help='list cached captures')
+    remove = sub.add_parser('purge', help='remove cached captures')
+    remove.add_argument('keys', nargs='*', help='entries to remove, all if omitted')
+    args = parser.parse_args(argv)
+
+    cache = ResultCache(args.dir)
+    if args.command == 'list':
+        total = 0
+        for key, meta, size, last_use in cache.entries():
+            total += size
+            print('%s  %8.1f MB  %s  %7s conns  %s' % (
+                key, size / 1048576., time.strftime('%Y-%m-%d %H:%M', time.localtime(last_use)),
+                meta.get('size', '?'), meta.get('pcap_file', '?')))
+        print('total %.1f MB in %s' % (total / 1048576., cache.cache_dir))
+    else:
+        if args.keys:
+            for key in args.keys:
+                cache.remove(key)
+        else:
+            cache.purge()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
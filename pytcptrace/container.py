@@ -1,18 +1,31 @@
 # encoding: utf-8
 import os
 import sys
+import time
+import Queue
+import threading
 import Tkinter as tk
 import ttk
-import tkFont
+import numpy as np
 import FileDialog
-from pytcptrace import TcpTrace
+from pytcptrace import TcpTrace, PcapHandle, TcpTraceCancelled
+from features import add_http_features, HTTP_FEATURES
+from cache import ResultCache
 from filter import generate_filter
+from metrics import get_metrics
 from tkFileDialog import askopenfilename
 from tkMessageBox import showerror
 from subprocess import Popen, PIPE
 
 
 class PyTcpTrace:
+    # seconds before an unfinished tcptrace is killed
+    LOAD_TIMEOUT = 3600
+    # milliseconds between two looks at the connections loaded so far
+    POLL_INTERVAL = 100
+    # seconds spent appending loaded connections per look
+    POLL_BUDGET = 0.05
+
     def __init__(self, master):
         self.master = master
         master.title("Network Performance Analyze")
@@ -21,11 +34,20 @@ class PyTcpTrace:
         self.filename = tk.StringVar()
         self.passwd = tk.StringVar()
         self.filter_str = tk.StringVar()
+        self.status = tk.StringVar()
 
         self.widget_dict = {}
         self.widget_frame = None
         self.connection_list = None
         self.handle = None
+        self.tcptrace = None
+        self.loading = False
+        # filled by the loading thread, drained by poll_loading on the Tk thread
+        self.load_queue = None
+        self.load_progress = (0, None)
+        self.load_size = 0
+        self.progress_bar = None
+        self.cancel_button = None
 
         self.init_filter()
         self.init_list()
@@ -49,6 +71,12 @@ class PyTcpTrace:
             .pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         tk.Button(master=new_frame, text='Select',
                   command=self.load_pcap_file).pack(side=tk.LEFT)
+        self.progress_bar = ttk.Progressbar(master=new_frame, mode='indeterminate', length=100)
+        self.progress_bar.pack(side=tk.LEFT)
+        self.cancel_button = tk.Button(master=new_frame, text='Cancel', state=tk.DISABLED,
+                                       command=self.cancel_loading)
+        self.cancel_button.pack(side=tk.LEFT)
+        tk.Label(master=new_frame, textvariable=self.status).pack(side=tk.LEFT)
         new_frame.pack(side=tk.TOP, fill=tk.BOTH)
 
     def password_dialog(self):
@@ -100,18 +128,119 @@ class PyTcpTrace:
         p.stdin.write(self.passwd.get() + '\n')
 
     def load_pcap_file(self):
+        if self.loading:
+            return
         file_path = askopenfilename(title='Choose .pcap file', initialdir='~/Downloads')
         if file_path:
+            self.loading = True
+            self.filename.set(file_path)
+            self.handle = None
+            self.load_progress = (0, None)
+            self.load_size = os.path.getsize(file_path)
+            self.load_queue = Queue.Queue()
+            self.tcptrace = TcpTrace(timeout=self.LOAD_TIMEOUT, cache=ResultCache())
+            # the analysis runs on a worker thread, the window keeps on refreshing
+            worker = threading.Thread(target=self.load_worker,
+                                      args=(self.tcptrace, file_path, self.load_queue))
+            worker.daemon = True
+            worker.start()
+            self.progress_bar.start()
+            self.cancel_button.config(state=tk.NORMAL)
+            self.master.after(self.POLL_INTERVAL, self.poll_loading)
+
+    def load_worker(self, tcptrace, file_path, queue):
+        def progress(num_connections, num_bytes):
+            # read by poll_loading, Tk must not be called from this thread
+            self.load_progress = (num_connections, num_bytes)
+
+        try:
+            for table in tcptrace.iter_tables(file_path, progress=progress):
+                # off the Tk thread, the http.* filter fields of each batch
+                if not table.has_column(HTTP_FEATURES[0]):
+                    add_http_features(table)
+                queue.put(('table', table))
+            queue.put(('done', ) + tcptrace.get_output())
+        except Exception as e:
+            queue.put(('error', e))
+
+    def poll_loading(self):
+        """ append the connections loaded so far to the list, in batches """
+        started = time.time()
+        # first row appended by this look, None when there was no table yet
+        start = len(self.handle.conn_data) if self.handle else None
+        added = False
+        message = None
+        try:
+            while time.time() - started < self.POLL_BUDGET:
+                message = self.load_queue.get_nowait()
+                if message[0] != 'table':
+                    break
+                self.add_connections(message[1])
+                added = True
+                message = None
+        except Queue.Empty:
+            pass
+        if added and start is None:
+            # associate connection list with tcptrace handle
+            self.connection_list.associate(self.handle)
+        elif added:
+            # only the new rows are filtered and inserted
+            self.connection_list.append_rows(start)
+        if message is None:
+            self.show_progress(*self.load_progress)
+            self.master.after(self.POLL_INTERVAL, self.poll_loading)
+        elif message[0] == 'done':
+            self.finish_loading(stdout=message[1], stderr=message[2])
+        else:
+            self.finish_loading(error=message[1])
+
+    def show_progress(self, num_connections, num_bytes):
+        if num_bytes is None or not self.load_size:
+            # the backend can't tell, keep the bar bouncing
+            self.status.set('Loading: %d connections' % num_connections)
+            return
+        if str(self.progress_bar.cget('mode')) != 'determinate':
+            self.progress_bar.stop()
+            self.progress_bar.config(mode='determinate', maximum=100)
+        percent = min(100., 100. * num_bytes / self.load_size)
+        self.progress_bar.config(value=percent)
+        self.status.set('Loading: %d connections, %.0f%% of %.1f MB' % (
+            num_connections, percent, self.load_size / 1048576.))
+
+    def add_connections(self, table):
+        if self.handle is None:
+            self.handle = PcapHandle(table, b'', b'')
             try:
-                self.filename.set(file_path)
-                self.handle = TcpTrace().open(self.filename.get())
-                # associate connection list with tcptrace handle
-                self.connection_list.associate(self.handle)
-                # enable widget buttons
-                for obj_tuple in self.widget_dict.values():
-                    obj_tuple[1].config(state=tk.NORMAL)
-            except RuntimeError:
+                self.handle.set_filter(generate_filter(self.filter_str.get()))
+            except Exception:
+                pass
+            # enable widget buttons
+            for obj_tuple in self.widget_dict.values():
+                obj_tuple[1].config(state=tk.NORMAL)
+        else:
+            self.handle.extend(table)
+
+    def finish_loading(self, stdout=b'', stderr=b'', error=None):
+        self.loading = False
+        self.progress_bar.stop()
+        self.progress_bar.config(mode='indeterminate', value=0)
+        self.cancel_button.config(state=tk.DISABLED)
+        if self.handle is None:
+            self.status.set('')
+            if not isinstance(error, TcpTraceCancelled):
                 showerror(title='Open file', message='Unable to load file, check if it is a valid .pcap file')
+        elif error is None:
+            self.handle.set_output(stdout, stderr)
+            self.tcptrace.store(self.filename.get(), self.handle)
+            self.status.set('Loaded %d connections' % len(self.handle.conn_data))
+        elif isinstance(error, TcpTraceCancelled):
+            self.status.set('Cancelled, %d connections loaded' % len(self.handle.conn_data))
+        else:
+            self.status.set('Stopped, %d connections loaded: %s' % (len(self.handle.conn_data), error))
+
+    def cancel_loading(self):
+        if self.loading:
+            self.tcptrace.cancel()
 
     def init_filter(self):
         new_frame = tk.Frame(master=self.master)
@@ -167,56 +296,102 @@ class PyTcpTrace:
 
 
 class ConnectionList:
+    """
+        Connections of a PcapHandle in a treeview, virtualized: the order
+        and selection are kept in Python and only the rows around the
+        viewport are materialized in the treeview, so lists of millions of
+        connections scroll and sort without creating millions of items.
+    """
     # float format
     FLOAT_FMT = '%.3f'
-
+    # treeview row height in pixels, to size the viewport
+    ROW_HEIGHT = 20
+    # rows materialized below the viewport
+    MARGIN = 20
+    # rows moved by one step of the mouse wheel
+    WHEEL_ROWS = 3
+    # rows measured to fit the column widths
+    WIDTH_SAMPLES = 1000
+    # Shift, Control and Command, clicks adding to the selection
+    MODIFIERS = 0x1 | 0x4 | 0x8
+
+    # sort keys are computed over whole columns of the connection table
     Headers = [
-        ('Status', lambda x: x['complete']),
-        ('Packets', lambda x: x['total_packets']),
-        ('Bytes', lambda x: x['a2b']['unique_bytes_sent'][0] +
-                            x['b2a']['unique_bytes_sent'][0]),
-        ('Start Time', lambda x: x['first_packet_time']),
-        ('End Time', lambda x: x['last_packet_time']),
-        ('Elapsed Time', lambda x: x['elapsed_time']),
+        ('Status', lambda t: t.column('complete')),
+        ('Packets', lambda t: t.column('total_packets')),
+        ('Bytes', lambda t: t.column('a2b.unique_bytes_sent') +
+                            t.column('b2a.unique_bytes_sent')),
+        ('Start Time', lambda t: t.column('first_packet_time')),
+        ('End Time', lambda t: t.column('last_packet_time')),
+        ('Elapsed Time', lambda t: t.column('elapsed_time')),
     ]
 
     def __init__(self, master):
         self.sort_status = {}
+        # (key function, descending) of the last sort, kept while rows are appended
+        self.sorting = None
         self.handle = None
         self.connections = None
+        # number of connections when columns were last fitted
+        self.fitted = 0
+        # table indices of all the rows, in display order
+        self.displayed = np.zeros(0, dtype=np.int64)
+        # the ones materialized in the treeview, from position `top`
+        self.rendered = np.zeros(0, dtype=np.int64)
+        self.top = 0
+        # item ids selected and table indices expanded, including rows not rendered
+        self.selection = set()
+        self.opened = set()
         self.listbox = None
+        self.scrollbar = None
+        self.metrics = None
         self.selected_all = False
         self.master = master
         self.init_treeview()
 
     def init_treeview(self):
-        scrollbar1 = tk.Scrollbar(master=self.master, orient=tk.VERTICAL)
+        self.scrollbar = tk.Scrollbar(master=self.master, orient=tk.VERTICAL, command=self.yview)
         scrollbar2 = tk.Scrollbar(master=self.master, orient=tk.HORIZONTAL)
         self.listbox = ttk.Treeview(master=self.master,
                                     columns=map(lambda x: x[0], self.Headers),
                                     # show="headings",
-                                    yscrollcommand=scrollbar1.set,
                                     xscrollcommand=scrollbar2.set)
-        scrollbar1.config(command=self.listbox.yview)
         scrollbar2.config(command=self.listbox.xview)
-        scrollbar1.pack(side=tk.RIGHT, fill=tk.Y)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
         scrollbar2.pack(side=tk.BOTTOM, fill=tk.X)
         self.listbox.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
+        self.listbox.bind('<ButtonPress-1>', self.on_click)
+        self.listbox.bind('<<TreeviewSelect>>', self.on_select)
+        self.listbox.bind('<<TreeviewOpen>>', lambda event: self.on_open(True))
+        self.listbox.bind('<<TreeviewClose>>', lambda event: self.on_open(False))
+        self.listbox.bind('<Configure>', lambda event: self.render())
+        self.listbox.bind('<MouseWheel>', lambda event: self.scroll(
+            -self.WHEEL_ROWS if event.delta > 0 else self.WHEEL_ROWS))
+        self.listbox.bind('<Button-4>', lambda event: self.scroll(-self.WHEEL_ROWS))
+        self.listbox.bind('<Button-5>', lambda event: self.scroll(self.WHEEL_ROWS))
+        self.metrics = get_metrics()
         self.init_header()
 
     def get_selected(self):
-        return self.connections, map(lambda iid: map(int, iid.split('-'))
-        if iid.find('-') != -1 else [int(iid), 0],
-                                     self.listbox.selection())
+        if self.selected_all:
+            return self.connections, [[int(index), sub] for index in self.displayed for sub in (0, 1, 2)]
+        return self.connections, sorted(map(lambda iid: map(int, iid.split('-'))
+                                            if iid.find('-') != -1 else [int(iid), 0],
+                                            self.selection))
 
     def clear_list(self):
-        for iid in self.listbox.get_children():
-            self.listbox.delete(iid)
+        self.listbox.delete(*self.listbox.get_children())
+        self.displayed = np.zeros(0, dtype=np.int64)
+        self.rendered = np.zeros(0, dtype=np.int64)
+        self.top = 0
+        self.selection.clear()
+        self.opened.clear()
+        self.selected_all = False
 
     def init_header(self):
         self.listbox.heading('#0', text='Connections   A <-> B')
         for header, func in self.Headers:
-            self.listbox.column(header, width=tkFont.Font().measure(header.title()))
+            self.listbox.column(header, width=self.metrics.measure(header.title()))
             # here we should save the parameter into default parameter of lambda function
             # or there could raise an error, only the last variable is saved
             self.listbox.heading(header, text=header,
@@ -226,26 +401,127 @@ class ConnectionList:
         if self.handle:
             if header not in self.sort_status:
                 self.sort_status[header] = False
-            self.update(sorted(self.handle.read(), key=func, reverse=self.sort_status[header]))
+            self.sorting = (func, self.sort_status[header])
+            self.update()
             self.sort_status[header] = not self.sort_status[header]
 
+    def sort_indices(self, indices):
+        func, reverse = self.sorting
+        order = np.argsort(func(self.handle.conn_data)[indices], kind='mergesort')
+        if reverse:
+            order = order[::-1]
+        return indices[order]
+
     def associate(self, handle):
         self.handle = handle
+        self.sorting = None
         self.update()
 
-    def update(self, conn_list=None):
-        # if no connection list is provided, just read from handle
-        if conn_list is None:
+    def append_rows(self, start):
+        """ show the rows from `start` on, just appended to the table, that match the filter """
+        indices = self.handle.read_indices()
+        # filter results are in table order, the new rows come last
+        new = indices[np.searchsorted(indices, start):]
+        if self.sorting and len(new):
+            func, reverse = self.sorting
+            keys = func(self.connections)
+            # merged into the sorted rows, as a stable sort of all of them would
+            displayed = self.displayed[::-1] if reverse else self.displayed
+            new = new[np.argsort(keys[new], kind='mergesort')]
+            displayed = np.insert(displayed, np.searchsorted(keys[displayed], keys[new], side='right'), new)
+            self.displayed = displayed[::-1] if reverse else displayed
+        else:
+            self.displayed = np.concatenate((self.displayed, new))
+        # refit once the table has doubled
+        if len(self.connections) >= 2 * self.fitted:
+            self.fit_columns()
+            self.fitted = len(self.connections)
+        self.render()
+
+    def update(self, indices=None):
+        # if no row indices are provided, read from handle in the current order
+        if indices is None:
             if self.handle:
-                self.update(self.handle.read())
+                indices = self.handle.read_indices()
+                if self.sorting:
+                    indices = self.sort_indices(indices)
+                self.update(indices)
             return
 
-        # first clear previous data
-        self.clear_list()
+        indices = np.asarray(indices, dtype=np.int64)
+        new_table = self.connections is not self.handle.conn_data
+        if new_table:
+            self.clear_list()
+        # save the connections for selection, rows are identified by table index
+        self.connections = self.handle.conn_data
+        self.displayed = indices
+        # rows the filter hides are no longer selected
+        if self.selection:
+            selection = list(self.selection)
+            shown = np.in1d([int(iid.split('-')[0]) for iid in selection], indices)
+            self.selection = set(iid for iid, keep in zip(selection, shown) if keep)
+        # refit as well once a table being loaded has doubled
+        if new_table or len(self.connections) >= 2 * self.fitted:
+            self.fit_columns()
+            self.fitted = len(self.connections)
+        self.render()
+
+    def visible_rows(self):
+        return max(int(self.listbox.cget('height')), self.listbox.winfo_height() // self.ROW_HEIGHT)
+
+    def yview(self, *args):
+        """ command of the vertical scrollbar, moves the rendered rows """
+        if args[0] == 'moveto':
+            self.scroll_to(int(round(float(args[1]) * len(self.displayed))))
+        elif args[0] == 'scroll':
+            self.scroll(int(args[1]) * (self.visible_rows() if args[2] == 'pages' else 1))
+
+    def scroll(self, rows):
+        self.scroll_to(self.top + rows)
+        return 'break'
+
+    def scroll_to(self, top):
+        top = max(0, min(top, len(self.displayed) - self.visible_rows()))
+        if top != self.top:
+            self.top = top
+            self.render()
+
+    def render(self):
+        """ materialize the rows of the viewport, touching only those which changed """
+        visible = self.visible_rows()
+        self.top = max(0, min(self.top, len(self.displayed) - visible))
+        window = self.displayed[self.top:self.top + visible + self.MARGIN]
+
+        removed = self.rendered[~np.in1d(self.rendered, window)]
+        if len(removed):
+            self.listbox.delete(*[str(index) for index in removed])
+        kept = self.rendered[np.in1d(self.rendered, window)]
+        shown = np.in1d(window, kept)
+        # a new sort order moves the kept rows, otherwise they are in place already
+        reorder = not np.array_equal(kept, window[shown])
+        for pos in (xrange(len(window)) if reorder else np.nonzero(~shown)[0]):
+            if shown[pos]:
+                self.listbox.move(str(window[pos]), '', pos)
+            else:
+                self.insert_row(window[pos], pos)
+        self.rendered = window
+
+        # the treeview itself never scrolls, its rows are replaced instead
+        self.listbox.yview_moveto(0)
+        if len(self.displayed):
+            self.scrollbar.set(float(self.top) / len(self.displayed),
+                               float(self.top + visible) / len(self.displayed))
+        else:
+            self.scrollbar.set(0, 1)
+        self.listbox.selection_set([iid for iid in self.rendered_items() if self.is_selected(iid)])
+
+    def rendered_items(self):
+        return [str(index) + suffix for index in self.rendered for suffix in ('', '-1', '-2')]
 
-        # save the connections for selection
-        self.connections = conn_list
+    def is_selected(self, iid):
+        return self.selected_all or iid in self.selection
 
+    def row_values(self, index):
         def time_wrapper(time_val):
             return self.FLOAT_FMT % time_val
 
@@ -257,45 +533,67 @@ class ConnectionList:
                    time_wrapper(sub_conn['last_data_time'][0]), \
                    time_wrapper(sub_conn['data_trans_time'][0])
 
-        for index, conn in enumerate(conn_list):
-            conn_details = (conn['complete'], conn['total_packets'],
-                            conn['a2b']['unique_bytes_sent'][0] + conn['b2a']['unique_bytes_sent'][0],
-                            time_wrapper(conn['first_packet_time']),
-                            time_wrapper(conn['last_packet_time']),
-                            time_wrapper(conn['elapsed_time']))
-            a2b_details = get_sub_connection(conn['a2b'])
-            b2a_details = get_sub_connection(conn['b2a'])
-            conn_str = '%s:%d - %s:%d' % (conn['host_a'], conn['port_a'],
-                                          conn['host_b'], conn['port_b'])
-            self.listbox.insert('', tk.END, str(index), values=conn_details, text=conn_str)
-            self.listbox.insert(str(index), tk.END, str(index) + '-1', text='A to B', values=a2b_details)
-            self.listbox.insert(str(index), tk.END, str(index) + '-2', text='B to A', values=b2a_details)
-
-            # adjust tree view width
-            col_w = tkFont.Font().measure(conn_str)
-            if self.listbox.column('#0', width=None) < col_w:
-                self.listbox.column('#0', width=col_w)
-
-            # adjust column width
-            for idx in range(len(conn_details)):
-                col_w = max(tkFont.Font().measure(str(conn_details[idx])),
-                            tkFont.Font().measure(str(a2b_details[idx])),
-                            tkFont.Font().measure(str(b2a_details[idx])))
-                cur_col = self.listbox.column(self.Headers[idx][0], width=None)
-                if cur_col < col_w:
-                    self.listbox.column(self.Headers[idx][0], width=col_w + 10)
+        conn = self.connections[index]
+        conn_details = (conn['complete'], conn['total_packets'],
+                        conn['a2b']['unique_bytes_sent'][0] + conn['b2a']['unique_bytes_sent'][0],
+                        time_wrapper(conn['first_packet_time']),
+                        time_wrapper(conn['last_packet_time']),
+                        time_wrapper(conn['elapsed_time']))
+        conn_str = '%s:%d - %s:%d' % (conn['host_a'], conn['port_a'],
+                                      conn['host_b'], conn['port_b'])
+        return conn_str, conn_details, get_sub_connection(conn['a2b']), get_sub_connection(conn['b2a'])
+
+    def insert_row(self, index, position):
+        conn_str, conn_details, a2b_details, b2a_details = self.row_values(index)
+        self.listbox.insert('', position, str(index), values=conn_details, text=conn_str,
+                            open=index in self.opened)
+        self.listbox.insert(str(index), tk.END, str(index) + '-1', text='A to B', values=a2b_details)
+        self.listbox.insert(str(index), tk.END, str(index) + '-2', text='B to A', values=b2a_details)
+
+    def fit_columns(self):
+        """ column widths fitting rows sampled over the whole list """
+        if not len(self.displayed):
+            return
+        samples = np.linspace(0, len(self.displayed) - 1, min(len(self.displayed), self.WIDTH_SAMPLES))
+        rows = [self.row_values(index) for index in np.unique(self.displayed[samples.astype(np.int64)])]
+        # one pass over each column, one Tcl call to set its width
+        col_w = self.metrics.max_width([row[0] for row in rows])
+        self.listbox.column('#0', width=max(col_w, self.metrics.measure('Connections   A <-> B')))
+        for idx, (header, _) in enumerate(self.Headers):
+            col_w = self.metrics.max_width([details[idx] for row in rows for details in row[1:]])
+            self.listbox.column(header, width=max(col_w + 10, self.metrics.measure(header.title())))
+
+    def on_click(self, event):
+        # a plain click on a row replaces the selection, rows not rendered included
+        if event.state & self.MODIFIERS or self.listbox.identify_region(event.x, event.y) not in ('tree', 'cell'):
+            return
+        if self.listbox.identify_element(event.x, event.y).endswith('indicator'):
+            return
+        self.selection.clear()
+        self.selected_all = False
+
+    def on_select(self, event):
+        selected = set(self.listbox.selection())
+        rendered = set(self.rendered_items())
+        if self.selected_all:
+            if selected == rendered:
+                return
+            # no longer all of them, rows not rendered stay selected
+            self.selected_all = False
+            self.selection = set(str(index) + suffix for index in self.displayed for suffix in ('', '-1', '-2'))
+        self.selection = (self.selection - rendered) | selected
+
+    def on_open(self, opened):
+        iid = self.listbox.focus()
+        if iid and iid.find('-') == -1:
+            if opened:
+                self.opened.add(int(iid))
+            else:
+                self.opened.discard(int(iid))
 
     def select_all(self):
-        if not self.listbox.get_children():
+        if not len(self.displayed):
             return
-        if self.selected_all:
-            for item in self.listbox.get_children():
-                self.listbox.selection_remove(item)
-                for child in self.listbox.get_children(item):
-                    self.listbox.selection_remove(child)
-        else:
-            for item in self.listbox.get_children():
-                self.listbox.selection_add(item)
-                for child in self.listbox.get_children(item):
-                    self.listbox.selection_add(child)
         self.selected_all = not self.selected_all
+        self.selection.clear()
+        self.listbox.selection_set([iid for iid in self.rendered_items() if self.is_selected(iid)])
@@ -0,0 +1,14 @@
+"""
+    Headless API: analyze captures, filter and cache connections without
+    importing Tkinter or matplotlib.
+
+        from pytcptrace.core import TcpTrace, generate_filter
+"""
+from pytcptrace import (TcpTrace, TcpTraceBackend, PcapHandle, TcpTraceProcess,
+                        TcpTraceCancelled, TcpTraceTimeout, BACKENDS)
+from native import NativeBackend
+from table import ConnectionTable
+from filter import generate_filter, compile_filter, CompiledFilter
+from cache import ResultCache
+
+__author__ = 'huangyan13@baidu.com'
@@ -0,0 +1,164 @@
+import re
+import base64
+import unittest
+import numpy as np
+from http_parser import split_messages
+
+__author__ = 'huangyan13@baidu.com'
+
+
+# columns added to the connection table, usable in filters: http.method and
+# http.host of the first request of a connection, http.status the highest
+# status of all its responses, so that on keep-alive connections
+# `http.status >= 500` finds a server error after the first response, and
+# `http.status in {404, 500}` tests the highest status only
+HTTP_FEATURES = ('http.method', 'http.host', 'http.status')
+HTTP_METHODS = ('GET', 'POST', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'PATCH', 'TRACE', 'CONNECT')
+# bytes of a payload searched for the request line and Host header
+HEADER_PEEK = 4096
+
+REQUEST_LINE = re.compile(r'([A-Z]+) \S+ HTTP/\d\.\d\r?\n')
+STATUS_LINE = re.compile(r'HTTP/\d\.\d (\d{3})')
+HOST_HEADER = re.compile(r'\nHost:[ \t]*([^\r\n]*)', re.I)
+
+
+def starts_with(table, direction, prefixes):
+    """
+        Rows whose payload in `direction` starts with one of `prefixes`,
+        compared on the memory-mapped blob without copying any payload.
+    """
+    name = '%s.payload_length' % direction
+    if not table.has_column(name) or not len(table):
+        return np.zeros(0, dtype=np.int64)
+    lengths = table.column(name)
+    offsets = table.column('%s.payload_offset' % direction)
+    rows = np.nonzero(lengths >= min(len(prefix) for prefix in prefixes))[0]
+    data = table.payloads.array()
+    if not len(rows) or not len(data):
+        return np.zeros(0, dtype=np.int64)
+    width = max(len(prefix) for prefix in prefixes)
+    # clamped, bytes past a short payload are never compared
+    heads = data[np.minimum(offsets[rows, None] + np.arange(width), len(data) - 1)]
+    match = np.zeros(len(rows), dtype=bool)
+    for prefix in prefixes:
+        expected = np.frombuffer(prefix, dtype=np.uint8)
+        match |= (lengths[rows] >= len(prefix)) & np.all(heads[:, :len(prefix)] == expected, axis=1)
+    return rows[match]
+
+
+def _peek(table, direction, index):
+    return bytes(table.get_payload_view(direction, index)[0:HEADER_PEEK])
+
+
+def add_http_features(table):
+    """
+        Add the http.method and http.host columns, taken from the first
+        request of every connection, and http.status, the highest status of
+        the responses found in its stream.
+    """
+    methods = np.zeros(len(table), dtype='U8')
+    hosts = [u''] * len(table)
+    statuses = np.zeros(len(table), dtype=np.int64)
+    prefixes = [method + ' ' for method in HTTP_METHODS]
+    # the client is usually A, so A is looked at first and the first direction found wins
+    for direction in ('a2b', 'b2a'):
+        for index in starts_with(table, direction, prefixes):
+            if methods[index]:
+                continue
+            head = _peek(table, direction, index)
+            request = REQUEST_LINE.match(head)
+            if not request:
+                continue
+            methods[index] = request.group(1)
+            end = head.find('\r\n\r\n')
+            host = HOST_HEADER.search(head, 0, end if end >= 0 else len(head))
+            hosts[index] = host.group(1).strip().decode('latin-1') if host else u''
+    # and the server usually B
+    for direction in ('b2a', 'a2b'):
+        rows = starts_with(table, direction, ['HTTP/'])
+        if not len(rows):
+            continue
+        blob = table.payloads.blob()
+        offsets = table.column('%s.payload_offset' % direction)
+        lengths = table.column('%s.payload_length' % direction)
+        for index in rows:
+            if statuses[index]:
+                continue
+            start = int(offsets[index])
+            end = start + int(lengths[index])
+            status = STATUS_LINE.match(blob, start, end)
+            if not status:
+                continue
+            try:
+                # split in place, only the headers delimiting the bodies are read
+                codes = [message.status_code for message in split_messages(blob, start, end, kind=1)
+                         if message.status_code]
+            except RuntimeError:
+                codes = []
+            statuses[index] = max(codes + [int(status.group(1))])
+    table.columns['http.method'] = methods
+    table.columns['http.host'] = np.array(hosts) if len(hosts) else np.zeros(0, dtype='U1')
+    table.columns['http.status'] = statuses
+
+
+class TestHttpFeatures(unittest.TestCase):
+    def test_features(self):
+        from table import ConnectionTable
+        encode = base64.b64encode
+        table = ConnectionTable.from_records([
+            {'a2b': {'base64_data': encode('GET /a HTTP/1.1\r\nHost: example.com\r\n\r\n')},
+             'b2a': {'base64_data': encode('HTTP/1.1 404 Not Found\r\n\r\n')}},
+            {'a2b': {'base64_data': encode('\x16\x03\x01 tls')}, 'b2a': {}},
+            {'a2b': {'base64_data': encode('HTTP/1.0 200 OK\r\n\r\n')},
+             'b2a': {'base64_data': encode('POST /b HTTP/1.0\r\nhost:api.local\r\n\r\nHost: body')}},
+            {'a2b': {'base64_data': encode('GE')}, 'b2a': {'base64_data': encode('')}},
+        ])
+        add_http_features(table)
+        self.assertEqual(list(table.column('http.method')), [u'GET', u'', u'POST', u''])
+        self.assertEqual(list(table.column('http.host')), [u'example.com', u'', u'api.local', u''])
+        self.assertEqual(list(table.column('http.status')), [404, 0, 200, 0])
+
+    def test_keep_alive(self):
+        from table import ConnectionTable
+        from filter import compile_filter
+        encode = base64.b64encode
+        requests = ''.join('GET /%d HTTP/1.1\r\nHost: %s\r\n\r\n' % (idx, host)
+                           for idx, host in enumerate(('a.com', 'b.com', 'a.com')))
+        table = ConnectionTable.from_records([
+            {'a2b': {'base64_data': encode(requests)},
+             'b2a': {'base64_data': encode('HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+                                           'HTTP/1.1 503 Unavailable\r\nContent-Length: 0\r\n\r\n'
+                                           'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')}},
+            {'a2b': {'base64_data': encode(requests)},
+             'b2a': {'base64_data': encode('HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n'
+                                           'HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')}},
+        ])
+        add_http_features(table)
+        # the first request, the highest status
+        self.assertEqual(list(table.column('http.host')), [u'a.com', u'a.com'])
+        self.assertEqual(list(table.column('http.status')), [503, 404])
+        for expr, expected in (('http.status >= 500', [0]), ('http.status in {404, 500}', [1]),
+                               ('http.status == 200', []), ('http.host == b.com', [])):
+            self.assertEqual(list(compile_filter(expr).indices(table)), expected, expr)
+
+    def test_both_directions(self):
+        from table import ConnectionTable
+        encode = base64.b64encode
+        # e.g. a proxy tunnel, both sides start with a request or a response
+        table = ConnectionTable.from_records([
+            {'a2b': {'base64_data': encode('GET /a HTTP/1.1\r\nHost: a.com\r\n\r\n')},
+             'b2a': {'base64_data': encode('PUT /b HTTP/1.1\r\nHost: b.com\r\n\r\n')}},
+            {'a2b': {'base64_data': encode('HTTP/1.1 301 Moved\r\n\r\n')},
+             'b2a': {'base64_data': encode('HTTP/1.1 200 OK\r\n\r\n')}},
+            # not a request line, B is used
+            {'a2b': {'base64_data': encode('GET nothing\r\n')},
+             'b2a': {'base64_data': encode('POST /c HTTP/1.0\r\nHost: c.com\r\n\r\n')}},
+        ])
+        add_http_features(table)
+        self.assertEqual(list(table.column('http.method')), [u'GET', u'', u'POST'])
+        self.assertEqual(list(table.column('http.host')), [u'a.com', u'', u'c.com'])
+        self.assertEqual(list(table.column('http.status')), [0, 200, 0])
+
+
+if __name__ == '__main__':
+    unittest.main()
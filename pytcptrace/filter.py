@@ -1,7 +1,13 @@
+import os
+import re
+import operator
+import unittest
+import numpy as np
 import ply.lex as lex
 import ply.yacc as yacc
-from pygraphviz import AGraph
 from random import random
+from collections import OrderedDict
+from table import PAYLOAD_NAMES
 
 __author__ = 'huangyan13@baidu.com'
 
@@ -15,7 +21,7 @@ def AST_DFS(node, g):
     node_name = str(id(node))
     g.add_node(node_name)
     if node.is_leaf():
-        g.get_node(node_name).attr['label'] = node.obj_name
+        g.get_node(node_name).attr['label'] = str(node.obj_name)
     else:
         g.get_node(node_name).attr['label'] = node.operator
         g.add_edge(node_name, AST_DFS(node.left_expr, g))
@@ -42,6 +48,8 @@ class ASTNode:
         return False
 
     def show(self, filename='AST.png'):
+        # debugging aid only, pygraphviz is optional
+        from pygraphviz import AGraph
         g = AGraph()
         g.graph_attr['label'] = 'AST'
         AST_DFS(self, g)
@@ -50,8 +58,10 @@ class ASTNode:
 
 
 class ASTLeaf:
-    def __init__(self, obj_name):
+    def __init__(self, obj_name, literal=False):
         self.obj_name = obj_name
+        # quoted strings and sets are never field names
+        self.literal = literal
 
     def get_obj(self):
         return self.obj_name
@@ -60,6 +70,8 @@ class ASTLeaf:
         return True
 
     def show(self, filename='AST.png'):
+        # debugging aid only, pygraphviz is optional
+        from pygraphviz import AGraph
         g = AGraph()
         g.graph_attr['label'] = 'AST'
         AST_DFS(self, g)
@@ -77,15 +89,25 @@ tokens = (
     'NEQ',
     'GT',
     'LT',
+    'STRING',
+    'CONTAINS',
+    'MATCHES',
+    'IN',
 )
 
-literals = ['!', '(', ')', '>', '<']
+literals = ['!', '(', ')', '>', '<', '{', '}', ',']
+
+# words which are operators rather than field names or constants
+reserved = {
+    'contains': 'CONTAINS',
+    'matches': 'MATCHES',
+    'in': 'IN',
+}
 
 
 # Tokens
 
 t_NAME = r'[a-zA-Z0-9_]+'
-t_OBJECT = t_NAME + r'(\.' + t_NAME + ')*'
 t_ignore = " \t"
 t_GT = r'>='
 t_LT = r'<='
@@ -112,20 +134,29 @@ def t_NUMBER(t):
     return t
 
 
+def t_STRING(t):
+    r'"([^"\\]|\\.)*"'
+    t.value = t.value[1:-1].decode('string_escape')
+    return t
+
+
+def t_OBJECT(t):
+    r'[a-zA-Z0-9_]+(\.[a-zA-Z0-9_]+)*'
+    t.type = reserved.get(t.value, 'OBJECT')
+    return t
+
+
 def t_error(t):
     t.lexer.skip(1)
     raise RuntimeError("Illegal character '%s'" % t.value[0])
 
 
-# Build the lexer
-lex.lex()
-
 # Parsing rules
 
 precedence = (
     ('left', 'OR'),
     ('left', 'AND'),
-    ('nonassoc', 'EQ', 'NEQ', 'GT', 'LT', '>', '<'),
+    ('nonassoc', 'EQ', 'NEQ', 'GT', 'LT', '>', '<', 'CONTAINS', 'MATCHES', 'IN'),
     ('right', '!'),
 )
 
@@ -137,6 +168,30 @@ def p_expression_obj(p):
     p[0] = ASTLeaf(p[1])
 
 
+def p_expression_string(p):
+    '''expression : STRING'''
+    p[0] = ASTLeaf(p[1], literal=True)
+
+
+def p_expression_in(p):
+    '''expression : expression IN '{' constants '}' '''
+    p[0] = ASTNode(p[1], p[2], ASTLeaf(frozenset(p[4]), literal=True))
+
+
+def p_constants(p):
+    '''constants : constant
+                 | constants ',' constant'''
+    p[0] = [p[1]] if len(p) == 2 else p[1] + [p[3]]
+
+
+def p_constant(p):
+    '''constant : OBJECT
+                | NUMBER
+                | IPADDR
+                | STRING'''
+    p[0] = p[1]
+
+
 def p_expression_par(p):
     '''expression : '(' expression ')' '''
     p[0] = p[2]
@@ -151,6 +206,8 @@ def p_expression_operator(p):
                   | expression LT expression
                   | expression '>' expression
                   | expression '<' expression
+                  | expression CONTAINS expression
+                  | expression MATCHES expression
                   | '!' expression'''
     if p[1] == '!':
         p[0] = ASTNode(None, p[1], p[2])
@@ -165,59 +222,555 @@ def p_error(p):
         raise RuntimeError("Syntax error at EOF")
 
 
-yacc.yacc()
+_lexer = None
+_parser = None
+
+
+def get_parser():
+    """
+        (lexer, parser), built on first use. The LALR tables are loaded
+        from the parsetab module shipped with the package, and only
+        regenerated (in memory) when the grammar no longer matches them.
+    """
+    global _lexer, _parser
+    if _parser is None:
+        try:
+            import parsetab
+        except ImportError:
+            parsetab = 'parsetab'
+        _lexer = lex.lex()
+        _parser = yacc.yacc(tabmodule=parsetab, debug=False, write_tables=False,
+                            errorlog=yacc.NullLogger())
+    return _lexer, _parser
+
+
+def write_parse_tables():
+    """ regenerate parsetab.py next to this module after changing the grammar """
+    yacc.yacc(tabmodule='parsetab', outputdir=os.path.dirname(os.path.abspath(__file__)),
+              debug=False, errorlog=yacc.NullLogger())
+
 
+# number of compiled expressions kept, the filter entry validates every keystroke
+FILTER_CACHE_SIZE = 256
+_filter_cache = OrderedDict()
 
-def generate_filter(filter_expr):
+
+def generate_filter(filter_expr, show_ast=None):
+    """
+        Compiled filter for `filter_expr`, memoized by expression string.
+        Invalid expressions raise the same error again without reparsing.
+        :param show_ast: file name to render the AST to (needs pygraphviz)
+    """
+    if not filter_expr:
+        return None
+    try:
+        result = _filter_cache.pop(filter_expr)
+    except KeyError:
+        try:
+            result = compile_filter(filter_expr)
+        except Exception as e:
+            result = e
+    _filter_cache[filter_expr] = result
+    if len(_filter_cache) > FILTER_CACHE_SIZE:
+        _filter_cache.popitem(last=False)
+    if isinstance(result, Exception):
+        raise result
+    if show_ast:
+        result.ast.show(show_ast)
+    return result
+
+
+def clear_filter_cache():
+    _filter_cache.clear()
+
+
+def compile_filter(filter_expr):
+    """ parse `filter_expr` once, None for an empty expression """
     if not filter_expr:
         return None
-    ast = yacc.parse(filter_expr)
-    ast.show()
-    return lambda conn: ast_eval(ast, conn)
+    lexer, parser = get_parser()
+    return CompiledFilter(filter_expr, parser.parse(filter_expr, lexer=lexer))
+
+
+def _contains(value, needle):
+    return needle in value
+
+
+def _matches(value, pattern):
+    return re.search(pattern, value) is not None
+
+
+def _member(value, values):
+    return value in values
+
+
+COMPARISONS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+    'contains': _contains,
+    'matches': _matches,
+    'in': _member,
+}
+
+
+class NotVectorizable(Exception):
+    """ the expression uses fields which are not plain columns """
+
+
+class CompiledFilter:
+    """
+        A parsed filter expression. Calling it with a connection evaluates
+        the AST like before; `mask` evaluates it over a whole ConnectionTable,
+        either as NumPy operations on the columns or, when the expression
+        needs per-packet series, with a closure compiled for the table.
+    """
+    def __init__(self, expr, ast):
+        self.expr = expr
+        self.ast = ast
+        self.conjuncts = frozenset(ast_key(node) for node in conjuncts(ast))
+
+    def refines(self, other):
+        """ True if every row matching this filter also matches `other` """
+        return other.conjuncts <= self.conjuncts
+
+    def __call__(self, conn):
+        return ast_eval(self.ast, conn)
+
+    def mask(self, table, mode='auto', rows=None):
+        """
+            boolean array, True for the rows of `table` matching the filter,
+            only over `rows` when given
+        """
+        # both modes reject what they would evaluate differently
+        check_types(self.ast, table)
+        count = len(table) if rows is None else len(rows)
+        if mode != 'row':
+            try:
+                result = _compile_vector(self.ast, table, rows)()
+                mask = np.zeros(count, dtype=bool)
+                mask[:] = _truth(result)
+                return mask
+            except NotVectorizable:
+                if mode == 'vector':
+                    raise
+        row_func = _compile_row(self.ast, table)
+        return np.fromiter((bool(row_func(idx)) for idx in (xrange(count) if rows is None else rows)),
+                           dtype=bool, count=count)
+
+    def indices(self, table, mode='auto', indexes=None, rows=None):
+        """
+            matching row indices, only looking at `rows` (e.g. the result of
+            a filter this one refines) or at the candidates from `indexes`
+        """
+        planned = plan(self.ast, indexes) if indexes else None
+        if rows is None or planned is not None and len(planned) < len(rows):
+            rows = planned
+        if rows is None:
+            return np.nonzero(self.mask(table, mode))[0]
+        if len(rows) > PLAN_MAX_FRACTION * len(table) and mode != 'row':
+            # gathering most of the rows costs more than a NumPy scan of all of
+            # them, unlike a row closure which only pays for the rows it sees
+            try:
+                return np.nonzero(self.mask(table, 'vector'))[0]
+            except NotVectorizable:
+                pass
+        rows = np.sort(rows)
+        return rows[self.mask(table, mode, rows)]
+
+
+def conjuncts(ast):
+    """ operands of the top level && operators of `ast` """
+    if not ast.is_leaf() and ast.operator == '&&':
+        return conjuncts(ast.left_expr) + conjuncts(ast.right_expr)
+    return [ast]
+
+
+def ast_key(ast):
+    """ hashable form of `ast`, equal for the same expression written differently """
+    if ast is None:
+        return None
+    if ast.is_leaf():
+        return ('"', ast.obj_name) if ast.literal else ast.obj_name
+    return ast.operator, ast_key(ast.left_expr), ast_key(ast.right_expr)
+
+
+# largest share of the rows worth narrowing the scan to
+PLAN_MAX_FRACTION = 0.25
+# the same comparison with its operands swapped
+FLIPPED = {'==': '==', '>=': '<=', '<=': '>=', '>': '<', '<': '>'}
+
+
+def plan(ast, indexes):
+    """
+        Candidate rows for `ast` from the secondary indexes of a table:
+        an array of row indices containing every matching row, in no
+        particular order, or None when all rows have to be scanned.
+    """
+    if ast.is_leaf() or ast.left_expr is None:
+        return None
+    if ast.operator in ('&&', '||'):
+        left, right = plan(ast.left_expr, indexes), plan(ast.right_expr, indexes)
+        if ast.operator == '||':
+            return None if left is None or right is None else np.union1d(left, right)
+        if left is None or right is None:
+            return right if left is None else left
+        # the whole expression is evaluated over the candidates anyway
+        return left if len(left) <= len(right) else right
+    if not ast.left_expr.is_leaf() or not ast.right_expr.is_leaf():
+        return None
+    if ast.operator == 'in':
+        name = _field_name(ast.left_expr)
+        if name is None:
+            return None
+        matches = [indexes.lookup(name, '==', value) for value in ast.right_expr.obj_name]
+        if any(rows is None for rows in matches):
+            return None
+        return np.concatenate(matches)
+    if ast.operator not in FLIPPED:
+        return None
+    name, value, op = _field_name(ast.left_expr), ast.right_expr, ast.operator
+    if name is None:
+        name, value, op = _field_name(ast.right_expr), ast.left_expr, FLIPPED[op]
+    if name is None or _field_name(value) is not None:
+        return None
+    return indexes.lookup(name, op, value.obj_name)
+
+
+def _field_name(leaf):
+    """ table field referenced by a leaf, None for a constant """
+    if isinstance(leaf.obj_name, str) and not leaf.literal:
+        fields = leaf.obj_name.split('.', 1)
+        if fields[0] == 'tcp' and len(fields) == 2:
+            return fields[1]
+        elif fields[0] == 'http':
+            # feature columns keep their prefix, features.HTTP_FEATURES tells
+            # which message of a connection each of them comes from
+            return leaf.obj_name
+    return None
+
+
+def _constant(ast):
+    """ (True, value) for a constant leaf, (False, None) otherwise """
+    if ast.is_leaf() and _field_name(ast) is None:
+        return True, ast.obj_name
+    return False, None
+
+
+# kinds of operands, only compared with the same kind
+NUMBER = 'number'
+STRING = 'string'
+DTYPE_KINDS = {'b': NUMBER, 'i': NUMBER, 'u': NUMBER, 'f': NUMBER, 'U': STRING, 'S': STRING}
+
+
+def _value_kind(value):
+    if isinstance(value, (bool, int, long, float)):
+        return NUMBER
+    return STRING if isinstance(value, basestring) else None
+
+
+def _kind(ast, table):
+    """ NUMBER or STRING for the value of `ast` over `table`, None when unknown """
+    if not ast.is_leaf():
+        # comparisons and logical operators give booleans
+        return NUMBER
+    name = _field_name(ast)
+    if name is None:
+        return _value_kind(ast.obj_name)
+    if table.has_column(name):
+        # e.g. object columns can hold anything
+        return DTYPE_KINDS.get(table.column(name).dtype.kind)
+    elif name in table.series:
+        return NUMBER
+    elif name in PAYLOAD_NAMES:
+        return STRING
+    raise KeyError(name)
+
+
+def check_types(ast, table):
+    """
+        Raise RuntimeError for operands of different kinds, like a string
+        column compared with a number, NumPy and Python would disagree on
+        the result. KeyError for an unknown field.
+    """
+    if ast.is_leaf():
+        _kind(ast, table)
+        return
+    if ast.left_expr is not None:
+        check_types(ast.left_expr, table)
+    check_types(ast.right_expr, table)
+    if ast.left_expr is None or ast.operator in ('&&', '||'):
+        return
+    left = _kind(ast.left_expr, table)
+    if ast.operator == 'in':
+        right = set(_value_kind(value) for value in ast.right_expr.obj_name)
+    else:
+        right = set([_kind(ast.right_expr, table)])
+    if left is None or None in right:
+        return
+    if ast.operator in ('contains', 'matches'):
+        if left != STRING or right != set([STRING]):
+            raise RuntimeError("Type error: '%s' needs strings on both sides" % ast.operator)
+    elif right != set([left]):
+        raise RuntimeError("Type error: '%s' between a %s and a %s" % (
+            ast.operator, left, ' or '.join(sorted(right - set([left])))))
+
+
+def _truth(values):
+    """ truth value of every element, strings are true when not empty like in Python """
+    if isinstance(values, basestring):
+        return bool(values)
+    if isinstance(values, np.ndarray) and values.dtype.kind in 'US':
+        return np.char.str_len(values) > 0
+    return values
+
+
+def _compile_row(ast, table):
+    """ closure evaluating `ast` for one row index of `table` """
+    if ast.is_leaf():
+        name = _field_name(ast)
+        if name is None:
+            value = ast.obj_name
+            return lambda idx: value
+        # resolve the column once instead of at every row
+        if table.has_column(name):
+            return table.column(name).__getitem__
+        elif name in table.series:
+            return lambda idx: table.get_value(name, idx)
+        elif name in PAYLOAD_NAMES:
+            direction = name.split('.')[0]
+            return lambda idx: table.get_payload(direction, idx)
+        raise KeyError(name)
+    right = _compile_row(ast.right_expr, table)
+    if ast.left_expr is None:
+        return lambda idx: not right(idx)
+    is_constant, value = _constant(ast.right_expr)
+    if ast.operator == 'contains' and is_constant and _field_name(ast.left_expr) in PAYLOAD_NAMES:
+        # search the memory-mapped payload instead of copying it
+        direction = _field_name(ast.left_expr).split('.')[0]
+        return lambda idx: table.find_payload(direction, idx, value) >= 0
+    elif ast.operator == 'matches' and is_constant:
+        pattern = re.compile(value)
+        left = _compile_row(ast.left_expr, table)
+        return lambda idx: pattern.search(left(idx)) is not None
+    left = _compile_row(ast.left_expr, table)
+    if ast.operator == '&&':
+        return lambda idx: left(idx) and right(idx)
+    elif ast.operator == '||':
+        return lambda idx: left(idx) or right(idx)
+    elif ast.operator in COMPARISONS:
+        compare = COMPARISONS[ast.operator]
+        return lambda idx: compare(left(idx), right(idx))
+    raise RuntimeError("Unknown operator %s" % ast.operator)
+
+
+def _compile_vector(ast, table, rows=None):
+    """ function returning the value of `ast` for all rows of `table` (or `rows`) at once """
+    if ast.is_leaf():
+        name = _field_name(ast)
+        if name is None:
+            value = ast.obj_name
+            return lambda: value
+        if not table.has_column(name):
+            if name in table.series or name in PAYLOAD_NAMES:
+                raise NotVectorizable(name)
+            raise KeyError(name)
+        column = table.column(name)
+        if rows is not None:
+            column = column[rows]
+        return lambda: column
+    right = _compile_vector(ast.right_expr, table, rows)
+    if ast.left_expr is None:
+        return lambda: np.logical_not(_truth(right()))
+    left = _compile_vector(ast.left_expr, table, rows)
+    if ast.operator == '&&':
+        return lambda: np.logical_and(_truth(left()), _truth(right()))
+    elif ast.operator == '||':
+        return lambda: np.logical_or(_truth(left()), _truth(right()))
+    elif ast.operator == 'contains':
+        return lambda: np.char.find(left(), right()) >= 0
+    elif ast.operator == 'in':
+        return lambda: np.in1d(left(), list(right()))
+    elif ast.operator == 'matches':
+        raise NotVectorizable(ast.operator)
+    elif ast.operator in COMPARISONS:
+        compare = COMPARISONS[ast.operator]
+        return lambda: compare(left(), right())
+    raise RuntimeError("Unknown operator %s" % ast.operator)
 
 
 def ast_eval(ast, connection):
     if ast.is_leaf():
-        # string type data, might be:
-        # 1. connection property
-        # 2. ip address
-        if isinstance(ast.obj_name, str):
-            fields = ast.obj_name.split('.')
-            if fields[0] == 'tcp':
-                val = connection
-                for field in fields[1:]:
-                    val = val[field]
-                return val[0] if isinstance(val, list) else val
-            else:
-                return ast.obj_name
-        else:
-            return ast.obj_name
+        # might be a connection property, or a constant
+        # like a number, an ip address or a string
+        name = _field_name(ast)
+        if name is not None:
+            return connection.field(name)
+        return ast.obj_name
     else:
         if ast.left_expr is None:
             return not ast_eval(ast.right_expr, connection)
         else:
-            if ast.operator == '==':
-                return ast_eval(ast.left_expr, connection) == ast_eval(ast.right_expr, connection)
-            elif ast.operator == '!=':
-                return ast_eval(ast.left_expr, connection) != ast_eval(ast.right_expr, connection)
-            elif ast.operator == '>=':
-                return ast_eval(ast.left_expr, connection) >= ast_eval(ast.right_expr, connection)
-            elif ast.operator == '<=':
-                return ast_eval(ast.left_expr, connection) <= ast_eval(ast.right_expr, connection)
-            elif ast.operator == '>':
-                return ast_eval(ast.left_expr, connection) > ast_eval(ast.right_expr, connection)
-            elif ast.operator == '<':
-                return ast_eval(ast.left_expr, connection) < ast_eval(ast.right_expr, connection)
-            elif ast.operator == '&&':
+            if ast.operator == '&&':
                 return ast_eval(ast.left_expr, connection) and ast_eval(ast.right_expr, connection)
             elif ast.operator == '||':
                 return ast_eval(ast.left_expr, connection) or ast_eval(ast.right_expr, connection)
+            elif ast.operator in COMPARISONS:
+                return COMPARISONS[ast.operator](ast_eval(ast.left_expr, connection),
+                                                 ast_eval(ast.right_expr, connection))
             else:
                 raise RuntimeError("Unknown operator %s" % ast.operator)
 
 
+class TestFilter(unittest.TestCase):
+    def setUp(self):
+        from table import ConnectionTable
+        self.table = ConnectionTable.from_records([
+            {'host_a': u'10.0.0.%d' % idx, 'port_a': 1000 + idx, 'complete': idx % 2 == 0,
+             'a2b': {'unique_bytes_sent': [idx * 10], 'points_time': [float(idx)] if idx else []}}
+            for idx in range(10)])
+
+    def check(self, expr, expected):
+        compiled = compile_filter(expr)
+        row = [idx for idx, conn in enumerate(self.table) if compiled(conn)]
+        self.assertEqual(row, expected)
+        self.assertEqual(list(compiled.indices(self.table, mode='row')), expected)
+        self.assertEqual(list(compiled.indices(self.table)), expected)
+
+    def test_modes(self):
+        self.check('tcp.a2b.unique_bytes_sent >= 50 && tcp.port_a != 1007', [5, 6, 8, 9])
+        self.check('tcp.host_a == 10.0.0.3 || !(tcp.port_a < 1008)', [3, 8, 9])
+        self.check('tcp.complete', [0, 2, 4, 6, 8])
+        self.check('1 == 1', range(10))
+
+    def test_plan(self):
+        from index import TableIndexes
+        indexes = TableIndexes(self.table)
+        for expr, candidates in (('tcp.a2b.unique_bytes_sent >= 50 && tcp.complete', [5, 6, 7, 8, 9]),
+                                 ('1003 == tcp.port_a || tcp.host_a == 10.0.0.8', [3, 8]),
+                                 ('tcp.a2b.unique_bytes_sent > 50 || tcp.complete', None),
+                                 ('tcp.port_a < 1004 && tcp.host_a == 10.0.0.2', [2]),
+                                 ('tcp.a2b.unique_bytes_sent < 40 && tcp.port_a == 1001', [1])):
+            compiled = compile_filter(expr)
+            rows = plan(compiled.ast, indexes)
+            self.assertEqual(None if rows is None else sorted(rows), candidates)
+            self.assertEqual(list(compiled.indices(self.table, indexes=indexes)),
+                             list(compiled.indices(self.table)))
+            self.assertEqual(list(compiled.indices(self.table, mode='row', indexes=indexes)),
+                             list(compiled.indices(self.table)))
+
+    def test_refines(self):
+        base = compile_filter('tcp.port_a > 1002 && tcp.complete')
+        refined = compile_filter('(tcp.complete) && tcp.a2b.unique_bytes_sent < 80 && tcp.port_a > 1002')
+        self.assertTrue(refined.refines(base))
+        self.assertFalse(base.refines(refined))
+        self.assertFalse(compile_filter('tcp.port_a > 1002 || tcp.complete').refines(base))
+        rows = base.indices(self.table)
+        self.assertEqual(list(refined.indices(self.table, rows=rows)), [4, 6])
+
+    def test_refined_rows(self):
+        base = compile_filter('tcp.port_a > 1003')
+        refined = compile_filter('tcp.port_a > 1003 && tcp.a2b.points_time > 5')
+        rows = base.indices(self.table)
+        self.assertEqual(len(rows), 6)
+        seen = []
+        get_value = self.table.get_value
+        self.table.get_value = lambda name, idx: seen.append(idx) or get_value(name, idx)
+        # more than PLAN_MAX_FRACTION of the rows, still only those go through the row closure
+        for mode in ('auto', 'row'):
+            del seen[:]
+            self.assertEqual(list(refined.indices(self.table, mode, rows=rows)), [6, 7, 8, 9])
+            self.assertEqual(sorted(seen), range(4, 10))
+
+    def test_series_fallback(self):
+        compiled = compile_filter('tcp.a2b.points_time')
+        self.assertRaises(NotVectorizable, compiled.mask, self.table, 'vector')
+        self.assertEqual(list(compiled.indices(self.table)), range(1, 10))
+        # series compare their first value, an empty one reads as None
+        self.check('tcp.a2b.points_time > 3', [4, 5, 6, 7, 8, 9])
+        self.check('tcp.a2b.points_time == 0', [])
+        from table import ConnectionTable
+        table = ConnectionTable.from_records([{'a2b': {'points_data': data}} for data in ([1, 10], [5], [])])
+        compiled = compile_filter('tcp.a2b.points_data > 3')
+        self.assertEqual([idx for idx, conn in enumerate(table) if compiled(conn)], [1])
+        self.assertEqual(list(compiled.indices(table)), [1])
+
+    def test_cache(self):
+        clear_filter_cache()
+        compiled = generate_filter('tcp.port_a == 1003')
+        self.assertTrue(generate_filter('tcp.port_a == 1003') is compiled)
+        self.assertRaises(RuntimeError, generate_filter, 'tcp.port_a ==')
+        self.assertRaises(RuntimeError, generate_filter, 'tcp.port_a ==')
+        self.assertEqual(len(_filter_cache), 2)
+
+    def test_http(self):
+        import base64
+        from table import ConnectionTable
+        from index import TableIndexes
+        from features import add_http_features
+        table = ConnectionTable.from_records([
+            {'a2b': {'base64_data': base64.b64encode(request)},
+             'b2a': {'base64_data': base64.b64encode('HTTP/1.1 %d OK\r\n\r\n' % status)}}
+            for request, status in (('GET / HTTP/1.1\r\nHost: a.com\r\nUser-Agent: curl\r\n\r\n', 200),
+                                    ('POST /x HTTP/1.1\r\nHost: b.com\r\n\r\n', 404),
+                                    ('PUT /y HTTP/1.1\r\nHost: api.a.com\r\n\r\n', 500))])
+        add_http_features(table)
+        indexes = TableIndexes(table)
+        for expr, expected in (('http.method == GET', [0]),
+                               ('http.method in {POST, PUT} && http.status >= 500', [2]),
+                               ('http.status in {200, 404}', [0, 1]),
+                               ('http.host contains "a.com"', [0, 2]),
+                               ('http.host matches "^[ab]\\."', [0, 1]),
+                               ('tcp.a2b.payload contains "User-Agent"', [0]),
+                               ('tcp.b2a.payload matches "HTTP/1\\.1 [45]"', [1, 2]),
+                               ('!(tcp.a2b.payload contains "Host")', [])):
+            compiled = compile_filter(expr)
+            self.assertEqual([idx for idx, conn in enumerate(table) if compiled(conn)], expected, expr)
+            self.assertEqual(list(compiled.indices(table, mode='row')), expected, expr)
+            self.assertEqual(list(compiled.indices(table, indexes=indexes)), expected, expr)
+        self.assertEqual(sorted(plan(compile_filter('http.status in {200, 500}').ast, indexes)), [0, 2])
+        # a quoted string is not a field
+        self.assertEqual(compile_filter('"tcp.host_a" == tcp.host_a').indices(self.table).tolist(), [])
+
+    def test_types(self):
+        import base64
+        from table import ConnectionTable
+        from features import add_http_features
+        table = ConnectionTable.from_records([
+            {'host_a': u'10.0.0.%d' % idx if idx != 3 else u'', 'port_a': 1000 + idx, 'complete': idx % 2 == 0,
+             'a2b': {'unique_bytes_sent': [idx * 1.5], 'points_time': [float(idx)] if idx else [],
+                     'base64_data': base64.b64encode('GET /%d HTTP/1.1\r\nHost: h%d\r\n\r\n' % (idx, idx % 3))}}
+            for idx in range(6)])
+        add_http_features(table)
+        # vector and row modes agree
+        for expr in ('tcp.host_a > 10.0.0.2', 'tcp.host_a && tcp.complete', '!tcp.host_a',
+                     'tcp.host_a || tcp.port_a > 1004', 'tcp.a2b.unique_bytes_sent >= 3',
+                     'tcp.complete == 1', 'tcp.port_a in {1001, 1003}', 'tcp.host_a in {10.0.0.1, "x"}',
+                     'http.host contains "1" || http.host == h2', 'http.method != GET',
+                     'tcp.a2b.points_time > 2', 'tcp.a2b.payload contains "/4"', 'http.host matches "h[01]"',
+                     '1 == 1', '"a" < "b"'):
+            compiled = compile_filter(expr)
+            expected = [idx for idx, conn in enumerate(table) if compiled(conn)]
+            self.assertEqual(list(compiled.indices(table, mode='row')), expected, expr)
+            self.assertEqual(list(compiled.indices(table)), expected, expr)
+            try:
+                self.assertEqual(list(compiled.indices(table, mode='vector')), expected, expr)
+            except NotVectorizable:
+                pass
+        # and both reject operands of different kinds
+        for expr in ('tcp.host_a > 5', '5 == tcp.host_a', 'tcp.port_a == 10.0.0.1', 'tcp.port_a contains "1"',
+                     'tcp.host_a contains 1', 'tcp.a2b.points_time == "x"', 'tcp.port_a in {1001, x}',
+                     'http.status matches "2.."', 'tcp.a2b.payload > 3', '(tcp.port_a > 1) == "x"',
+                     'tcp.complete && tcp.host_a < 3'):
+            for mode in ('vector', 'row', 'auto'):
+                self.assertRaises(RuntimeError, compile_filter(expr).mask, table, mode)
+
+    def test_unknown_field(self):
+        self.assertRaises(KeyError, compile_filter('tcp.nothing > 1').mask, self.table)
+
+
 if __name__ == '__main__':
-    pcap_file = '/Users/baidu/Library/Caches/clion11/cmake/generated/b28c2630/b28c2630/Release/demo/test/data.pcap'
-    from pytcptrace import TcpTrace
-    fid = TcpTrace().open(pcap_file)
-    generate_filter('tcp.data < 123')
+    unittest.main()
@@ -12,6 +12,7 @@
 
 import os
 import re
+import pickle
 import sys
 import unittest
 import urlparse
@@ -23,6 +24,7 @@ METHOD_RE = re.compile("[A-Z0-9$-_.]{3,20}")
 VERSION_RE = re.compile("HTTP/(\d+).(\d+)")
 STATUS_RE = re.compile("(\d{3})\s*(\w*)")
 HEADER_RE = re.compile("[\x00-\x1F\x7F()<>@,;:\[\]={} \t\\\\\"]")
+FRAMING_RE = re.compile(r"^(content-length|transfer-encoding|trailer)[ \t]*:[ \t]*(.*?)[ \t]*\r?$", re.I | re.M)
 
 # errors
 BAD_FIRST_LINE = -1
@@ -44,11 +46,119 @@ class InvalidChunkSize(Exception):
     """ error raised when we parse an invalid chunk size """
 
 
+# stream states of feed(), and the error of a stream closed in each
+STREAM_ERRORS = {
+    'first_line': BAD_FIRST_LINE,
+    'headers': INVALID_HEADER,
+    'body': INVALID_BODY,
+    'chunk_size': INVALID_CHUNK,
+    'chunk_data': INVALID_CHUNK,
+    'chunk_end': INVALID_CHUNK,
+    'trailer': INVALID_TRAILER,
+}
+
+
+def parse_header_lines(data, headers, environ=None):
+    """ add the CRLF separated header lines of `data` to `headers`, and to `environ` if given """
+    if not data:
+        return
+    lines = data.split("\r\n")
+    idx = 0
+
+    # Parse headers into key/value pairs paying attention
+    # to continuation lines.
+    while idx < len(lines):
+        # Parse initial header name : value pair.
+        curr = lines[idx]
+        idx += 1
+        if curr.find(":") < 0:
+            raise InvalidHeader("invalid line %s" % curr.strip())
+        name, value = curr.split(":", 1)
+        name = name.rstrip(" \t").upper()
+        if HEADER_RE.search(name):
+            raise InvalidHeader("invalid header name %s" % name)
+
+        name, value = name.strip(), [value.lstrip()]
+
+        # Consume value continuation lines
+        while idx < len(lines) and lines[idx].startswith((" ", "\t")):
+            value.append(lines[idx])
+            idx += 1
+        value = ''.join(value).rstrip()
+
+        # multiple headers
+        if name in headers:
+            value = "%s, %s" % (headers[name], value)
+
+        # store new header value
+        headers[name] = value
+
+        # update WSGI environ
+        if environ is not None:
+            environ['HTTP_%s' % name.upper().replace('-', '_')] = value
+
+
+def wsgi_environ(environ, path):
+    """ complete the HTTP_* keys of `environ` into a WSGI environ """
+    # clean special keys
+    for key in ("CONTENT_LENGTH", "CONTENT_TYPE", "SCRIPT_NAME"):
+        hkey = "HTTP_%s" % key
+        if hkey in environ:
+            environ[key] = environ.pop(hkey)
+
+    script_name = environ.get('SCRIPT_NAME',
+                              os.environ.get("SCRIPT_NAME", ""))
+    if script_name:
+        path_info = path.split(script_name, 1)[1]
+        environ.update({
+            "PATH_INFO": unquote(path_info),
+            "SCRIPT_NAME": script_name})
+    else:
+        environ['SCRIPT_NAME'] = ""
+
+    if environ.get('HTTP_X_FORWARDED_PROTOCOL', '').lower() == "ssl":
+        environ['wsgi.url_scheme'] = "https"
+    elif environ.get('HTTP_X_FORWARDED_SSL', '').lower() == "on":
+        environ['wsgi.url_scheme'] = "https"
+    else:
+        environ['wsgi.url_scheme'] = "http"
+
+    return environ
+
+
+def join_body(data, spans, headers, decompress):
+    """ body made of the `spans` of `data`, decompressed if asked and possible """
+    body = ''.join(str(data[start:end]) for start, end in spans)
+    encoding = headers.get('content-encoding')
+    if not body or not decompress or encoding not in ('gzip', 'deflate'):
+        return body
+    for wbits in (16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS, -zlib.MAX_WBITS):
+        try:
+            return zlib.decompress(body, wbits)
+        except zlib.error:
+            pass
+    return body
+
+
 class HttpParser(object):
-    def __init__(self, kind=2, decompress=False):
+    def __init__(self, kind=2, decompress=False, on_message_begin=None,
+                 on_headers_complete=None, on_body=None, on_message_complete=None):
         self.kind = kind
         self.decompress = decompress
 
+        # stream mode, see feed()
+        self.on_message_begin = on_message_begin
+        self.on_headers_complete = on_headers_complete
+        self.on_body = on_body
+        self.on_message_complete = on_message_complete
+        self._state = 'first_line'
+        self._stream = ""
+        self._remaining = 0
+
+        self.reset()
+
+    def reset(self):
+        """ forget the current message, keeping the options """
         # errors vars
         self.errno = None
         self.errstr = ""
@@ -88,6 +198,13 @@ class HttpParser(object):
         self.__decompress_obj = None
         self.__decompress_first_try = True
 
+        # offset mode, see parse()
+        self._data = None
+        self.message_span = None
+        self.header_span = None
+        self.trailer_span = None
+        self.body_spans = None
+
     def get_version(self):
         return self._version
 
@@ -119,34 +236,13 @@ class HttpParser(object):
         if not self.__on_headers_complete:
             return None
 
-        environ = self._environ.copy()
-        # clean special keys
-        for key in ("CONTENT_LENGTH", "CONTENT_TYPE", "SCRIPT_NAME"):
-            hkey = "HTTP_%s" % key
-            if hkey in environ:
-                environ[key] = environ.pop(hkey)
-
-        script_name = environ.get('SCRIPT_NAME',
-                                  os.environ.get("SCRIPT_NAME", ""))
-        if script_name:
-            path_info = self._path.split(script_name, 1)[1]
-            environ.update({
-                "PATH_INFO": unquote(path_info),
-                "SCRIPT_NAME": script_name})
-        else:
-            environ['SCRIPT_NAME'] = ""
-
-        if environ.get('HTTP_X_FORWARDED_PROTOCOL', '').lower() == "ssl":
-            environ['wsgi.url_scheme'] = "https"
-        elif environ.get('HTTP_X_FORWARDED_SSL', '').lower() == "on":
-            environ['wsgi.url_scheme'] = "https"
-        else:
-            environ['wsgi.url_scheme'] = "http"
-
-        return environ
+        return wsgi_environ(self._environ.copy(), self._path)
 
     def get_body(self):
         """ return last chunk of the parsed body"""
+        if self._body is None:
+            # parsed in offset mode, chunks are joined once, on first use
+            self._body = join_body(self._data, self.body_spans, self._headers, self.decompress)
         return self._body
 
     def is_upgrade(self):
@@ -238,6 +334,245 @@ class HttpParser(object):
             else:
                 return self.nb_parsed
 
+    def parse(self, data, start=0, end=None, headers=True):
+        """
+            Parse one message from data[start:end] with integer cursors.
+            `data` only needs find() and slicing, e.g. str, bytearray or
+            mmap: nothing but the first line and headers is copied, the
+            body is kept as spans of `data` (see get_body). With
+            headers=False only the headers delimiting the body are read,
+            the others stay in header_span and trailer_span.
+            :returns: offset right after the message, or a negative error
+        """
+        if end is None:
+            end = len(data)
+        self._data = data
+        self._body = None
+        self.body_spans = []
+
+        idx = data.find("\r\n", start, end)
+        if idx < 0:
+            self.errno = BAD_FIRST_LINE
+            self.errstr = "Invalid HTTP request/status line"
+            return BAD_FIRST_LINE
+        self.__on_firstline = True
+        if not self._parse_firstline(str(data[start:idx])):
+            return BAD_FIRST_LINE
+        pos = idx + 2
+
+        if data[pos:pos + 2] == "\r\n":
+            # no header at all
+            idx = pos - 2
+        else:
+            idx = data.find("\r\n\r\n", pos, end)
+        if idx < 0:
+            self.errno = INVALID_HEADER
+            self.errstr = 'Headers not complete'
+            return INVALID_HEADER
+        self.header_span = (pos, max(pos, idx + 2))
+        if not headers:
+            self._scan_framing(str(data[pos:idx]))
+        else:
+            try:
+                self._parse_header_lines(str(data[pos:idx]))
+            except InvalidHeader as e:
+                self.errno = INVALID_HEADER
+                self.errstr = str(e)
+                return INVALID_HEADER
+            self._on_headers()
+        self.__on_headers_complete = True
+        self.__on_message_begin = True
+        pos = idx + 4
+
+        if not self._chunked:
+            body_end = pos + self._clen
+            if body_end > end:
+                body_end = end
+                self.errno = INVALID_BODY
+                self.errstr = "HTTP body incomplete"
+            if body_end > pos:
+                self.body_spans.append((pos, body_end))
+            pos = body_end
+        else:
+            while True:
+                idx = data.find("\r\n", pos, end)
+                if idx < 0:
+                    self.errno = INVALID_CHUNK
+                    self.errstr = "Invalid trunk size"
+                    return INVALID_CHUNK
+                try:
+                    size = int(str(data[pos:idx]).split(";", 1)[0].strip(), 16)
+                except ValueError as e:
+                    self.errno = INVALID_CHUNK
+                    self.errstr = "invalid chunk size [%s]" % str(e)
+                    return INVALID_CHUNK
+                pos = idx + 2
+                if size == 0:
+                    break
+                if pos + size + 2 > end:
+                    self.errno = INVALID_CHUNK
+                    self.errstr = "chunk missing terminator"
+                    return INVALID_CHUNK
+                self.body_spans.append((pos, pos + size))
+                pos += size + 2
+
+            # last chunk, then an empty line or trailing headers
+            if data[pos:pos + 2] == "\r\n":
+                pos += 2
+            else:
+                idx = data.find("\r\n\r\n", pos, end) if self._have_trailer else -1
+                if idx < 0:
+                    self.errno = INVALID_TRAILER
+                    self.errstr = "Invalid trailer"
+                    return INVALID_TRAILER
+                self.trailer_span = (pos, idx + 2)
+                try:
+                    if headers:
+                        self._parse_header_lines(str(data[pos:idx]))
+                except InvalidHeader:
+                    self.errno = INVALID_TRAILER
+                    self.errstr = "Invalid trailer"
+                    return INVALID_TRAILER
+                pos = idx + 4
+
+        self._have_body = bool(self.body_spans)
+        self.__on_message_complete = True
+        self.nb_parsed = pos - start
+        self.message_span = (start, pos)
+        return pos
+
+    def feed(self, data):
+        """
+            Feed the next fragment of a stream of messages, e.g. a TCP
+            segment. Callbacks fire as soon as their data is there:
+            on_message_begin(parser), on_headers_complete(parser),
+            on_body(parser, chunk) and on_message_complete(parser), after
+            which the parser is reset for the next message. Only a partial
+            line or header block is kept between fragments, body bytes are
+            handed to on_body and never accumulated.
+            :returns: number of messages completed, or a negative error
+        """
+        if self._state == 'error':
+            return self.errno
+        buf = self._stream + data if self._stream else data
+        pos = 0
+        completed = 0
+        while pos < len(buf):
+            state = self._state
+            if state == 'chunk_end':
+                if buf[pos:pos + 2] == "\r\n":
+                    pos += 2
+                    self._state = 'chunk_size'
+                elif buf[pos] != "\r" or len(buf) - pos > 1:
+                    return self._fail(INVALID_CHUNK, "chunk missing terminator")
+                else:
+                    break
+            elif state in ('first_line', 'chunk_size'):
+                idx = buf.find("\r\n", pos)
+                if idx < 0:
+                    break
+                line, pos = buf[pos:idx], idx + 2
+                if state == 'first_line':
+                    if not line:
+                        # stray CRLF between messages
+                        continue
+                    self.__on_firstline = True
+                    if not self._parse_firstline(line):
+                        return self._fail(BAD_FIRST_LINE, self.errstr)
+                    self.__on_message_begin = True
+                    self._callback(self.on_message_begin)
+                    self._state = 'headers'
+                else:
+                    try:
+                        size = int(line.split(";", 1)[0].strip(), 16)
+                    except ValueError as e:
+                        return self._fail(INVALID_CHUNK, "invalid chunk size [%s]" % str(e))
+                    self._remaining = size
+                    self._state = 'chunk_data' if size else 'trailer'
+            elif state in ('headers', 'trailer'):
+                if buf.startswith("\r\n", pos):
+                    idx = pos - 2
+                else:
+                    idx = buf.find("\r\n\r\n", pos)
+                    if idx < 0:
+                        break
+                try:
+                    self._parse_header_lines(buf[pos:idx])
+                except InvalidHeader as e:
+                    if state == 'trailer':
+                        return self._fail(INVALID_TRAILER, "Invalid trailer")
+                    return self._fail(INVALID_HEADER, str(e))
+                pos = idx + 4
+                if state == 'trailer':
+                    completed += self._complete()
+                    continue
+                self._on_headers()
+                self.__on_headers_complete = True
+                self._callback(self.on_headers_complete)
+                if self._chunked:
+                    self._state = 'chunk_size'
+                elif self._clen > 0:
+                    self._remaining = self._clen
+                    self._state = 'body'
+                else:
+                    completed += self._complete()
+            else:
+                size = min(self._remaining, len(buf) - pos)
+                self._on_body_part(buf[pos:pos + size])
+                pos += size
+                self._remaining -= size
+                if not self._remaining:
+                    if state == 'body':
+                        completed += self._complete()
+                    else:
+                        self._state = 'chunk_end'
+        self._stream = buf[pos:]
+        return completed
+
+    def close(self):
+        """
+            End of the stream.
+            :returns: 0, or the error of a message left incomplete
+        """
+        if self._state == 'error':
+            return self.errno
+        if self._state == 'first_line' and not self._stream.strip():
+            return 0
+        return self._fail(STREAM_ERRORS[self._state], "HTTP message incomplete")
+
+    def _fail(self, errno, errstr):
+        self.errno = errno
+        self.errstr = errstr
+        self._state = 'error'
+        return errno
+
+    def _callback(self, func, *args):
+        if func is not None:
+            func(self, *args)
+
+    def _on_body_part(self, part):
+        if self.__decompress_obj is not None:
+            try:
+                part = self.__decompress_obj.decompress(part)
+            except zlib.error:
+                if self.__decompress_first_try:
+                    # deflate sent without the zlib header
+                    self.__decompress_obj = zlib.decompressobj(-zlib.MAX_WBITS)
+                    part = self.__decompress_obj.decompress(part)
+                else:
+                    raise
+            self.__decompress_first_try = False
+        if part:
+            self._have_body = True
+            self._callback(self.on_body, part)
+
+    def _complete(self):
+        self.__on_message_complete = True
+        self._callback(self.on_message_complete)
+        self.reset()
+        self._state = 'first_line'
+        return 1
+
     def _parse_firstline(self, line):
         try:
             if self.kind == 2:  # auto detect
@@ -312,50 +647,31 @@ class HttpParser(object):
         if idx < 0:  # we don't have all headers
             raise InvalidHeader('Headers not complete')
 
-        # Split lines on \r\n keeping the \r\n on each line
-        lines = [line + "\r\n" for line in
-                 data[:idx].split("\r\n")]
-
-        # Parse headers into key/value pairs paying attention
-        # to continuation lines.
-        while len(lines):
-            # Parse initial header name : value pair.
-            curr = lines.pop(0)
-            if curr.find(":") < 0:
-                raise InvalidHeader("invalid line %s" % curr.strip())
-            name, value = curr.split(":", 1)
-            name = name.rstrip(" \t").upper()
-            if HEADER_RE.search(name):
-                raise InvalidHeader("invalid header name %s" % name)
-
-            if value.endswith("\r\n"):
-                value = value[:-2]
-
-            name, value = name.strip(), [value.lstrip()]
-
-            # Consume value continuation lines
-            while len(lines) and lines[0].startswith((" ", "\t")):
-                curr = lines.pop(0)
-                if curr.endswith("\r\n"):
-                    curr = curr[:-2]
-                value.append(curr)
-            value = ''.join(value).rstrip()
-
-            # multiple headers
-            if name in self._headers:
-                value = "%s, %s" % (self._headers[name], value)
-
-            # store new header value
-            self._headers[name] = value
-
-            # update WSGI environ
-            key = 'HTTP_%s' % name.upper().replace('-', '_')
-            self._environ[key] = value
+        self._parse_header_lines(data[:idx])
+        self._on_headers()
 
+        rest = data[idx + 4:]
+        self._buf = rest
+        return len(rest)
+
+    def _parse_header_lines(self, data):
+        parse_header_lines(data, self._headers, self._environ)
+
+    def _scan_framing(self, data):
+        # only the headers delimiting the body, the others are left in place
+        framing = {}
+        for name, value in FRAMING_RE.findall(data):
+            name = name.lower()
+            framing[name] = "%s, %s" % (framing[name], value) if name in framing else value
+        self._on_headers(framing)
+
+    def _on_headers(self, headers=None):
+        if headers is None:
+            headers = self._headers
         # detect now if body is sent by chunks.
-        clen = self._headers.get('content-length')
-        te = self._headers.get('transfer-encoding', '').lower()
-        if self._headers.get('Trailer'):
+        clen = headers.get('content-length')
+        te = headers.get('transfer-encoding', '').lower()
+        if headers.get('trailer'):
             self._have_trailer = True
 
         if clen is not None:
@@ -369,7 +685,7 @@ class HttpParser(object):
                 self._clen_rest = MAXSIZE
 
         # detect encoding and set decompress object
-        encoding = self._headers.get('content-encoding')
+        encoding = headers.get('content-encoding')
         if self.decompress:
             if encoding == "gzip":
                 self.__decompress_obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
@@ -377,10 +693,6 @@ class HttpParser(object):
             elif encoding == "deflate":
                 self.__decompress_obj = zlib.decompressobj()
 
-        rest = data[idx + 4:]
-        self._buf = rest
-        return len(rest)
-
     def _parse_body(self, data):
         if not self._chunked:
             complete = True
@@ -485,6 +797,218 @@ class HttpParser(object):
         return chunk_size, rest_chunk
 
 
+class HttpMessage(object):
+    """
+        One message split out of a stream, without its parser: the first
+        line as parsed, the headers and body as spans of the stream. The
+        headers, WSGI environ and (decompressed) body are built on first
+        access and cached.
+    """
+    __slots__ = ('method', 'url', 'path', 'version', 'status_code', 'reason', 'errno',
+                 'message_span', 'header_span', 'trailer_span', 'body_spans', 'decompress',
+                 '_data', '_headers', '_environ', '_body')
+
+    def __init__(self, parser):
+        self.method = parser.get_method()
+        self.url = parser.get_url()
+        self.path = parser.get_path()
+        self.version = parser.get_version()
+        self.status_code = parser.get_status_code()
+        self.reason = parser.get_reason()
+        self.errno = parser.errno
+        self.message_span = parser.message_span
+        self.header_span = parser.header_span
+        self.trailer_span = parser.trailer_span
+        self.body_spans = parser.body_spans
+        self.decompress = parser.decompress
+        self._data = parser._data
+        self._headers = None
+        self._environ = None
+        self._body = None
+
+    def get_method(self):
+        return self.method
+
+    def get_url(self):
+        return self.url
+
+    def get_version(self):
+        return self.version
+
+    def get_status_code(self):
+        return self.status_code
+
+    def get_reason(self):
+        return self.reason
+
+    def get_headers(self):
+        if self._headers is None:
+            self._headers = IOrderedDict()
+            for span in (self.header_span, self.trailer_span):
+                if span is None:
+                    continue
+                try:
+                    # spans include the CRLF of their last line
+                    parse_header_lines(str(self._data[span[0]:span[1] - 2]), self._headers)
+                except InvalidHeader:
+                    self.errno = INVALID_HEADER
+        return self._headers
+
+    def get_wsgi_environ(self):
+        if self._environ is None:
+            environ = dict(('HTTP_%s' % name.upper().replace('-', '_'), value)
+                           for name, value in self.get_headers().items())
+            self._environ = wsgi_environ(environ, self.path)
+        return self._environ
+
+    def get_body(self):
+        if self._body is None:
+            self._body = join_body(self._data, self.body_spans, self.get_headers(), self.decompress)
+        return self._body
+
+    def memory_size(self):
+        """ bytes held by this message, the stream it was split from excluded """
+        return deep_size(self, exclude=(self._data, ))
+
+
+def deep_size(obj, exclude=()):
+    """ approximate size in bytes of `obj` and everything it refers to """
+    seen = set(id(item) for item in exclude)
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for name in getattr(type(obj), '__slots__', ()):
+            if hasattr(obj, name):
+                stack.append(getattr(obj, name))
+    return size
+
+
+class HttpTransaction(object):
+    """
+        Compact record of one request and its response: the fields shown
+        in lists, the connection timings and where both messages lie in
+        `data`, (first line, end of headers) and (start of body, end).
+        Messages are parsed again from `data` when they are needed.
+    """
+    __slots__ = ('method', 'host', 'url', 'status', 'start', 'stop', 'data',
+                 'request_header', 'request_body', 'response_header', 'response_body')
+    # pickled fields, `data` is not, e.g. a map of the payload blob
+    _state = tuple(name for name in __slots__ if name != 'data')
+
+    def __init__(self, data, request, response, start=None, stop=None):
+        self.data = data
+        self.start = start
+        self.stop = stop
+        self.method = self.host = self.url = self.status = None
+        self.request_header = self.request_body = None
+        self.response_header = self.response_body = None
+        if request is not None:
+            self.method = request.get_method()
+            self.host = request.get_headers().get('Host', '')
+            self.url = request.get_url()
+            self.request_header, self.request_body = self._offsets(request)
+        if response is not None:
+            self.status = response.get_status_code()
+            self.response_header, self.response_body = self._offsets(response)
+
+    @staticmethod
+    def _offsets(message):
+        start, end = message.message_span
+        return (start, message.header_span[1]), (message.header_span[1] + 2, end)
+
+    def _message(self, header, body, kind, decompress):
+        if header is None:
+            return None
+        parser = HttpParser(kind, decompress)
+        parser.parse(self.data, header[0], body[1], headers=False)
+        return HttpMessage(parser)
+
+    def get_request(self, decompress=True):
+        return self._message(self.request_header, self.request_body, 0, decompress)
+
+    def get_response(self, decompress=True):
+        return self._message(self.response_header, self.response_body, 1, decompress)
+
+    def memory_size(self):
+        """ bytes held by this record, `data` excluded """
+        return deep_size(self, exclude=(self.data, ))
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self._state)
+
+    def __setstate__(self, state):
+        self.data = None
+        for name, value in zip(self._state, state):
+            setattr(self, name, value)
+
+
+def build_transactions(data, requests, responses, start=None, stop=None):
+    """
+        Pair pipelined requests and responses split from `data` in order,
+        into HttpTransaction records. `data` must hold both streams, e.g.
+        the payload blob.
+    """
+    return [HttpTransaction(data,
+                            requests[idx] if idx < len(requests) else None,
+                            responses[idx] if idx < len(responses) else None,
+                            start, stop)
+            for idx in xrange(max(len(requests), len(responses)))]
+
+
+def extract_transactions(data, spans, start=None, stop=None):
+    """
+        HttpTransaction lists of a connection whose directions are
+        data[begin:end] for (begin, end) in `spans`: one list for each
+        direction starting with a response, paired with the requests of
+        the other one. Directions not parsing as HTTP are skipped.
+    """
+    result = []
+    for idx, (begin, end) in enumerate(spans):
+        if data[begin:begin + 4] != 'HTTP':
+            continue
+        try:
+            requests = split_messages(data, spans[1 - idx][0], spans[1 - idx][1], decompress=True)
+            responses = split_messages(data, begin, end, decompress=True)
+        except RuntimeError:
+            continue
+        if requests and responses:
+            result.append(build_transactions(data, requests, responses, start, stop))
+    return result
+
+
+def split_messages(data, start=0, end=None, kind=2, decompress=False):
+    """
+        Split the keep-alive stream data[start:end] into HttpMessage records
+        in one pass, with one parser and no copy of the rest of the stream;
+        only the headers delimiting bodies are read while splitting. Stops
+        at the first message that does not parse.
+    """
+    if end is None:
+        end = len(data)
+    parser = HttpParser(kind, decompress)
+    messages = []
+    while start < end:
+        pos = parser.parse(data, start, end, headers=False)
+        if pos < 0:
+            break
+        messages.append(HttpMessage(parser))
+        parser.reset()
+        start = pos
+    return messages
+
+
 class TestHttpParser(unittest.TestCase):
     def test_normal_request(self):
         data = ('GET /anxun/pic/item/0824ab18972bd4073f3636e97c899e510fb30934.jpg HTTP/1.1\r\n'
@@ -603,6 +1127,163 @@ class TestHttpParser(unittest.TestCase):
         self.assertEqual(r.get_headers()['This'], 'is shit')
         self.assertEqual(r.get_body(), '0123456789012345')
 
+    def test_offset_mode(self):
+        import mmap
+        request = ('GET /a HTTP/1.1\r\n'
+                   'Host: example.com\r\n'
+                   'Content-Length: 4\r\n'
+                   '\r\n'
+                   'body')
+        response = ('HTTP/1.1 200 OK\r\n'
+                    'Transfer-Encoding: chunked\r\n'
+                    'Content-Encoding: gzip\r\n'
+                    '\r\n')
+        import gzip
+        import StringIO
+        out = StringIO.StringIO()
+        with gzip.GzipFile(fileobj=out, mode='w') as f:
+            f.write('0123456789' * 10)
+        payload = out.getvalue()
+        response += '%x\r\n%s\r\n%x\r\n%s\r\n0\r\n\r\n' % (
+            10, payload[:10], len(payload) - 10, payload[10:])
+        data = 'xx' + request + response
+        blob = mmap.mmap(-1, len(data))
+        blob.write(data)
+        for buf in (data, bytearray(data), blob):
+            r = HttpParser()
+            self.assertEqual(r.parse(buf, 2), 2 + len(request))
+            self.assertEqual(r.get_method(), 'GET')
+            self.assertEqual(r.get_headers()['Host'], 'example.com')
+            self.assertEqual(r.body_spans, [(len(data) - len(response) - 4, len(data) - len(response))])
+            self.assertEqual(r.get_body(), 'body')
+            r = HttpParser(decompress=True)
+            self.assertEqual(r.parse(buf, 2 + len(request)), len(data))
+            self.assertEqual(len(r.body_spans), 2)
+            self.assertEqual(r.get_body(), '0123456789' * 10)
+            # bounded by `end`
+            r = HttpParser()
+            self.assertEqual(r.parse(buf, 2 + len(request), len(data) - 3), INVALID_CHUNK)
+
+    def test_offset_mode_errors(self):
+        r = HttpParser()
+        self.assertEqual(r.parse('GET / HTTP/1.1\r\n\r\n'), 18)
+        self.assertEqual(r.get_body(), '')
+        self.assertEqual(HttpParser().parse('GET / HTTP/1.1\r\nHost: a\r\n'), INVALID_HEADER)
+        r = HttpParser()
+        data = 'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n012345678'
+        self.assertEqual(r.parse(data), len(data))
+        self.assertEqual(r.errno, INVALID_BODY)
+        self.assertEqual(r.get_body(), '012345678')
+
+    def test_stream(self):
+        events = []
+        r = HttpParser(on_message_begin=lambda p: events.append(('begin', p.get_method())),
+                       on_headers_complete=lambda p: events.append(('headers', p.get_headers().get('Host'))),
+                       on_body=lambda p, chunk: events.append(('body', chunk)),
+                       on_message_complete=lambda p: events.append(('complete', p.is_chunked())))
+        data = ('GET /a HTTP/1.1\r\nHost: a.com\r\n\r\n'
+                'POST /b HTTP/1.1\r\nHost: b.com\r\nContent-Length: 5\r\n\r\nhello'
+                'PUT /c HTTP/1.1\r\nTransfer-Encoding: chunked\r\n\r\n'
+                '3\r\nabc\r\n2\r\nde\r\n0\r\n\r\n')
+        expected = [('begin', 'GET'), ('headers', 'a.com'), ('complete', False),
+                    ('begin', 'POST'), ('headers', 'b.com'), ('complete', False),
+                    ('begin', 'PUT'), ('headers', None), ('complete', True)]
+        # fed at once, and byte by byte
+        self.assertEqual(r.feed(data), 3)
+        self.assertEqual(r.close(), 0)
+        self.assertEqual([event for event in events if event[0] != 'body'], expected)
+        self.assertEqual(''.join(event[1] for event in events if event[0] == 'body'), 'helloabcde')
+        del events[:]
+        self.assertEqual(sum(r.feed(char) for char in data), 3)
+        self.assertEqual([event for event in events if event[0] != 'body'], expected)
+        self.assertEqual(''.join(event[1] for event in events if event[0] == 'body'), 'helloabcde')
+        # body passed through as it arrives, not buffered
+        del events[:]
+        self.assertEqual(r.feed('HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n01234'), 0)
+        self.assertEqual(events[-1], ('body', '01234'))
+        self.assertEqual(r.close(), INVALID_BODY)
+        self.assertEqual(r.feed('56789'), INVALID_BODY)
+
+    def test_split_messages(self):
+        request = 'GET /%d HTTP/1.1\r\nHost: a.com\r\nContent-Length: 1\r\n\r\n%d'
+        data = ''.join(request % (idx, idx) for idx in range(10))
+        messages = split_messages(data)
+        self.assertEqual([m.get_url() for m in messages], ['/%d' % idx for idx in range(10)])
+        self.assertEqual([m.get_body() for m in messages], [str(idx) for idx in range(10)])
+        self.assertEqual(messages[3].get_headers()['Host'], 'a.com')
+        # bounded, and stops at garbage
+        self.assertEqual(len(split_messages(data, len(request % (0, 0)), 3 * len(request % (0, 0)))), 2)
+        self.assertEqual(len(split_messages(data[:2 * len(request % (0, 0))] + 'garbage\r\n' + data)), 2)
+        self.assertEqual(split_messages(''), [])
+
+    def test_lazy_message(self):
+        data = ('POST /a?b=1 HTTP/1.1\r\n'
+                'Host: a.com\r\n'
+                'Content-Type: text/plain\r\n'
+                'transfer-encoding :  chunked \r\n'
+                'Trailer: Expires\r\n'
+                '\r\n'
+                '3\r\nabc\r\n0\r\n'
+                'Expires: never\r\n'
+                '\r\n')
+        message, = split_messages(data)
+        self.assertEqual(message._headers, None)
+        size = message.memory_size()
+        self.assertEqual(message.get_body(), 'abc')
+        self.assertEqual(message.get_headers()['Host'], 'a.com')
+        self.assertEqual(message.get_headers()['Expires'], 'never')
+        self.assertTrue(message.get_headers() is message.get_headers())
+        environ = message.get_wsgi_environ()
+        self.assertEqual((environ['CONTENT_TYPE'], environ['HTTP_HOST']), ('text/plain', 'a.com'))
+        self.assertTrue(message.memory_size() > size)
+        self.assertTrue(deep_size(message) >= message.memory_size() + len(data))
+
+    def test_transactions(self):
+        requests = 'GET /a HTTP/1.1\r\nHost: a.com\r\n\r\nPOST /b HTTP/1.1\r\nContent-Length: 2\r\n\r\nhi'
+        responses = ('HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nabc'
+                     'HTTP/1.1 404 Not Found\r\nTransfer-Encoding: chunked\r\n\r\n1\r\nx\r\n0\r\n\r\n')
+        data = requests + responses
+        transactions = build_transactions(data, split_messages(data, 0, len(requests)),
+                                          split_messages(data, len(requests)), 1.0, 2.5)
+        self.assertEqual([(t.method, t.host, t.url, t.status) for t in transactions],
+                         [('GET', 'a.com', '/a', 200), ('POST', '', '/b', 404)])
+        self.assertEqual(transactions[0].request_header, (0, 30))
+        self.assertEqual(transactions[1].response_body, (len(data) - 11, len(data)))
+        self.assertEqual(transactions[1].get_request().get_body(), 'hi')
+        self.assertEqual(transactions[1].get_response().get_body(), 'x')
+        self.assertEqual(transactions[0].get_response().get_headers()['Content-Length'], '3')
+        self.assertFalse(hasattr(transactions[0], '__dict__'))
+        self.assertTrue(transactions[0].memory_size() < deep_size(split_messages(data)[0]))
+        # unanswered request
+        transaction, = build_transactions(requests, split_messages(requests)[:1], [])
+        self.assertEqual((transaction.status, transaction.get_response()), (None, None))
+
+    def test_extract_transactions(self):
+        requests = 'GET /a HTTP/1.1\r\nHost: a.com\r\n\r\nGET /b HTTP/1.1\r\n\r\n'
+        responses = 'HTTP/1.1 200 OK\r\nContent-Length: 3\r\n\r\nabc'
+        data = 'xx' + responses + requests
+        spans = [(2, 2 + len(responses)), (2 + len(responses), len(data))]
+        transactions, = extract_transactions(data, spans, 1.0, 2.0)
+        self.assertEqual([(t.url, t.status, t.start) for t in transactions], [('/a', 200, 1.0), ('/b', None, 1.0)])
+        self.assertEqual([t.url for t in extract_transactions(data, spans[::-1])[0]], ['/a', '/b'])
+        self.assertEqual(extract_transactions(data, [(2, 2 + len(responses)), (0, 0)]), [])
+        self.assertEqual(extract_transactions(requests, [(0, len(requests)), (0, 0)]), [])
+        # sent back from worker processes without the data
+        transaction = pickle.loads(pickle.dumps(transactions[0], pickle.HIGHEST_PROTOCOL))
+        self.assertEqual((transaction.data, transaction.host, transaction.response_body),
+                         (None, 'a.com', transactions[0].response_body))
+        transaction.data = data
+        self.assertEqual(transaction.get_response().get_body(), 'abc')
+
+    def test_stream_errors(self):
+        self.assertEqual(HttpParser().feed('GET\r\n'), BAD_FIRST_LINE)
+        self.assertEqual(HttpParser().feed('GET / HTTP/1.1\r\nbad\r\n\r\n'), INVALID_HEADER)
+        r = HttpParser()
+        self.assertEqual(r.feed('HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n2\r\nabc'), INVALID_CHUNK)
+        r = HttpParser()
+        self.assertEqual(r.feed('GET / HTTP/1.1\r\nHost: a'), 0)
+        self.assertEqual(r.close(), INVALID_HEADER)
+
 
 if __name__ == '__main__':
     unittest.main()
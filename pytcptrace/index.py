@@ -0,0 +1,112 @@
+import unittest
+import numpy as np
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class HashIndex:
+    """ value -> sorted row indices, for equality lookups """
+    def __init__(self, column):
+        order = np.argsort(column, kind='mergesort')
+        values, starts = np.unique(column[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self.rows = dict((val, order[start:end]) for val, start, end in zip(values.tolist(), starts, ends))
+
+    def lookup(self, operator, value):
+        if operator != '==':
+            return None
+        return self.rows.get(value, np.zeros(0, dtype=np.int64))
+
+
+class SortedIndex:
+    """ row indices ordered by value, for equality and range lookups """
+    def __init__(self, column):
+        self.order = np.argsort(column, kind='mergesort')
+        self.values = column[self.order]
+
+    def lookup(self, operator, value):
+        """ row indices (in value order) where `column <operator> value` holds, None if unsupported """
+        if operator == '==':
+            start = np.searchsorted(self.values, value, 'left')
+            end = np.searchsorted(self.values, value, 'right')
+        elif operator in ('>', '>='):
+            start = np.searchsorted(self.values, value, 'right' if operator == '>' else 'left')
+            end = len(self.values)
+        elif operator in ('<', '<='):
+            start = 0
+            end = np.searchsorted(self.values, value, 'left' if operator == '<' else 'right')
+        else:
+            return None
+        return self.order[start:end]
+
+
+class TableIndexes:
+    """
+        Secondary indexes over the columns of a ConnectionTable, each one
+        built on first use: hash indexes on endpoints and HTTP features,
+        sorted ones on times, packet and byte counts.
+    """
+    HASH_COLUMNS = ('host_a', 'host_b', 'port_a', 'port_b', 'http.method', 'http.host', 'http.status')
+    SORTED_COLUMNS = ('first_packet_time', 'last_packet_time', 'total_packets',
+                      'a2b.unique_bytes_sent', 'b2a.unique_bytes_sent')
+
+    def __init__(self, table):
+        self.table = table
+        self._indexes = {}
+
+    def get(self, name):
+        """ index of column `name`, None if it is not indexed """
+        if name not in self._indexes:
+            if not self.table.has_column(name):
+                return None
+            elif name in self.HASH_COLUMNS:
+                self._indexes[name] = HashIndex(self.table.column(name))
+            elif name in self.SORTED_COLUMNS:
+                self._indexes[name] = SortedIndex(self.table.column(name))
+            else:
+                return None
+        return self._indexes[name]
+
+    def lookup(self, name, operator, value):
+        index = self.get(name)
+        if index is None:
+            return None
+        if isinstance(index, SortedIndex) and (isinstance(value, bool) or
+                                               not isinstance(value, (int, long, float))):
+            # only numbers compare like the sorted values
+            return None
+        return index.lookup(operator, value)
+
+    def clear(self):
+        self._indexes.clear()
+
+
+class TestTableIndexes(unittest.TestCase):
+    def setUp(self):
+        from table import ConnectionTable
+        self.table = ConnectionTable({
+            'host_a': np.array([u'10.0.0.2', u'10.0.0.1', u'10.0.0.2', u'10.0.0.3']),
+            'port_a': np.array([80, 443, 80, 22]),
+            'first_packet_time': np.array([3.0, 1.0, 2.0, 2.0]),
+        }, {}, 4)
+        self.indexes = TableIndexes(self.table)
+
+    def test_hash(self):
+        self.assertEqual(list(self.indexes.lookup('host_a', '==', '10.0.0.2')), [0, 2])
+        self.assertEqual(list(self.indexes.lookup('port_a', '==', 22)), [3])
+        self.assertEqual(list(self.indexes.lookup('port_a', '==', 8080)), [])
+        self.assertEqual(self.indexes.lookup('port_a', '>', 22), None)
+
+    def test_sorted(self):
+        lookup = lambda op, value: sorted(self.indexes.lookup('first_packet_time', op, value))
+        self.assertEqual(lookup('==', 2.0), [2, 3])
+        self.assertEqual(lookup('>', 2.0), [0])
+        self.assertEqual(lookup('>=', 2.0), [0, 2, 3])
+        self.assertEqual(lookup('<', 2.0), [1])
+        self.assertEqual(lookup('<=', 2), [1, 2, 3])
+        self.assertEqual(self.indexes.lookup('first_packet_time', '<', '10.0.0.1'), None)
+        self.assertEqual(self.indexes.lookup('elapsed_time', '<', 1), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import tkFont
+import unittest
+import numpy as np
+
+__author__ = 'huangyan13@baidu.com'
+
+
+class TextMetrics:
+    """
+        Text widths for one font: exact measures are remembered, and
+        ASCII strings are summed from the character widths, measured once,
+        over whole lists at a time, which is close enough to size columns.
+    """
+    # exact measures remembered before the memo starts over
+    MEMO_SIZE = 65536
+
+    def __init__(self, font):
+        self.font = font
+        self._memo = {}
+        self._chars = None
+
+    def measure(self, text):
+        """ exact width of `text`, one Tcl call the first time only """
+        width = self._memo.get(text)
+        if width is None:
+            if len(self._memo) >= self.MEMO_SIZE:
+                self._memo.clear()
+            width = self._memo[text] = self.font.measure(text)
+        return width
+
+    def char_widths(self):
+        """ width of every ASCII character, control characters count for nothing """
+        if self._chars is None:
+            self._chars = np.array([self.font.measure(chr(char)) if 32 <= char < 127 else 0
+                                    for char in xrange(128)], dtype=np.int64)
+        return self._chars
+
+    def widths(self, texts):
+        """ widths of `texts` (strings or values), non-ASCII ones measured exactly """
+        strings = [text if isinstance(text, basestring) else str(text) for text in texts]
+        if not strings:
+            return np.zeros(0, dtype=np.int64)
+        data = np.array([text.encode('utf-8') if isinstance(text, unicode) else text
+                         for text in strings], dtype=np.string_)
+        chars = np.frombuffer(data.tostring(), dtype=np.uint8).reshape(len(data), data.dtype.itemsize)
+        # padding bytes are NUL, which has no width
+        widths = self.char_widths()[chars & 0x7f].sum(axis=1)
+        for row in np.nonzero((chars >= 128).any(axis=1))[0]:
+            widths[row] = self.measure(strings[row])
+        return widths
+
+    def max_width(self, texts):
+        widths = self.widths(texts)
+        return int(widths.max()) if len(widths) else 0
+
+
+# one TextMetrics, and one font object, per font description
+_shared = {}
+
+
+def get_metrics(font=None):
+    """ TextMetrics shared by all widgets for `font`, None for the default font """
+    if font not in _shared:
+        _shared[font] = TextMetrics(tkFont.Font(font=font) if font else tkFont.Font())
+    return _shared[font]
+
+
+class TestTextMetrics(unittest.TestCase):
+    class Font:
+        """ 6 pixels per character, 10 for non-ASCII ones """
+        def __init__(self):
+            self.calls = 0
+
+        def measure(self, text):
+            self.calls += 1
+            if isinstance(text, str):
+                text = text.decode('utf-8')
+            return sum(6 if ord(char) < 128 else 10 for char in text)
+
+    def test_widths(self):
+        font = self.Font()
+        metrics = TextMetrics(font)
+        self.assertEqual(list(metrics.widths(['abc', '', 12.5, True, u'\u4e2d\u6587a'])), [18, 0, 24, 24, 26])
+        calls = font.calls
+        self.assertEqual(metrics.max_width(['a' * 100, 'b']), 600)
+        self.assertEqual(metrics.max_width([]), 0)
+        # character widths are measured once, non-ASCII strings once each
+        self.assertEqual(list(metrics.widths([u'\u4e2d\u6587a', 'xyz'])), [26, 18])
+        self.assertEqual(font.calls, calls)
+
+    def test_measure(self):
+        font = self.Font()
+        metrics = TextMetrics(font)
+        self.assertEqual(metrics.measure('Start Time'), 60)
+        self.assertEqual(metrics.measure('Start Time'), 60)
+        self.assertEqual(font.calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,520 @@
+import os
+import json
+import mmap
+import time
+import base64
+import socket
+import struct
+import unittest
+import numpy as np
+from pcap import (PCAP_MAGIC, PCAP_HEADER_LEN, RECORD_HEADER_LEN, PcapFormatError,
+                  LINKTYPE_NULL, LINKTYPE_ETHERNET, LINKTYPE_RAW, LINKTYPE_LOOP,
+                  LINKTYPE_LINUX_SLL, LINKTYPE_IPV4, LINKTYPE_IPV6,
+                  ETHERTYPE_IP, ETHERTYPE_IPV6, ETHERTYPE_VLAN, IPPROTO_TCP)
+
+__author__ = 'huangyan13@baidu.com'
+
+
+PCAPNG_SHB = 0x0a0d0d0a
+PCAPNG_IDB = 0x00000001
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_BYTE_ORDER = 0x1a2b3c4d
+
+TH_FIN = 0x01
+TH_SYN = 0x02
+
+
+def index_pcap(buf, start=PCAP_HEADER_LEN, max_records=None):
+    """
+        Walk the records of a classic pcap file, from the one at `start` and
+        at most `max_records` of them. Every record starts where the previous
+        one ends, so the walk is a Python loop reading one length per record,
+        only the other fields are gathered with NumPy.
+        :returns: (timestamps, data offsets, captured lengths, link types)
+    """
+    magic = struct.unpack_from('<I', buf, 0)[0]
+    order, resolution = PCAP_MAGIC[magic]
+    linktype = struct.unpack_from(order + 'I', buf, 20)[0] & 0x0fffffff
+    caplen_fmt = struct.Struct(order + 'I')
+    size = len(buf)
+    offsets = []
+    pos = start
+    while pos + RECORD_HEADER_LEN <= size and (max_records is None or len(offsets) < max_records):
+        caplen = caplen_fmt.unpack_from(buf, pos + 8)[0]
+        if pos + RECORD_HEADER_LEN + caplen > size:
+            break
+        offsets.append(pos)
+        pos += RECORD_HEADER_LEN + caplen
+
+    data = np.frombuffer(buf, dtype=np.uint8)
+    headers = np.array(offsets, dtype=np.int64)
+    sec = _gather_uint(data, headers, 4, order)
+    frac = _gather_uint(data, headers + 4, 4, order)
+    caplens = _gather_uint(data, headers + 8, 4, order).astype(np.int64)
+    timestamps = sec + frac * resolution
+    linktypes = np.empty(len(headers), dtype=np.int64)
+    linktypes.fill(linktype)
+    return timestamps, headers + RECORD_HEADER_LEN, caplens, linktypes
+
+
+def index_pcapng(buf):
+    """ same as index_pcap for a pcapng file (enhanced and simple packet blocks), one loop over all blocks """
+    size = len(buf)
+    pos = 0
+    order = '<'
+    interfaces = []
+    timestamps = []
+    offsets = []
+    caplens = []
+    linktypes = []
+    while pos + 12 <= size:
+        block_type = struct.unpack_from(order + 'I', buf, pos)[0]
+        if block_type == PCAPNG_SHB:
+            # every section may change the byte order
+            order = '<' if struct.unpack_from('<I', buf, pos + 8)[0] == PCAPNG_BYTE_ORDER else '>'
+            interfaces = []
+        block_len = struct.unpack_from(order + 'I', buf, pos + 4)[0]
+        if block_len < 12 or pos + block_len > size:
+            break
+        if block_type == PCAPNG_IDB:
+            linktype = struct.unpack_from(order + 'H', buf, pos + 8)[0]
+            interfaces.append((linktype, _pcapng_resolution(buf, pos + 16, pos + block_len - 4, order)))
+        elif block_type == PCAPNG_EPB:
+            iface, ts_high, ts_low, caplen = struct.unpack_from(order + 'IIII', buf, pos + 8)
+            linktype, resolution = interfaces[iface]
+            timestamps.append(((ts_high << 32) | ts_low) * resolution)
+            offsets.append(pos + 28)
+            caplens.append(caplen)
+            linktypes.append(linktype)
+        elif block_type == PCAPNG_SPB and interfaces:
+            origlen = struct.unpack_from(order + 'I', buf, pos + 8)[0]
+            timestamps.append(0.)
+            offsets.append(pos + 12)
+            caplens.append(min(origlen, block_len - 16))
+            linktypes.append(interfaces[0][0])
+        pos += block_len
+    return (np.array(timestamps, dtype=np.float64), np.array(offsets, dtype=np.int64),
+            np.array(caplens, dtype=np.int64), np.array(linktypes, dtype=np.int64))
+
+
+def _pcapng_resolution(buf, pos, end, order):
+    # look for the if_tsresol option, microseconds by default
+    while pos + 4 <= end:
+        code, length = struct.unpack_from(order + 'HH', buf, pos)
+        if code == 0:
+            break
+        if code == 9 and length >= 1:
+            value = ord(buf[pos + 4])
+            return 2. ** -(value & 0x7f) if value & 0x80 else 10. ** -value
+        pos += 4 + (length + 3) / 4 * 4
+    return 1e-6
+
+
+def index_capture(buf):
+    if len(buf) < PCAP_HEADER_LEN:
+        raise PcapFormatError('file too short for a capture')
+    magic = struct.unpack_from('<I', buf, 0)[0]
+    if magic in PCAP_MAGIC:
+        return index_pcap(buf)
+    elif magic == PCAPNG_SHB:
+        return index_pcapng(buf)
+    raise PcapFormatError('neither a pcap nor a pcapng file')
+
+
+def _gather_uint(data, pos, width, order='>'):
+    """ unsigned integers of `width` bytes starting at every offset in `pos` """
+    value = np.zeros(len(pos), dtype=np.uint64)
+    byte_range = range(width) if order == '>' else range(width - 1, -1, -1)
+    for idx in byte_range:
+        value = (value << np.uint64(8)) | data[pos + idx]
+    return value.astype(np.int64)
+
+
+def _gather_bytes(data, pos, width):
+    return data[pos[:, None] + np.arange(width)]
+
+
+def decode_tcp(buf, timestamps, offsets, caplens, linktypes):
+    """
+        Decode the link, IP and TCP headers of all packets at once.
+        :returns: dict of arrays describing the TCP packets only, 'record'
+            being their index in the arrays given
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    num = len(offsets)
+    l3_off = np.empty(num, dtype=np.int64)
+    l3_off.fill(-1)
+    version = np.zeros(num, dtype=np.int64)
+
+    # link layer
+    sel = np.nonzero((linktypes == LINKTYPE_ETHERNET) & (caplens >= 14))[0]
+    ethertype = _gather_uint(data, offsets[sel] + 12, 2)
+    l3_off[sel] = 14
+    vlan = np.nonzero(np.in1d(ethertype, ETHERTYPE_VLAN) & (caplens[sel] >= 18))[0]
+    ethertype[vlan] = _gather_uint(data, offsets[sel[vlan]] + 16, 2)
+    l3_off[sel[vlan]] = 18
+    version[sel] = np.where(ethertype == ETHERTYPE_IP, 4, np.where(ethertype == ETHERTYPE_IPV6, 6, 0))
+
+    sel = np.nonzero((linktypes == LINKTYPE_LINUX_SLL) & (caplens >= 16))[0]
+    ethertype = _gather_uint(data, offsets[sel] + 14, 2)
+    l3_off[sel] = 16
+    version[sel] = np.where(ethertype == ETHERTYPE_IP, 4, np.where(ethertype == ETHERTYPE_IPV6, 6, 0))
+
+    for linktypes_set, header_len in (((LINKTYPE_NULL, LINKTYPE_LOOP), 4),
+                                      ((LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6), 0)):
+        sel = np.nonzero(np.in1d(linktypes, linktypes_set) & (caplens > header_len))[0]
+        l3_off[sel] = header_len
+        version[sel] = data[offsets[sel] + header_len] >> 4
+
+    # network layer
+    l3 = offsets + l3_off
+    l4 = np.zeros(num, dtype=np.int64)
+    ip_payload = np.zeros(num, dtype=np.int64)
+    src = np.zeros((num, 16), dtype=np.uint8)
+    dst = np.zeros((num, 16), dtype=np.uint8)
+    is_tcp = np.zeros(num, dtype=bool)
+
+    sel = np.nonzero((version == 4) & (caplens >= l3_off + 20))[0]
+    sel = sel[data[l3[sel] + 9] == IPPROTO_TCP]
+    ihl = (data[l3[sel]] & 0x0f).astype(np.int64) * 4
+    l4[sel] = l3[sel] + ihl
+    ip_payload[sel] = _gather_uint(data, l3[sel] + 2, 2) - ihl
+    src[sel, :4] = _gather_bytes(data, l3[sel] + 12, 4)
+    dst[sel, :4] = _gather_bytes(data, l3[sel] + 16, 4)
+    is_tcp[sel] = True
+
+    sel = np.nonzero((version == 6) & (caplens >= l3_off + 40))[0]
+    sel = sel[data[l3[sel] + 6] == IPPROTO_TCP]
+    l4[sel] = l3[sel] + 40
+    ip_payload[sel] = _gather_uint(data, l3[sel] + 4, 2)
+    src[sel] = _gather_bytes(data, l3[sel] + 8, 16)
+    dst[sel] = _gather_bytes(data, l3[sel] + 24, 16)
+    is_tcp[sel] = True
+
+    # transport layer
+    sel = np.nonzero(is_tcp & (offsets + caplens >= l4 + 20))[0]
+    l4 = l4[sel]
+    header_len = (data[l4 + 12] >> 4).astype(np.int64) * 4
+    payload_off = l4 + header_len
+    payload_len = np.minimum(ip_payload[sel] - header_len, offsets[sel] + caplens[sel] - payload_off)
+    return {
+        'record': sel,
+        'time': timestamps[sel],
+        'version': version[sel],
+        'src': src[sel],
+        'dst': dst[sel],
+        'sport': _gather_uint(data, l4, 2),
+        'dport': _gather_uint(data, l4 + 2, 2),
+        'seq': _gather_uint(data, l4 + 4, 4),
+        'flags': data[l4 + 13].astype(np.int64),
+        'payload_off': payload_off,
+        'payload_len': np.maximum(payload_len, 0),
+    }
+
+
+def _format_host(version, addr):
+    if version == 4:
+        return socket.inet_ntoa(addr[:4].tostring())
+    return socket.inet_ntop(socket.AF_INET6, addr.tostring())
+
+
+def _reassemble(buf, seq, payload_off, payload_len):
+    """
+        Rebuild the byte stream of one half-connection from its segments,
+        dropping retransmitted bytes.
+        :returns: the stream data
+    """
+    # sequence numbers relative to the first segment, allowing wrap around
+    rel = (seq - seq[0]) % (1 << 32)
+    rel = np.where(rel >= 1 << 31, rel - (1 << 32), rel)
+    order = np.argsort(rel, kind='mergesort')
+    chunks = []
+    next_seq = rel[order[0]]
+    for idx in order:
+        start, length = rel[idx], payload_len[idx]
+        if start + length <= next_seq:
+            continue
+        skip = max(0, next_seq - start)
+        chunks.append(buf[payload_off[idx] + skip:payload_off[idx] + length])
+        next_seq = start + length
+    return b''.join(chunks)
+
+
+def _half_connection(buf, packets, idx):
+    times = packets['time'][idx]
+    flags = packets['flags'][idx]
+    payload_len = packets['payload_len'][idx]
+    has_data = np.nonzero(payload_len > 0)[0]
+    sub_conn = {
+        'packets_sent': [len(idx)],
+        'FIN_pkts_sent': [int(np.count_nonzero(flags & TH_FIN))],
+        'SYN_pkts_sent': [int(np.count_nonzero(flags & TH_SYN))],
+        'time': times.tolist(),
+        'points_time': times[has_data].tolist(),
+        'points_data': payload_len[has_data].tolist(),
+    }
+    if len(has_data):
+        data_idx = idx[has_data]
+        stream = _reassemble(buf, packets['seq'][data_idx],
+                             packets['payload_off'][data_idx], packets['payload_len'][data_idx])
+        first, last = float(times[has_data].min()), float(times[has_data].max())
+        sub_conn['unique_bytes_sent'] = [len(stream)]
+        sub_conn['base64_data'] = base64.b64encode(stream)
+    else:
+        first = last = 0.
+        sub_conn['unique_bytes_sent'] = [0]
+    sub_conn['first_data_time'] = [first]
+    sub_conn['last_data_time'] = [last]
+    sub_conn['data_trans_time'] = [last - first]
+    return sub_conn
+
+
+def build_connections(buf, packets):
+    """
+        Group decoded TCP packets by connection and produce records with the
+        schema of tcptrace JSON output, ordered by first packet. A 4-tuple
+        reused for a later connection is reported as a single connection.
+    """
+    num = len(packets['time'])
+    if not num:
+        return
+    # one key per direction: version, source endpoint, destination endpoint
+    keys = np.zeros((num, 37), dtype=np.uint8)
+    keys[:, 0] = packets['version']
+    keys[:, 1:17] = packets['src']
+    keys[:, 17] = packets['sport'] >> 8
+    keys[:, 18] = packets['sport'] & 0xff
+    keys[:, 19:35] = packets['dst']
+    keys[:, 35] = packets['dport'] >> 8
+    keys[:, 36] = packets['dport'] & 0xff
+    keys = np.ascontiguousarray(keys).view('V37').ravel()
+    uniq, first_idx, inverse = np.unique(keys, return_index=True, return_inverse=True)
+
+    # packets of each direction, in capture order
+    order = np.argsort(inverse, kind='mergesort')
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(inverse, minlength=len(uniq)))))
+    lookup = dict((key.tostring(), idx) for idx, key in enumerate(uniq))
+
+    done = set()
+    for direct in np.argsort(first_idx, kind='mergesort'):
+        if direct in done:
+            continue
+        raw = uniq[direct].tostring()
+        reverse = lookup.get(raw[0] + raw[19:37] + raw[1:19])
+        done.add(direct)
+        done.add(reverse)
+        a2b = order[bounds[direct]:bounds[direct + 1]]
+        b2a = order[bounds[reverse]:bounds[reverse + 1]] if reverse is not None else order[0:0]
+        first = first_idx[direct]
+        times = packets['time'][np.concatenate((a2b, b2a))]
+        conn = {
+            'host_a': _format_host(packets['version'][first], packets['src'][first]),
+            'port_a': int(packets['sport'][first]),
+            'host_b': _format_host(packets['version'][first], packets['dst'][first]),
+            'port_b': int(packets['dport'][first]),
+            'total_packets': len(a2b) + len(b2a),
+            'first_packet_time': float(times.min()),
+            'last_packet_time': float(times.max()),
+            'a2b': _half_connection(buf, packets, a2b),
+            'b2a': _half_connection(buf, packets, b2a),
+        }
+        conn['elapsed_time'] = conn['last_packet_time'] - conn['first_packet_time']
+        # tcptrace calls a connection complete when SYN and FIN were seen both ways
+        conn['complete'] = all(conn[key]['SYN_pkts_sent'][0] and conn[key]['FIN_pkts_sent'][0]
+                               for key in ('a2b', 'b2a'))
+        yield conn
+
+
+class NativeAnalysis:
+    """
+        Analyze a capture without the tcptrace binary, iterating over it
+        yields the connection records, like TcpTraceProcess does.
+    """
+    def __init__(self, pcap_file, timeout=None, progress=None):
+        self.pcap_file = pcap_file
+        self.timeout = timeout
+        self.progress = progress
+        self.num_connections = 0
+        self._cancelled = False
+        self._summary = ''
+
+    def __iter__(self):
+        deadline = time.time() + self.timeout if self.timeout else None
+        with open(self.pcap_file, 'rb') as fid:
+            if not os.fstat(fid.fileno()).st_size:
+                raise RuntimeError('empty capture file')
+            buf = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            try:
+                index = index_capture(buf)
+            except (PcapFormatError, struct.error, KeyError, IndexError) as e:
+                raise RuntimeError('unable to read %s: %s' % (self.pcap_file, e))
+            packets = decode_tcp(buf, *index)
+            for conn in build_connections(buf, packets):
+                if self._cancelled:
+                    break
+                if deadline and time.time() > deadline:
+                    # imported late, pytcptrace imports this module
+                    from pytcptrace import TcpTraceTimeout
+                    raise TcpTraceTimeout('analysis did not finish in %s seconds' % self.timeout)
+                self.num_connections += 1
+                if self.progress:
+                    # connections come by first packet, not by position in the capture
+                    self.progress(self.num_connections, None)
+                yield conn
+            self._summary = '%d packets seen, %d TCP packets traced\n%d TCP connections traced\n' % (
+                len(index[0]), len(packets['time']), self.num_connections)
+        finally:
+            buf.close()
+        if self._cancelled:
+            from pytcptrace import TcpTraceCancelled
+            raise TcpTraceCancelled('analysis cancelled')
+
+    def cancel(self):
+        self._cancelled = True
+
+    def get_stdout(self):
+        return self._summary
+
+    def get_stderr(self):
+        return ''
+
+
+class NativeBackend:
+    """
+        Reads pcap and pcapng files instead of running tcptrace: records are
+        walked one by one, headers decoded for all packets at once with NumPy,
+        streams reassembled per connection.
+
+        Its records only carry host_*, port_*, complete, total_packets,
+        *_packet_time, elapsed_time and, per direction, packets_sent,
+        unique_bytes_sent, SYN_pkts_sent, FIN_pkts_sent, *_data_time,
+        data_trans_time, time, points_time, points_data and base64_data.
+        Compared with tcptrace -J:
+        - the ack, retransmission, window, segment size, RTT and throughput
+          fields are missing, so are filters and merges using them
+        - a reused 4-tuple stays one connection, tcptrace starts a new one
+        - data behind a sequence gap is appended to the stream, where
+          tcptrace reports it as missed_data
+    """
+    name = 'native'
+    VERSION = 1
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def cache_key(self):
+        return [self.name, self.VERSION]
+
+    def spawn(self, pcap_file, progress=None):
+        return NativeAnalysis(pcap_file, timeout=self.timeout, progress=progress)
+
+
+class TestNativeBackend(unittest.TestCase):
+    # regression fixture: native output for the session below, checked by hand
+    # against the packets, not produced by tcptrace
+    FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'native_http_session.json')
+    CLIENT = ('10.0.0.1', 51000)
+    SERVER = ('10.0.0.2', 80)
+
+    @classmethod
+    def packets(cls):
+        """ (time, frame) of a short HTTP session with a retransmission """
+        request = 'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n'
+        response = 'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello'
+        c, s = cls.CLIENT, cls.SERVER
+        return [
+            (1000000000.0, cls.frame(c, s, 100, TH_SYN)),
+            (1000000000.1, cls.frame(s, c, 500, TH_SYN | 0x10)),
+            (1000000000.2, cls.frame(c, s, 101, 0x10)),
+            (1000000000.3, cls.frame(c, s, 101, 0x18, request[:16])),
+            (1000000000.4, cls.frame(c, s, 117, 0x18, request[16:])),
+            # retransmission of the first request segment
+            (1000000000.5, cls.frame(c, s, 101, 0x18, request[:16])),
+            (1000000000.6, cls.frame(s, c, 501, 0x18, response)),
+            (1000000000.7, cls.frame(c, s, 101 + len(request), TH_FIN | 0x10)),
+            (1000000000.8, cls.frame(s, c, 501 + len(response), TH_FIN | 0x10)),
+        ]
+
+    @staticmethod
+    def frame(src, dst, seq, flags, payload=''):
+        tcp = struct.pack('!HHIIBBHHH', src[1], dst[1], seq, 0, 5 << 4, flags, 65535, 0, 0) + payload
+        ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(tcp), 0, 0, 64, IPPROTO_TCP, 0,
+                         socket.inet_aton(src[0]), socket.inet_aton(dst[0]))
+        # ethernet frames shorter than 60 bytes are padded
+        return ('\x00' * 12 + '\x08\x00' + ip + tcp).ljust(60, '\x00')
+
+    def write_pcap(self, path):
+        with open(path, 'wb') as fid:
+            fid.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, LINKTYPE_ETHERNET))
+            for ts, frame in self.packets():
+                usec = int(round(ts * 1e6))
+                fid.write(struct.pack('<IIII', usec / 1000000, usec % 1000000, len(frame), len(frame)))
+                fid.write(frame)
+
+    def write_pcapng(self, path):
+        def block(block_type, body):
+            body += '\x00' * (-len(body) % 4)
+            return struct.pack('<II', block_type, len(body) + 12) + body + struct.pack('<I', len(body) + 12)
+
+        with open(path, 'wb') as fid:
+            fid.write(block(PCAPNG_SHB, struct.pack('<IHHq', PCAPNG_BYTE_ORDER, 1, 0, -1)))
+            # nanosecond resolution through if_tsresol
+            fid.write(block(PCAPNG_IDB, struct.pack('<HHI', LINKTYPE_ETHERNET, 0, 65535) +
+                            struct.pack('<HHB3x', 9, 1, 9) + struct.pack('<HH', 0, 0)))
+            for ts, frame in self.packets():
+                nsec = int(round(ts * 1e9))
+                fid.write(block(PCAPNG_EPB, struct.pack('<IIIII', 0, nsec >> 32, nsec & 0xffffffff,
+                                                        len(frame), len(frame)) + frame))
+
+    def analyze(self, writer):
+        import tempfile
+        fid, path = tempfile.mkstemp()
+        os.close(fid)
+        try:
+            writer(path)
+            return list(NativeBackend().spawn(path))
+        finally:
+            os.remove(path)
+
+    def assert_records(self, records):
+        with open(self.FIXTURE) as fid:
+            expected = json.load(fid)
+        self.assertEqual(len(records), len(expected))
+        for conn, ref in zip(records, expected):
+            self.assertEqual(sorted(conn.keys()), sorted(ref.keys()))
+            for key in ref:
+                if key in ('a2b', 'b2a'):
+                    self.assertEqual(sorted(conn[key].keys()), sorted(ref[key].keys()))
+                    for sub_key in ref[key]:
+                        self.assert_value(conn[key][sub_key], ref[key][sub_key], key + '.' + sub_key)
+                else:
+                    self.assert_value(conn[key], ref[key], key)
+
+    def assert_value(self, value, ref, name):
+        if isinstance(ref, list):
+            self.assertEqual(len(value), len(ref), name)
+            for val, ref_val in zip(value, ref):
+                self.assertAlmostEqual(val, ref_val, places=5, msg=name)
+        elif isinstance(ref, float):
+            self.assertAlmostEqual(value, ref, places=5, msg=name)
+        else:
+            self.assertEqual(value, ref, name)
+
+    def test_pcap(self):
+        self.assert_records(self.analyze(self.write_pcap))
+
+    def test_pcapng(self):
+        self.assert_records(self.analyze(self.write_pcapng))
+
+    def test_payload(self):
+        conn = self.analyze(self.write_pcap)[0]
+        self.assertEqual(base64.b64decode(conn['a2b']['base64_data']),
+                         'GET / HTTP/1.1\r\nHost: example.com\r\n\r\n')
+        self.assertEqual(base64.b64decode(conn['b2a']['base64_data']),
+                         'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello')
+
+
+if __name__ == '__main__':
+    unittest.main()
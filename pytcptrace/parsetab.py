@@ -0,0 +1,53 @@
+
+# parsetab.py
+# This file is automatically generated. Do not edit.
+# pylint: disable=W,C,R
+_tabversion = '3.10'
+
+_lr_method = 'LALR'
+
+_lr_signature = "leftORleftANDnonassocEQNEQGTLT><CONTAINSMATCHESINright!AND CONTAINS EQ GT IN IPADDR LT MATCHES NAME NEQ NUMBER OBJECT OR STRINGexpression : OBJECT\n                  | NUMBER\n                  | IPADDRexpression : STRINGexpression : expression IN '{' constants '}' constants : constant\n                 | constants ',' constantconstant : OBJECT\n                | NUMBER\n                | IPADDR\n                | STRINGexpression : '(' expression ')' expression : expression AND expression\n                  | expression OR expression\n                  | expression EQ expression\n                  | expression NEQ expression\n                  | expression GT expression\n                  | expression LT expression\n                  | expression '>' expression\n                  | expression '<' expression\n                  | expression CONTAINS expression\n                  | expression MATCHES expression\n                  | '!' expression"
+    
+_lr_action_items = {'OBJECT':([0,3,4,10,11,12,13,14,15,16,18,19,20,29,39,],[1,1,1,1,1,1,1,1,1,1,1,1,1,35,35,]),'NUMBER':([0,3,4,10,11,12,13,14,15,16,18,19,20,29,39,],[2,2,2,2,2,2,2,2,2,2,2,2,2,37,37,]),'NEQ':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,20,-3,-23,20,-12,20,None,None,None,None,None,None,None,20,None,-5,]),'!':([0,3,4,10,11,12,13,14,15,16,18,19,20,],[3,3,3,3,3,3,3,3,3,3,3,3,3,]),')':([1,2,5,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,-3,-23,21,-12,-13,-17,-15,-22,-21,-20,-18,-19,-14,-16,-5,]),'(':([0,3,4,10,11,12,13,14,15,16,18,19,20,],[4,4,4,4,4,4,4,4,4,4,4,4,4,]),',':([33,34,35,36,37,38,41,],[-6,-11,-8,-10,-9,39,-7,]),'LT':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,16,-3,-23,16,-12,16,None,None,None,None,None,None,None,16,None,-5,]),'<':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,15,-3,-23,15,-12,15,None,None,None,None,None,None,None,15,None,-5,]),'>':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,18,-3,-23,18,-12,18,None,None,None,None,None,None,None,18,None,-5,]),'GT':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,11,-3,-23,11,-12,11,None,None,None,None,None,None,None,11,None,-5,]),'STRING':([0,3,4,10,11,12,13,14,15,16,18,19,20,29,39,],[5,5,5,5,5,5,5,5,5,5,5,5,5,34,34,]),'IN':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,17,-3,-23,17,-12,17,None,None,None,None,None,None,None,17,None,-5,]),'EQ':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,12,-3,-23,12,-12,12,None,None,None,None,None,None,None,12,None,-5,]),'AND':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,10,-3,-23,10,-12,-13,-17,-15,-22,-21,-20,-18,-19,10,-16,-5,]),'MATCHES':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,13,-3,-23,13,-12,13,None,None,None,None,None,None,None,13,None,-5,]),'CONTAINS':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,14,-3,-23,14,-12,14,None,None,None,None,None,None,None,14,None,-5,]),'IPADDR':([0,3,4,10,11,12,13,14,15,16,18,19,20,29,39,],[7,7,7,7,7,7,7,7,7,7,7,7,7,36,36,]),'{':([17,],[29,]),'$end':([1,2,5,6,7,8,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,0,-3,-23,-12,-13,-17,-15,-22,-21,-20,-18,-19,-14,-16,-5,]),'}':([33,34,35,36,37,38,41,],[-6,-11,-8,-10,-9,40,-7,]),'OR':([1,2,5,6,7,8,9,21,22,23,24,25,26,27,28,30,31,32,40,],[-1,-2,-4,19,-3,-23,19,-12,-13,-17,-15,-22,-21,-20,-18,-19,-14,-16,-5,]),}
+
+_lr_action = {}
+for _k, _v in _lr_action_items.items():
+   for _x,_y in zip(_v[0],_v[1]):
+      if not _x in _lr_action:  _lr_action[_x] = {}
+      _lr_action[_x][_k] = _y
+del _lr_action_items
+
+_lr_goto_items = {'constant':([29,39,],[33,41,]),'expression':([0,3,4,10,11,12,13,14,15,16,18,19,20,],[6,8,9,22,23,24,25,26,27,28,30,31,32,]),'constants':([29,],[38,]),}
+
+_lr_goto = {}
+for _k, _v in _lr_goto_items.items():
+   for _x, _y in zip(_v[0], _v[1]):
+       if not _x in _lr_goto: _lr_goto[_x] = {}
+       _lr_goto[_x][_k] = _y
+del _lr_goto_items
+_lr_productions = [
+  ("S' -> expression","S'",1,None,None,None),
+  ('expression -> OBJECT','expression',1,'p_expression_obj','filter.py',165),
+  ('expression -> NUMBER','expression',1,'p_expression_obj','filter.py',166),
+  ('expression -> IPADDR','expression',1,'p_expression_obj','filter.py',167),
+  ('expression -> STRING','expression',1,'p_expression_string','filter.py',172),
+  ('expression -> expression IN { constants }','expression',5,'p_expression_in','filter.py',177),
+  ('constants -> constant','constants',1,'p_constants','filter.py',182),
+  ('constants -> constants , constant','constants',3,'p_constants','filter.py',183),
+  ('constant -> OBJECT','constant',1,'p_constant','filter.py',188),
+  ('constant -> NUMBER','constant',1,'p_constant','filter.py',189),
+  ('constant -> IPADDR','constant',1,'p_constant','filter.py',190),
+  ('constant -> STRING','constant',1,'p_constant','filter.py',191),
+  ('expression -> ( expression )','expression',3,'p_expression_par','filter.py',196),
+  ('expression -> expression AND expression','expression',3,'p_expression_operator','filter.py',201),
+  ('expression -> expression OR expression','expression',3,'p_expression_operator','filter.py',202),
+  ('expression -> expression EQ expression','expression',3,'p_expression_operator','filter.py',203),
+  ('expression -> expression NEQ expression','expression',3,'p_expression_operator','filter.py',204),
+  ('expression -> expression GT expression','expression',3,'p_expression_operator','filter.py',205),
+  ('expression -> expression LT expression','expression',3,'p_expression_operator','filter.py',206),
+  ('expression -> expression > expression','expression',3,'p_expression_operator','filter.py',207),
+  ('expression -> expression < expression','expression',3,'p_expression_operator','filter.py',208),
+  ('expression -> expression CONTAINS expression','expression',3,'p_expression_operator','filter.py',209),
+  ('expression -> expression MATCHES expression','expression',3,'p_expression_operator','filter.py',210),
+  ('expression -> ! expression','expression',2,'p_expression_operator','filter.py',211),
+]
@@ -0,0 +1,261 @@
+import os
+import base64
+import shutil
+import mmap
+import threading
+import unittest
+import numpy as np
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile
+
+__author__ = 'huangyan13@baidu.com'
+
+
+def decode_base64(data):
+    """
+        Decode base64, padding being optional.
+        :param data: Base64 data as an ASCII byte string
+        :returns: The decoded byte string.
+    """
+    missing_padding = len(data) % 4
+    if missing_padding:
+        data += b'=' * (4 - missing_padding)
+    return base64.b64decode(data)
+
+
+try:
+    buffer
+except NameError:
+    def zero_copy(data, offset, length):
+        return memoryview(data)[offset:offset + length]
+else:
+    # mmap objects do not export the new buffer interface on python 2
+    def zero_copy(data, offset, length):
+        return buffer(data, offset, length)
+
+
+class LRUCache:
+    """
+        Least recently used cache bounded by the total size (in bytes)
+        of its values rather than by the number of entries.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.cur_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key, default=None):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # move to the most recently used end
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if key in self._items:
+            self.cur_bytes -= len(self._items.pop(key))
+        # too large to be worth evicting everything else
+        if len(value) > self.max_bytes:
+            return
+        self._items[key] = value
+        self.cur_bytes += len(value)
+        while self.cur_bytes > self.max_bytes:
+            _, evicted = self._items.popitem(last=False)
+            self.cur_bytes -= len(evicted)
+
+    def clear(self):
+        self._items.clear()
+        self.cur_bytes = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._items), 'bytes': self.cur_bytes}
+
+
+class PayloadStore:
+    """
+        Keep the payloads of all connections in a blob file instead of the
+        heap: each payload is decoded once while loading, written to the
+        blob and referenced by (offset, length). Reads are zero-copy slices
+        of the memory-mapped blob, `get` returns string copies through a
+        byte bounded LRU cache. Other processes can map the blob at `path`.
+    """
+    # bytes of payload copies kept in memory
+    CACHE_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, cache_size=CACHE_SIZE, path=None):
+        if path:
+            # an existing blob, e.g. from the result cache
+            self._fid = open(path, 'rb')
+            self._size = os.path.getsize(path)
+        else:
+            # named, removed when closed
+            self._fid = NamedTemporaryFile()
+            self._size = 0
+        self.path = self._fid.name
+        self._map = None
+        self._lock = threading.Lock()
+        self.cache = LRUCache(cache_size)
+
+    def append(self, data):
+        """ decode base64 `data`, store it and return its (offset, length) """
+        data = decode_base64(data)
+        with self._lock:
+            offset = self._size
+            self._fid.seek(offset)
+            self._fid.write(data)
+            self._size += len(data)
+        return offset, len(data)
+
+    def flush(self):
+        """ make the payloads appended so far visible to readers of `path` """
+        with self._lock:
+            self._fid.flush()
+            return self._size
+
+    def _get_map(self, end):
+        with self._lock:
+            if self._map is None or len(self._map) < end:
+                self._fid.flush()
+                # older maps stay alive as long as a slice refers to them
+                self._map = mmap.mmap(self._fid.fileno(), self._size, access=mmap.ACCESS_READ)
+            return self._map
+
+    def blob(self):
+        """ the whole blob, memory-mapped, e.g. for parsers working with offsets """
+        if not self._size:
+            return b''
+        return self._get_map(self._size)
+
+    def view(self, offset, length):
+        """ zero-copy slice of the payload stored at `offset` """
+        if not length:
+            return zero_copy(b'', 0, 0)
+        return zero_copy(self._get_map(offset + length), offset, length)
+
+    def span(self, offset, length):
+        """ (data, start, end) of the payload stored at `offset`, `data` supporting find() """
+        if not length:
+            return b'', 0, 0
+        return self._get_map(offset + length), offset, offset + length
+
+    def find(self, offset, length, needle):
+        """ position of `needle` in the payload stored at `offset`, -1 if absent """
+        if len(needle) > length:
+            return -1
+        elif not needle:
+            return 0
+        pos = self._get_map(offset + length).find(needle, offset, offset + length)
+        return pos - offset if pos >= 0 else -1
+
+    def array(self):
+        """ the whole blob as a read-only uint8 array, without copying it """
+        if not self._size:
+            return np.zeros(0, dtype=np.uint8)
+        return np.frombuffer(self._get_map(self._size), dtype=np.uint8)
+
+    def get(self, offset, length):
+        """ copy of the payload stored at `offset` """
+        with self._lock:
+            data = self.cache.get((offset, length))
+        if data is None:
+            data = bytes(self.view(offset, length))
+            with self._lock:
+                self.cache.put((offset, length), data)
+        return data
+
+    def save(self, path):
+        """ copy the whole blob to `path` """
+        with self._lock:
+            self._fid.seek(0)
+            with open(path, 'wb') as fid:
+                shutil.copyfileobj(self._fid, fid)
+
+    def close(self):
+        self._map = None
+        self._fid.close()
+        self.cache.clear()
+
+
+# blobs mapped by this process, by path
+_blob_maps = {}
+
+
+def map_blob(path, end):
+    """
+        Read-only map of the blob at `path` covering at least `end` bytes,
+        shared by the calls of one process, e.g. a worker of a Pool.
+    """
+    blob = _blob_maps.get(path)
+    if blob is None or len(blob) < end:
+        with open(path, 'rb') as fid:
+            blob = _blob_maps[path] = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+    return blob
+
+
+class TestPayloadStore(unittest.TestCase):
+    def test_lru_budget(self):
+        cache = LRUCache(10)
+        cache.put(1, 'aaaa')
+        cache.put(2, 'bbbb')
+        self.assertEqual(cache.get(1), 'aaaa')
+        # evicts 2, the least recently used one
+        cache.put(3, 'cccc')
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(3), 'cccc')
+        cache.put(4, 'x' * 11)
+        self.assertTrue(4 not in cache)
+        self.assertEqual(cache.stats(), {'hits': 2, 'misses': 1, 'entries': 2, 'bytes': 8})
+
+    def test_store(self):
+        store = PayloadStore(cache_size=100)
+        refs = [store.append(base64.b64encode(data).rstrip('='))
+                for data in ('hello', 'HTTP/1.1 200 OK', '')]
+        self.assertEqual(store.get(*refs[1]), 'HTTP/1.1 200 OK')
+        self.assertEqual(store.get(*refs[0]), 'hello')
+        self.assertEqual(store.get(*refs[1]), 'HTTP/1.1 200 OK')
+        self.assertEqual(store.get(*refs[2]), '')
+        self.assertEqual(store.cache.hits, 1)
+        self.assertEqual(refs[1], (5, 15))
+        self.assertEqual(bytes(store.view(*refs[1])[0:4]), 'HTTP')
+        # appending after a read maps the grown blob again
+        refs.append(store.append(base64.b64encode('world')))
+        self.assertEqual(bytes(store.view(*refs[3])), 'world')
+        self.assertEqual(store.find(*refs[1] + ('200',)), 9)
+        self.assertEqual(store.find(*refs[0] + ('HTTP',)), -1)
+        data, start, end = store.span(*refs[1])
+        self.assertEqual((data[start:end], data.find('OK', start, end)), ('HTTP/1.1 200 OK', 18))
+        self.assertEqual(store.span(*refs[2]), ('', 0, 0))
+        self.assertEqual(store.array()[5:9].tostring(), 'HTTP')
+        self.assertEqual(store.blob()[5:20], 'HTTP/1.1 200 OK')
+        self.assertEqual(PayloadStore().blob(), '')
+
+    def test_map_blob(self):
+        store = PayloadStore()
+        offset, length = store.append(base64.b64encode('GET / HTTP/1.1'))
+        end = store.flush()
+        blob = map_blob(store.path, end)
+        self.assertEqual(blob[offset:offset + length], 'GET / HTTP/1.1')
+        self.assertTrue(map_blob(store.path, end) is blob)
+        # grown since, mapped again
+        offset, length = store.append(base64.b64encode('HTTP/1.1 200 OK'))
+        blob = map_blob(store.path, store.flush())
+        self.assertEqual(blob[offset:offset + length], 'HTTP/1.1 200 OK')
+        store.close()
+        _blob_maps.clear()
+
+
+if __name__ == '__main__':
+    unittest.main()
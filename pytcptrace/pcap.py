@@ -0,0 +1,149 @@
+import os
+import mmap
+import struct
+import numpy as np
+
+__author__ = 'huangyan13@baidu.com'
+
+
+# magic number -> (byte order, timestamp resolution)
+PCAP_MAGIC = {
+    0xa1b2c3d4: ('<', 1e-6),
+    0xd4c3b2a1: ('>', 1e-6),
+    0xa1b23c4d: ('<', 1e-9),
+    0x4d3cb2a1: ('>', 1e-9),
+}
+PCAP_HEADER_LEN = 24
+RECORD_HEADER_LEN = 16
+
+# link layer types
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LOOP = 108
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+ETHERTYPE_IP = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+IPPROTO_TCP = 6
+
+# records indexed and decoded at a time by split_pcap
+SPLIT_BATCH = 1 << 18
+# bytes copied to a chunk per write
+COPY_BLOCK = 16 * 1024 * 1024
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+
+class PcapFormatError(ValueError):
+    """ error raised when a file is not a capture we can read """
+
+
+def read_header(fid):
+    """
+        Read the global header of a classic pcap file.
+        :returns: (raw header, byte order, timestamp resolution, link type)
+    """
+    header = fid.read(PCAP_HEADER_LEN)
+    if len(header) < PCAP_HEADER_LEN:
+        raise PcapFormatError('file too short for a pcap header')
+    magic = struct.unpack('<I', header[:4])[0]
+    if magic not in PCAP_MAGIC:
+        raise PcapFormatError('not a classic pcap file')
+    order, resolution = PCAP_MAGIC[magic]
+    linktype = struct.unpack(order + 'I', header[20:24])[0] & 0x0fffffff
+    return header, order, resolution, linktype
+
+
+def flow_hash(packets):
+    """
+        Direction independent hash of the TCP 4-tuple of every packet decoded
+        by native.decode_tcp, the same for both directions of a connection.
+    """
+    ends = []
+    for addr, port in (('src', 'sport'), ('dst', 'dport')):
+        # FNV-1a over the address and port bytes, wrapping around like in C
+        value = np.empty(len(packets[port]), dtype=np.uint64)
+        value.fill(FNV_OFFSET)
+        columns = [packets[addr][:, idx] for idx in range(packets[addr].shape[1])]
+        for column in columns + [packets[port] >> 8, packets[port] & 0xff]:
+            value = (value ^ column.astype(np.uint64)) * FNV_PRIME
+        ends.append(value)
+    # the sum does not depend on the direction, mix its bits again
+    value = ends[0] + ends[1]
+    value ^= value >> np.uint64(33)
+    value *= np.uint64(0xff51afd7ed558ccd)
+    value ^= value >> np.uint64(33)
+    return value
+
+
+def _copy(buf, output, start, end):
+    for pos in xrange(start, end, COPY_BLOCK):
+        output.write(buf[pos:min(end, pos + COPY_BLOCK)])
+
+
+def split_pcap(pcap_file, num_chunks, out_dir, mode='flow', progress=None):
+    """
+        Split a classic pcap file into `num_chunks` captures in `out_dir`.
+        With mode 'flow' packets are spread by a hash of their TCP 4-tuple,
+        so every connection stays in a single chunk; with mode 'time' the
+        capture is cut into consecutive time ranges of about the same size.
+        Records are indexed and decoded with NumPy a batch at a time, and
+        every run of records going to the same chunk is copied at once.
+        `progress` is called with the bytes split so far after every batch,
+        an exception it raises (e.g. on cancel) stops the split.
+        :returns: the paths of the chunks which received packets
+    """
+    # imported late, native imports this module
+    from native import index_pcap, decode_tcp
+    paths = [os.path.join(out_dir, 'chunk%d.pcap' % idx) for idx in range(num_chunks)]
+    with open(pcap_file, 'rb') as fid:
+        header = read_header(fid)[0]
+        total = os.fstat(fid.fileno()).st_size
+        buf = mmap.mmap(fid.fileno(), 0, access=mmap.ACCESS_READ)
+    counts = np.zeros(num_chunks, dtype=np.int64)
+    outputs = []
+    try:
+        for path in paths:
+            outputs.append(open(path, 'wb'))
+            outputs[-1].write(header)
+        writes = [output.write for output in outputs]
+        pos = PCAP_HEADER_LEN
+        while True:
+            index = index_pcap(buf, pos, SPLIT_BATCH)
+            offsets, caplens = index[1:3]
+            if not len(offsets):
+                break
+            starts = offsets - RECORD_HEADER_LEN
+            ends = offsets + caplens
+            if mode == 'flow':
+                # packets tcptrace ignores anyway go to the first chunk
+                chunks = np.zeros(len(offsets), dtype=np.int64)
+                packets = decode_tcp(buf, *index)
+                chunks[packets['record']] = flow_hash(packets) % np.uint64(num_chunks)
+            else:
+                chunks = np.minimum(num_chunks - 1, starts * num_chunks // total)
+            counts += np.bincount(chunks, minlength=num_chunks)
+            # one write per run of records going to the same chunk
+            firsts = np.concatenate(([0], np.nonzero(np.diff(chunks))[0] + 1))
+            lasts = np.append(firsts[1:], len(chunks)) - 1
+            for chunk, start, end in zip(chunks[firsts].tolist(), starts[firsts].tolist(),
+                                         ends[lasts].tolist()):
+                if end - start <= COPY_BLOCK:
+                    writes[chunk](buf[start:end])
+                else:
+                    _copy(buf, outputs[chunk], start, end)
+            pos = int(ends[-1])
+            if progress:
+                progress(pos)
+    finally:
+        for output in outputs:
+            output.close()
+        buf.close()
+    for path, count in zip(paths, counts):
+        if not count:
+            os.remove(path)
+    return [path for path, count in zip(paths, counts) if count]
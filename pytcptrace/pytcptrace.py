@@ -1,20 +1,193 @@
+import io
 import os
+import sys
 import time
-import base64
+import codecs
 import datetime
 import json
+import base64
+import shutil
+import select
+import struct
+import threading
+import unittest
 import subprocess
-from tempfile import NamedTemporaryFile
-from filter import generate_filter
+import multiprocessing
+from collections import OrderedDict
+from tempfile import NamedTemporaryFile, mkdtemp, mkstemp
+import numpy as np
+from filter import generate_filter, CompiledFilter
+from table import ConnectionTable, ConnectionTableBuilder, DIRECTIONS, SERIES_FIELDS, PAYLOAD_FIELDS
+from payload import decode_base64, PayloadStore
+import pcap
+from pcap import split_pcap, PcapFormatError
+import native
+from native import NativeBackend
+from index import TableIndexes
+from features import add_http_features, HTTP_FEATURES
 
 __author__ = 'huangyan13@baidu.com'
 
 
-class TcpTrace:
-    def __init__(self):
-        self._tcptrace = self._get_tcptrace()
+class TcpTraceCancelled(RuntimeError):
+    """ error raised when tcptrace is cancelled by the user """
+
+
+class TcpTraceTimeout(RuntimeError):
+    """ error raised when tcptrace runs longer than the timeout """
+
+
+class TcpTraceProcess:
+    """
+        Drive a single tcptrace run: the -J output is read from a pipe while
+        stdout and stderr are drained by background threads, so tcptrace
+        never blocks on a full pipe buffer. tcptrace writes the JSON only
+        once it went through the whole capture, until then progress reports
+        the bytes tcptrace has read, where the system tells (Linux /proc).
+    """
+    # seconds between two progress reports when tcptrace is silent
+    PROGRESS_INTERVAL = 0.2
+
+    def __init__(self, args, timeout=None, progress=None):
+        self.args = args
+        self.timeout = timeout
+        self.progress = progress
+        self.bytes_read = 0
+        # bytes read by tcptrace, None when unknown
+        self.capture_read = None
+        self.num_connections = 0
+        self.returncode = None
+        self._pid = None
+        self._fid = None
+        self._timer = None
+        self._stdout = []
+        self._stderr = []
+        self._threads = []
+        self._cancelled = threading.Event()
+        self._timed_out = threading.Event()
+
+    @staticmethod
+    def _drain(stream, chunks):
+        for chunk in iter(lambda: stream.read(4096), b''):
+            chunks.append(chunk)
+        stream.close()
+
+    def start(self):
+        read_fd, write_fd = os.pipe()
+        try:
+            self._pid = subprocess.Popen([self.args[0], '-J/dev/fd/%d' % write_fd] + self.args[1:],
+                                         stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE,
+                                         close_fds=False)
+        except OSError:
+            os.close(read_fd)
+            raise
+        finally:
+            # only the child should hold the write end, so that we get EOF when it exits
+            os.close(write_fd)
+        # unbuffered, so that each read returns whatever tcptrace has written so far
+        self._fid = io.open(read_fd, 'rb', buffering=0)
+        for stream, chunks in ((self._pid.stdout, self._stdout),
+                               (self._pid.stderr, self._stderr)):
+            thread = threading.Thread(target=self._drain, args=(stream, chunks))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+        if self.timeout:
+            self._timer = threading.Timer(self.timeout, self._on_timeout)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _update_capture_read(self):
+        try:
+            with open('/proc/%d/io' % self._pid.pid) as fid:
+                for line in fid:
+                    if line.startswith('rchar:'):
+                        self.capture_read = int(line.split()[1])
+        except (IOError, ValueError):
+            # not Linux, or tcptrace exited, keep the last value
+            pass
+        return self.capture_read
+
+    def read(self, size):
+        # tcptrace stays silent while it goes through the capture,
+        # report how far it got so the caller can refresh itself
+        while not select.select([self._fid], [], [], self.PROGRESS_INTERVAL)[0]:
+            if self.progress:
+                self.progress(self.num_connections, self._update_capture_read())
+        data = self._fid.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def __iter__(self):
+        if self._pid is None:
+            self.start()
+        complete = False
+        try:
+            for conn in iter_json_array(self):
+                self.num_connections += 1
+                if self.progress:
+                    self.progress(self.num_connections, self.capture_read)
+                yield conn
+            complete = True
+        except RuntimeError:
+            # a killed tcptrace leaves truncated output behind
+            if not (self._cancelled.is_set() or self._timed_out.is_set()):
+                raise
+        finally:
+            # let tcptrace exit by itself unless we stopped reading early
+            self._finish(kill=not complete)
+        if self._cancelled.is_set():
+            raise TcpTraceCancelled('tcptrace cancelled')
+        if self._timed_out.is_set():
+            raise TcpTraceTimeout('tcptrace did not finish in %s seconds' % self.timeout)
+        if self.returncode != 0:
+            raise RuntimeError('tcptrace exited with return code %d' % self.returncode)
 
-    def _get_tcptrace(self):
+    def _finish(self, kill):
+        if kill:
+            self._kill()
+        self.returncode = self._pid.wait()
+        if self._timer:
+            self._timer.cancel()
+        for thread in self._threads:
+            thread.join()
+        self._fid.close()
+
+    def _kill(self):
+        if self._pid and self._pid.poll() is None:
+            try:
+                self._pid.kill()
+            except OSError:
+                # already exited
+                pass
+
+    def _on_timeout(self):
+        self._timed_out.set()
+        self._kill()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._kill()
+
+    def get_stdout(self):
+        return b''.join(self._stdout)
+
+    def get_stderr(self):
+        return b''.join(self._stderr)
+
+
+class TcpTraceBackend:
+    """ runs the tcptrace executable shipped next to this module """
+    name = 'tcptrace'
+    FLAGS = ['-n', '-e', '-T']
+
+    def __init__(self, timeout=None):
+        self.path = self._get_tcptrace()
+        self.timeout = timeout
+
+    @staticmethod
+    def _get_tcptrace():
         dirname, filename = os.path.split(os.path.abspath(__file__))
         tcptrace_path = os.path.join(dirname, 'tcptrace')
         if os.path.exists(tcptrace_path) and os.path.isfile(tcptrace_path):
@@ -22,14 +195,190 @@ class TcpTrace:
         else:
             raise IOError('tcptrace executable not exist.')
 
-    def open(self, pcap_file):
+    def cache_key(self):
+        # same key as before backends existed, so old cache entries stay valid
+        return self.FLAGS
+
+    def spawn(self, pcap_file, progress=None):
+        return TcpTraceProcess([self.path] + self.FLAGS + [pcap_file],
+                               timeout=self.timeout, progress=progress)
+
+
+BACKENDS = {
+    'tcptrace': TcpTraceBackend,
+    'native': NativeBackend,
+}
+
+
+class TcpTrace:
+    """
+        Analyze captures with a backend: 'tcptrace' runs the executable,
+        'native' reads the capture with NumPy. By default tcptrace is used
+        when it is available.
+    """
+    # seconds between two looks at cancel() while chunks are analyzed
+    CANCEL_INTERVAL = 0.2
+
+    def __init__(self, timeout=None, cache=None, backend=None):
+        self.timeout = timeout
+        self.cache = cache
+        self.backend = self._get_backend(backend, timeout)
+        self._process = None
+        self._cancelled = threading.Event()
+        self._output = (b'', b'')
+
+    @staticmethod
+    def _get_backend(backend, timeout):
+        if backend is None:
+            try:
+                return TcpTraceBackend(timeout)
+            except IOError:
+                return NativeBackend(timeout)
+        elif isinstance(backend, basestring):
+            if backend not in BACKENDS:
+                raise ValueError('unknown backend %s' % backend)
+            return BACKENDS[backend](timeout)
+        return backend
+
+    def open(self, pcap_file, streaming=True, progress=None, workers=1, split='flow'):
+        """
+            Analyze `pcap_file`, `progress` is called with the number of
+            connections and capture bytes analyzed so far, None when the
+            backend can't tell. With more than one worker the capture is
+            split into chunks analyzed in parallel.
+        """
+        if not streaming:
+            return self._open_buffered(pcap_file)
+        if self.cache:
+            cached = self.cache.get(pcap_file, self.backend.cache_key())
+            if cached:
+                return PcapHandle(*cached)
+        result = None
+        self._cancelled.clear()
+        if workers > 1:
+            result = self._open_parallel(pcap_file, workers, split, progress)
+        if result is None:
+            process = self.spawn(pcap_file, progress)
+            result = (ConnectionTable.from_records(process),
+                      process.get_stdout(), process.get_stderr())
+        conn_data, stdout, stderr = result
+        if not len(conn_data):
+            raise RuntimeError('.pcap file do not contain valid TCP connections.')
+        handle = PcapHandle(conn_data, stdout, stderr)
+        self.store(pcap_file, handle)
+        return handle
+
+    def store(self, pcap_file, handle):
+        if self.cache:
+            # store normalized times, so that loading from cache costs nothing more
+            self.cache.put(pcap_file, self.backend.cache_key(), handle.conn_data, handle._stdout, handle._stderr)
+
+    def iter_tables(self, pcap_file, batch_size=1000, batch_time=0.5, progress=None):
+        """
+            Yield the connections as tables of up to `batch_size` rows, or
+            what arrived within `batch_time` seconds, sharing one
+            PayloadStore so that they can be appended to the first one. A
+            cached capture comes as a single table. Then get_output() has
+            tcptrace stdout and stderr.
+        """
+        self._output = (b'', b'')
+        if self.cache:
+            cached = self.cache.get(pcap_file, self.backend.cache_key())
+            if cached:
+                self._output = cached[1:]
+                yield cached[0]
+                return
+        builder = ConnectionTableBuilder(PayloadStore())
+        started = time.time()
+        for record in self.iter_connections(pcap_file, progress):
+            builder.append(record)
+            if builder.size >= batch_size or time.time() - started >= batch_time:
+                yield builder.build()
+                builder = ConnectionTableBuilder(builder.payloads)
+                started = time.time()
+        if builder.size:
+            yield builder.build()
+        self._output = (self._process.get_stdout(), self._process.get_stderr())
+
+    def get_output(self):
+        return self._output
+
+    def _open_parallel(self, pcap_file, workers, split, progress=None):
+        # the capture is read twice, by the split and by the workers,
+        # progress counts half of the bytes of each
+        def split_progress(num_bytes):
+            if self._cancelled.is_set():
+                raise TcpTraceCancelled('tcptrace cancelled')
+            if progress:
+                progress(0, num_bytes / 2)
+
+        temp_dir = mkdtemp()
+        try:
+            try:
+                chunks = split_pcap(pcap_file, workers, temp_dir, split, split_progress)
+            except PcapFormatError:
+                # e.g. pcapng, let a single process handle it
+                return None
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = []
+                num_connections = 0
+                num_bytes = os.path.getsize(pcap_file)
+                pending = pool.imap(_analyze_chunk, [(self.backend, path) for path in chunks])
+                for path in chunks:
+                    # wait with a timeout, so that cancel() is noticed while workers run
+                    while True:
+                        if self._cancelled.is_set():
+                            raise TcpTraceCancelled('tcptrace cancelled')
+                        try:
+                            result = pending.next(self.CANCEL_INTERVAL)
+                            break
+                        except multiprocessing.TimeoutError:
+                            pass
+                    results.append(result)
+                    num_connections += len(result[0])
+                    num_bytes += os.path.getsize(path)
+                    if progress:
+                        progress(num_connections, num_bytes / 2)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        records = merge_chunks([result[0] for result in results])
+        return (ConnectionTable.from_records(records),
+                b''.join(result[1] for result in results),
+                b''.join(result[2] for result in results))
+
+    def spawn(self, pcap_file, progress=None):
+        self._process = self.backend.spawn(pcap_file, progress)
+        return self._process
+
+    def iter_connections(self, pcap_file, progress=None):
+        """
+            Yield each connection as soon as the backend has produced it,
+            e.g. as soon as tcptrace has written its JSON object.
+        """
+        return iter(self.spawn(pcap_file, progress))
+
+    def cancel(self):
+        # the pool of _open_parallel is terminated by the thread waiting on it
+        self._cancelled.set()
+        if self._process:
+            self._process.cancel()
+
+    def _open_buffered(self, pcap_file):
+        if not isinstance(self.backend, TcpTraceBackend):
+            return PcapHandle(list(self.spawn(pcap_file)), self._process.get_stdout(),
+                              self._process.get_stderr())
         fid = NamedTemporaryFile('w', delete=False)
         temp_name = fid.name
         fid.close()
-        pid = subprocess.Popen([self._tcptrace, '-n', '-J' + temp_name, '-e', '-T', pcap_file],
+        pid = subprocess.Popen([self.backend.path, '-J' + temp_name] + self.backend.FLAGS + [pcap_file],
                                stdout=subprocess.PIPE,
                                stderr=subprocess.PIPE)
-        pid.wait()
+        stdout, stderr = pid.communicate()
         if pid.returncode != 0:
             raise RuntimeError('tcptrace exited with return code %d' % pid.returncode)
         else:
@@ -39,72 +388,568 @@ class TcpTrace:
             if not raw_json:
                 raise RuntimeError('.pcap file do not contain valid TCP connections.')
             os.remove(temp_name)
-            return PcapHandle(raw_json, pid.stdout.read(), pid.stderr.read())
+            return PcapHandle(json.loads(raw_json.decode('utf-8')), stdout, stderr)
+
+
+def _analyze_chunk(args):
+    # runs in a worker process of TcpTrace._open_parallel
+    backend, pcap_file = args
+    process = backend.spawn(pcap_file)
+    return list(process), process.get_stdout(), process.get_stderr()
+
+
+def _swap_direction(conn):
+    """ the same connection as seen from the other end """
+    conn = dict(conn)
+    conn['host_a'], conn['host_b'] = conn['host_b'], conn['host_a']
+    conn['port_a'], conn['port_b'] = conn['port_b'], conn['port_a']
+    conn['a2b'], conn['b2a'] = conn['b2a'], conn['a2b']
+    return conn
+
+
+# per-direction counters of tcptrace, summed over the chunks of a connection
+ADDITIVE_FIELDS = frozenset((
+    'packets_sent', 'ack_pkts_sent', 'pure_acks_sent', 'sack_pkts_sent', 'dsack_pkts_sent',
+    'unique_bytes_sent', 'actual_data_pkts', 'actual_data_bytes', 'rexmt_data_pkts',
+    'rexmt_data_bytes', 'zwnd_probe_pkts', 'zwnd_probe_bytes', 'outoforder_pkts',
+    'pushed_data_pkts', 'SYN_pkts_sent', 'FIN_pkts_sent', 'RST_pkts_sent', 'sacks_sent',
+    'urgent_data_pkts', 'urgent_data_bytes', 'zero_win_adv', 'missed_data',
+    'truncated_data', 'truncated_packets', 'RTT_samples', 'RTT_full_sz_smpls',
+))
+# counters the statistics of a field family are measured over, packets by default
+STAT_WEIGHTS = (
+    ('segm_size', 'actual_data_pkts'),
+    ('RTT_full_sz', 'RTT_full_sz_smpls'),
+    ('RTT_', 'RTT_samples'),
+)
+
+
+def _is_extreme(key, kind):
+    return key.startswith(kind + '_') or key.endswith('_' + kind)
+
+
+def _merge_direction(sub_conn, other):
+    """
+        Merge `other` into `sub_conn`, both in the same direction: counters
+        are added, extremes compared, averages weighted by the counter they
+        are computed over, series and payloads joined. Other values, e.g.
+        options of the handshake, are kept from the earlier chunk.
+    """
+    def weight(conn, key):
+        name = next((name for family, name in STAT_WEIGHTS if family in key), 'packets_sent')
+        return conn[name][0] if name in conn else 1
+
+    merged = {}
+    for key, val in other.items():
+        if key not in sub_conn:
+            merged[key] = val
+        elif key in SERIES_FIELDS:
+            merged[key] = sub_conn[key] + val
+        elif key in PAYLOAD_FIELDS:
+            # base64 padding does not allow to simply join the strings
+            merged[key] = base64.b64encode(decode_base64(sub_conn[key]) + decode_base64(val))
+        elif not (isinstance(val, list) and val and isinstance(val[0], (int, long, float))):
+            continue
+        elif key in ADDITIVE_FIELDS:
+            merged[key] = [sub_conn[key][0] + val[0]]
+        elif key.startswith('first_'):
+            # 0 stands for no data in this direction
+            times = [t for t in (sub_conn[key][0], val[0]) if t > 0]
+            merged[key] = [min(times) if times else 0]
+        elif key.startswith('last_'):
+            merged[key] = [max(sub_conn[key][0], val[0])]
+        else:
+            # a chunk without packets weighting it did not measure anything
+            weights = (weight(sub_conn, key), weight(other, key))
+            values = [v for v, w in zip((sub_conn[key][0], val[0]), weights) if w > 0]
+            if len(values) < 2:
+                merged[key] = [values[0] if values else sub_conn[key][0]]
+            elif _is_extreme(key, 'max'):
+                merged[key] = [max(values)]
+            elif _is_extreme(key, 'min'):
+                merged[key] = [min(values)]
+            elif _is_extreme(key, 'avg'):
+                merged[key] = [float(values[0] * weights[0] + values[1] * weights[1]) / sum(weights)]
+            elif key.endswith('_stdev') and key[:-6] + '_avg' in sub_conn and key[:-6] + '_avg' in other:
+                # pooled from the second moments of both chunks
+                avg = key[:-6] + '_avg'
+                moments = [(w, a[0], s ** 2 + a[0] ** 2) for w, a, s in
+                           zip(weights, (sub_conn[avg], other[avg]), values)]
+                total = float(sum(w for w, _, _ in moments))
+                mean = sum(w * a for w, a, _ in moments) / total
+                merged[key] = [max(sum(w * m for w, _, m in moments) / total - mean ** 2, 0) ** 0.5]
+    sub_conn.update(merged)
+    if 'data_trans_time' in sub_conn and sub_conn.get('first_data_time', [0])[0] > 0:
+        sub_conn['data_trans_time'] = [sub_conn['last_data_time'][0] - sub_conn['first_data_time'][0]]
+
+
+def merge_connection(conn, other):
+    """ merge `other`, a later part of the same connection, into `conn` """
+    conn['first_packet_time'] = min(conn['first_packet_time'], other['first_packet_time'])
+    conn['last_packet_time'] = max(conn['last_packet_time'], other['last_packet_time'])
+    conn['elapsed_time'] = conn['last_packet_time'] - conn['first_packet_time']
+    conn['total_packets'] += other['total_packets']
+    for direct in DIRECTIONS:
+        _merge_direction(conn[direct], other[direct])
+    # as tcptrace tells it, SYN and FIN seen both ways, maybe by different chunks
+    counts = [conn[direct].get(key, [None])[0] for direct in DIRECTIONS
+              for key in ('SYN_pkts_sent', 'FIN_pkts_sent')]
+    if None in counts:
+        conn['complete'] = conn['complete'] and other['complete']
+    else:
+        conn['complete'] = all(count > 0 for count in counts)
+    for direct in DIRECTIONS:
+        if 'throughput' in conn[direct] and 'unique_bytes_sent' in conn[direct]:
+            conn[direct]['throughput'] = [conn[direct]['unique_bytes_sent'][0] / conn['elapsed_time']
+                                          if conn['elapsed_time'] > 0 else 0]
+
+
+def merge_chunks(chunks):
+    """
+        Join the connections reported for consecutive chunks of a capture,
+        merging those which appear in more than one chunk.
+    """
+    merged = []
+    known = {}
+    for records in chunks:
+        new_keys = {}
+        for conn in records:
+            key = (conn['host_a'], conn['port_a'], conn['host_b'], conn['port_b'])
+            reverse = (key[2], key[3], key[0], key[1])
+            if key in known:
+                merge_connection(merged[known[key]], conn)
+            elif reverse in known:
+                merge_connection(merged[known[reverse]], _swap_direction(conn))
+            else:
+                merged.append(conn)
+                new_keys[key] = len(merged) - 1
+        # only merge with connections of previous chunks, a 4-tuple reused
+        # inside a chunk is a new connection for tcptrace as well
+        known.update(new_keys)
+    merged.sort(key=lambda conn: conn['first_packet_time'])
+    return merged
+
+
+def iter_json_array(fid, chunk_size=1 << 16):
+    """
+        Incrementally decode a top level JSON array read from `fid`,
+        yielding every element once it is complete.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = u''
+    pos = 0
+    started = False
+    eof = False
+    read_size = chunk_size
+    while True:
+        # skip separators between two elements
+        while pos < len(buf) and (buf[pos].isspace() or buf[pos] == u','
+                                  or (buf[pos] == u'[' and not started)):
+            if buf[pos] == u'[':
+                started = True
+            pos += 1
+        if pos < len(buf) and buf[pos] == u']':
+            return
+        if pos < len(buf) and not started:
+            raise RuntimeError('Malformed JSON output from tcptrace.')
+        if pos < len(buf):
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # a number at the end of the buffer may go on in the next chunk
+                if end == len(buf) and not eof:
+                    raise ValueError
+            except ValueError:
+                # element not complete yet, wait for more data, growing the
+                # read size so that huge elements are not re-scanned too often
+                if eof:
+                    raise RuntimeError('Truncated or malformed JSON output from tcptrace.')
+                read_size = max(chunk_size, len(buf) - pos)
+            else:
+                yield obj
+                pos = end
+                read_size = chunk_size
+                continue
+        elif eof:
+            if started:
+                raise RuntimeError('Truncated JSON output from tcptrace.')
+            return
+        chunk = fid.read(read_size)
+        if not chunk:
+            eof = True
+            buf = buf[pos:] + utf8.decode(b'', final=True)
+        else:
+            buf = buf[pos:] + utf8.decode(chunk)
+        pos = 0
 
 
 class PcapHandle:
     # the unix timestamp of 2000-01-01
     TIME_MAGIC = time.mktime(datetime.datetime(2000, 1, 1).timetuple())
+    TIME_FIELDS = ('first_packet_time', 'last_packet_time',
+                   'a2b.first_data_time', 'a2b.last_data_time',
+                   'b2a.first_data_time', 'b2a.last_data_time')
+    # number of filter results kept for incremental re-filtering
+    RESULT_CACHE_SIZE = 16
 
-    def __init__(self, raw_json, stdout, stderr):
-        self._raw_json = raw_json.decode('utf-8')
+    def __init__(self, conn_data, stdout, stderr):
         self._stdout = stdout
         self._stderr = stderr
-        self.conn_data = json.loads(self._raw_json)
+        # keep the connections column by column
+        if not isinstance(conn_data, ConnectionTable):
+            conn_data = ConnectionTable.from_records(conn_data)
+        self.conn_data = conn_data
         self.filter_func = None
+        self._min_time = None
         self.shift_time()
-        self.decode_data()
+        # http.* filter fields, cached tables have them already
+        if not conn_data.has_column(HTTP_FEATURES[0]):
+            add_http_features(conn_data)
+        # built column by column when a filter can use them
+        self.indexes = TableIndexes(conn_data)
+        # expression -> (compiled filter, matching rows) of recent filters
+        self._results = OrderedDict()
 
-    @staticmethod
-    def decode_base64(data):
+    # payloads are only decoded when a widget asks for them
+    decode_base64 = staticmethod(decode_base64)
+
+    def shift_time(self, table=None):
+        """
+            Make times relative to the first packet. Tables appended later
+            are shifted like the first one.
         """
-            Decode base64, padding being optional.
-            :param data: Base64 data as an ASCII byte string
-            :returns: The decoded byte string.
+        if table is None:
+            table = self.conn_data
+        if self._min_time is None:
+            for name in ('first_packet_time', 'a2b.first_data_time', 'b2a.first_data_time'):
+                if table.has_column(name):
+                    values = table.column(name)
+                    values = values[values > self.TIME_MAGIC]
+                    if len(values) and (self._min_time is None or values.min() < self._min_time):
+                        self._min_time = values.min()
+            if self._min_time is None:
+                return
+        min_time = self._min_time
+
+        time_arrays = [table.column(name) for name in self.TIME_FIELDS if table.has_column(name)]
+        for direct in DIRECTIONS:
+            for field in ('time', 'points_time'):
+                name = '%s.%s' % (direct, field)
+                if name in table.series:
+                    time_arrays.append(table.series[name][0])
+        # values below TIME_MAGIC are not timestamps (e.g. 0 when no data was sent)
+        for values in time_arrays:
+            values[values >= self.TIME_MAGIC] -= min_time
+
+    def extend(self, table):
         """
-        missing_padding = 4 - len(data) % 4
-        if missing_padding:
-            data += b'=' * missing_padding
-        return base64.decodestring(data)
-
-    def decode_data(self):
-        for idx in range(len(self.conn_data)):
-            for field in ('a2b', 'b2a'):
-                if 'base64_data' in self.conn_data[idx][field]:
-                    self.conn_data[idx][field]['base64_data'] =\
-                        self.decode_base64(self.conn_data[idx][field]['base64_data'])
-
-    def shift_time(self):
-        min_time = None
-        for conn in self.conn_data:
-            times = (conn['first_packet_time'],
-                     conn['a2b']['first_data_time'][0],
-                     conn['b2a']['first_data_time'][0])
-            for t in times:
-                if t > self.TIME_MAGIC and (not min_time or t < min_time):
-                    min_time = t
-
-        def time_wrapper(time_val):
-            return time_val if time_val < self.TIME_MAGIC else time_val - min_time
-
-        for idx in range(len(self.conn_data)):
-            for field in ('first_packet_time', 'last_packet_time'):
-                self.conn_data[idx][field] = time_wrapper(self.conn_data[idx][field])
-
-            for direct in ('a2b', 'b2a'):
-                for field in ('first_data_time', 'last_data_time'):
-                    self.conn_data[idx][direct][field][0] = time_wrapper(self.conn_data[idx][direct][field][0])
-
-                for field in ('time', 'points_time'):
-                    if field in self.conn_data[idx][direct]:
-                        for i in range(len(self.conn_data[idx][direct][field])):
-                            self.conn_data[idx][direct][field][i] = time_wrapper(self.conn_data[idx][direct][field][i])
+            Append the connections of `table`, see TcpTrace.iter_tables.
+            Cached filter results are completed by evaluating the filters
+            over the new rows only.
+        """
+        self.shift_time(table)
+        if not table.has_column(HTTP_FEATURES[0]):
+            add_http_features(table)
+        start = len(self.conn_data)
+        self.conn_data.extend(table)
+        self.indexes.clear()
+        new_rows = np.arange(start, len(self.conn_data))
+        for expr, (compiled, rows) in self._results.items():
+            matches = new_rows[compiled.mask(self.conn_data, rows=new_rows)]
+            self._results[expr] = (compiled, np.concatenate((rows, matches)))
+
+    def set_output(self, stdout, stderr):
+        self._stdout = stdout
+        self._stderr = stderr
 
     def set_filter(self, filter_func=None):
         self.filter_func = filter_func
 
-    def read(self):
+    def read_indices(self):
+        """ row indices of the connections matching current filter """
         if not self.filter_func:
-            return self.conn_data
+            return np.arange(len(self.conn_data))
+        elif isinstance(self.filter_func, CompiledFilter):
+            return self._filter_indices(self.filter_func)
+        else:
+            return np.array([idx for idx, conn in enumerate(self.conn_data)
+                             if self.filter_func(conn)], dtype=np.int64)
+
+    def _filter_indices(self, compiled):
+        cached = self._results.pop(compiled.expr, None)
+        if cached:
+            rows = cached[1]
         else:
-            return filter(lambda x: self.filter_func(x), self.conn_data)
+            # a refinement of a recent filter only has to look at its matches
+            base = None
+            for other, other_rows in self._results.values():
+                if compiled.refines(other) and (base is None or len(other_rows) < len(base)):
+                    base = other_rows
+            rows = compiled.indices(self.conn_data, indexes=self.indexes, rows=base)
+        self._results[compiled.expr] = (compiled, rows)
+        if len(self._results) > self.RESULT_CACHE_SIZE:
+            self._results.popitem(last=False)
+        return rows
+
+    def clear_results(self):
+        """ forget cached filter results, e.g. after the table changed """
+        self._results.clear()
+        self.indexes.clear()
+
+    def read(self):
+        return [self.conn_data[idx] for idx in self.read_indices()]
+
+
+class TestJsonArray(unittest.TestCase):
+    @staticmethod
+    def decode(data, chunk_size=1):
+        return list(iter_json_array(io.BytesIO(data), chunk_size))
+
+    def test_chunk_boundaries(self):
+        data = b'[{"host_a": "10.0.0.1", "a2b": {"time": [1.5, 2.25]}}, 12345, "caf\xc3\xa9", [1, [2]]]'
+        expected = json.loads(data)
+        # every split point, numbers and utf-8 sequences included
+        for chunk_size in (1, 2, 3, 7, 1 << 16):
+            self.assertEqual(self.decode(data, chunk_size), expected)
+
+    def test_separators(self):
+        self.assertEqual(self.decode(b' \n[ \n{"a": 1}\n ,\t{"b": 2} , 3 ]\n'), [{'a': 1}, {'b': 2}, 3])
+        self.assertEqual(self.decode(b'[]'), [])
+        self.assertEqual(self.decode(b' [ ] '), [])
+        # no output at all, e.g. no connection traced
+        self.assertEqual(self.decode(b''), [])
+        self.assertEqual(self.decode(b'\n'), [])
+
+    def test_malformed(self):
+        for data in (b'[{"a": 1}, {"b": ', b'[{"a": 1}', b'[1, 2', b'[', b'[{"a": 1}, {"b" 2}]',
+                     b'[1, tru]', b'{"a": 1}', b'garbage'):
+            self.assertRaises(RuntimeError, self.decode, data)
+            self.assertRaises(RuntimeError, self.decode, data, 1 << 16)
+        # elements decoded before the error are still yielded
+        decoded = []
+        with self.assertRaises(RuntimeError):
+            for obj in iter_json_array(io.BytesIO(b'[{"a": 1}, {"b": '), 4):
+                decoded.append(obj)
+        self.assertEqual(decoded, [{'a': 1}])
+
+
+class TestTcpTraceProcess(unittest.TestCase):
+    # stands in for tcptrace: reads the capture, waits, then writes the -J output
+    FAKE_TCPTRACE = '''#!%s
+import sys, time
+with open(sys.argv[-1], 'rb') as fid:
+    fid.read()
+time.sleep(float(sys.argv[2]))
+with open(sys.argv[1][2:], 'w') as fid:
+    fid.write('[{"host_a": "10.0.0.1"}, {"host_a": "10.0.0.2"}]')
+'''
+
+    def setUp(self):
+        self.temp_dir = mkdtemp()
+        self.fake = os.path.join(self.temp_dir, 'tcptrace')
+        with open(self.fake, 'w') as fid:
+            fid.write(self.FAKE_TCPTRACE % sys.executable)
+        os.chmod(self.fake, 0o755)
+        self.capture = os.path.join(self.temp_dir, 'capture.pcap')
+        with open(self.capture, 'wb') as fid:
+            fid.write('\0' * 1048576)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+    def run_fake(self, delay, timeout=None, cancel_after=None):
+        reports = []
+        process = TcpTraceProcess([self.fake, str(delay), self.capture], timeout=timeout,
+                                  progress=lambda *args: reports.append(args))
+        if cancel_after:
+            timer = threading.Timer(cancel_after, process.cancel)
+            timer.start()
+        try:
+            return list(process), reports
+        finally:
+            if cancel_after:
+                timer.cancel()
+
+    def test_output(self):
+        records, reports = self.run_fake(0.5)
+        self.assertEqual([conn['host_a'] for conn in records], ['10.0.0.1', '10.0.0.2'])
+        self.assertEqual([report[0] for report in reports[-2:]], [1, 2])
+        if os.path.exists('/proc/self/io'):
+            # the capture was read before any connection came out
+            self.assertTrue(reports[0][1] >= 1048576)
+        else:
+            self.assertEqual(reports[0][1], None)
+
+    def test_timeout(self):
+        started = time.time()
+        self.assertRaises(TcpTraceTimeout, self.run_fake, 30, timeout=0.5)
+        self.assertTrue(time.time() - started < 10)
+
+    def test_cancel(self):
+        started = time.time()
+        self.assertRaises(TcpTraceCancelled, self.run_fake, 30, cancel_after=0.5)
+        self.assertTrue(time.time() - started < 10)
+
+
+class TestChunks(unittest.TestCase):
+    FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+    def load(self, name):
+        with open(os.path.join(self.FIXTURES, name)) as fid:
+            return json.load(fid)
+
+    def test_merge_chunks(self):
+        # 51000 spans both chunks, the second one seeing the server first
+        merged = merge_chunks([self.load('chunk0.json'), self.load('chunk1.json')])
+        self.assertEqual([conn['port_a'] for conn in merged], [51000, 51001])
+        conn = merged[0]
+        self.assertEqual((conn['total_packets'], conn['complete']), (12, True))
+        self.assertAlmostEqual(conn['elapsed_time'], 2.0)
+        client, server = conn['a2b'], conn['b2a']
+        self.assertEqual([client[key][0] for key in ('packets_sent', 'unique_bytes_sent', 'actual_data_pkts',
+                                                     'SYN_pkts_sent', 'FIN_pkts_sent', 'RTT_samples')],
+                         [7, 1100, 3, 1, 1, 4])
+        self.assertEqual((client['max_segm_size'], client['min_segm_size'], client['mss_requested']),
+                         ([600], [100], [1460]))
+        self.assertAlmostEqual(client['avg_segm_size'][0], 1100 / 3.)
+        self.assertEqual((client['RTT_min'], client['RTT_max']), ([0.01], [0.05]))
+        self.assertAlmostEqual(client['RTT_avg'][0], 0.03)
+        self.assertAlmostEqual(client['RTT_stdev'][0], 0.0002 ** 0.5)
+        self.assertAlmostEqual(client['data_trans_time'][0], 1.2)
+        self.assertAlmostEqual(client['throughput'][0], 550.)
+        self.assertEqual(base64.b64decode(client['base64_data']), 'GET /')
+        self.assertEqual(client['points_data'], [600, 400, 100])
+        # the first chunk has no segment of the server to measure
+        self.assertEqual((server['max_segm_size'], server['min_segm_size'], server['avg_segm_size']),
+                         ([1400], [600], [1000.0]))
+        self.assertEqual((server['packets_sent'], server['mss_requested'], server['RTT_avg']), ([5], [1400], [0.0]))
+        self.assertEqual(merged[1]['complete'], False)
+
+    def write_capture(self):
+        fid, path = mkstemp()
+        os.close(fid)
+        test = native.TestNativeBackend('test_pcap')
+        test.write_pcap(path)
+        return path
+
+    def test_split_pcap(self):
+        path = self.write_capture()
+        temp_dir = mkdtemp()
+        try:
+            by_flow = split_pcap(path, 4, temp_dir, 'flow')
+            self.assertEqual(len(by_flow), 1)
+            for chunk in by_flow:
+                os.remove(chunk)
+            by_time = split_pcap(path, 2, temp_dir, 'time')
+            self.assertEqual(len(by_time), 2)
+            chunks = [list(NativeBackend().spawn(chunk)) for chunk in by_time]
+            whole = list(NativeBackend().spawn(path))
+        finally:
+            shutil.rmtree(temp_dir)
+            os.remove(path)
+        # the connection crosses the split point, neither chunk sees all of it
+        self.assertEqual([len(records) for records in chunks], [1, 1])
+        self.assertEqual([records[0]['complete'] for records in chunks], [False, False])
+        merged, = merge_chunks(chunks)
+        expected, = whole
+        for key in expected:
+            if key not in DIRECTIONS:
+                self.assertAlmostEqual(merged[key], expected[key], places=5, msg=key)
+        for direct in DIRECTIONS:
+            for key in expected[direct]:
+                # the retransmission in the second chunk looks new to it
+                if (direct, key) in (('a2b', 'unique_bytes_sent'), ('a2b', 'base64_data')):
+                    continue
+                self.assertEqual(merged[direct][key], expected[direct][key], direct + '.' + key)
+        self.assertEqual(merged['a2b']['unique_bytes_sent'][0], expected['a2b']['unique_bytes_sent'][0] + 16)
+
+    def test_split_flows(self):
+        test = native.TestNativeBackend
+        frames = []
+        for seq in range(20):
+            # interleaved connections, seen from both sides
+            for port in (51000, 51001, 51002, 51003, 51004):
+                client, server = ('10.0.0.1', port), ('10.0.%d.2' % (port % 3), 80)
+                frames.append(test.frame(client, server, seq, 0x10) if seq % 2 else
+                              test.frame(server, client, seq, 0x10, 'x' * seq))
+        # not TCP, goes to the first chunk
+        frames.insert(7, '\x00' * 12 + '\x08\x06' + '\x00' * 46)
+        fid, path = mkstemp()
+        with os.fdopen(fid, 'wb') as fid:
+            fid.write(struct.pack('<IHHiIII', 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1))
+            for idx, frame in enumerate(frames):
+                fid.write(struct.pack('<IIII', idx, 0, len(frame), len(frame)) + frame)
+        size = os.path.getsize(path)
+        temp_dir = mkdtemp()
+        reports = []
+        batch = pcap.SPLIT_BATCH
+        pcap.SPLIT_BATCH = 7
+        try:
+            chunks = split_pcap(path, 4, temp_dir, 'flow', reports.append)
+            records = []
+            for chunk in chunks:
+                with open(chunk, 'rb') as fid:
+                    data = fid.read()
+                _, offsets, caplens, _ = native.index_pcap(data)
+                records.append([data[offset:offset + caplen] for offset, caplen in zip(offsets, caplens)])
+            def stop(num_bytes):
+                raise TcpTraceCancelled('cancelled')
+            self.assertRaises(TcpTraceCancelled, split_pcap, path, 4, temp_dir, 'flow', stop)
+        finally:
+            pcap.SPLIT_BATCH = batch
+            shutil.rmtree(temp_dir)
+            os.remove(path)
+        # every record once, in capture order within its chunk
+        self.assertEqual(sorted(sum(records, [])), sorted(frames))
+        for chunk in records:
+            self.assertEqual(chunk, sorted(chunk, key=frames.index))
+        self.assertTrue(frames[7] in records[0])
+        # both directions of a connection land in the same chunk
+        for port in range(51000, 51005):
+            key = struct.pack('!H', port)
+            self.assertEqual(len([chunk for chunk in records if any(key in frame[34:38] for frame in chunk)]), 1)
+        self.assertTrue(len(records) > 1)
+        # after every batch of 7 records, up to the end of the capture
+        self.assertEqual(len(reports), 15)
+        self.assertEqual(reports[-1], size)
+
+    def test_cancel_parallel(self):
+        path = self.write_capture()
+        tcptrace = TcpTrace(backend='native')
+        # cancelled before the first chunk is done
+        tcptrace.cancel()
+        try:
+            self.assertRaises(TcpTraceCancelled, tcptrace._open_parallel, path, 2, 'time')
+        finally:
+            os.remove(path)
+
+
+class TestPcapHandle(unittest.TestCase):
+    def test_extend(self):
+        payloads = PayloadStore()
+        tables = []
+        for ports in (range(1000, 1006), range(1006, 1010)):
+            builder = ConnectionTableBuilder(payloads)
+            builder.extend([{'port_a': port, 'first_packet_time': 1e9 + port,
+                             'a2b': {'base64_data': base64.b64encode('GET / HTTP/1.1\r\n\r\n')}}
+                            for port in ports])
+            tables.append(builder.build())
+        handle = PcapHandle(tables[0], b'', b'')
+        compiled = generate_filter('tcp.port_a > 1003 && http.method == GET')
+        handle.set_filter(compiled)
+        self.assertEqual(list(handle.read_indices()), [4, 5])
+        evaluated = []
+        mask = compiled.mask
+        compiled.mask = lambda table, mode='auto', rows=None: evaluated.append(rows) or mask(table, mode, rows)
+        try:
+            handle.extend(tables[1])
+            self.assertEqual(list(handle.read_indices()), range(4, 10))
+        finally:
+            del compiled.mask
+        # the cached result is completed over the new rows only
+        self.assertEqual([list(rows) for rows in evaluated], [range(6, 10)])
+        self.assertEqual(list(handle.conn_data.column('first_packet_time')), range(10))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,370 @@
+import unittest
+import numpy as np
+from payload import PayloadStore
+
+__author__ = 'huangyan13@baidu.com'
+
+
+# the two half-connections of a connection
+DIRECTIONS = ('a2b', 'b2a')
+# per-packet fields, stored as one flat array plus row offsets (CSR layout)
+SERIES_FIELDS = ('time', 'points_time', 'points_data')
+# payloads, moved to a PayloadStore and referenced by offset and length
+PAYLOAD_FIELDS = ('base64_data',)
+# how filters refer to the payload of each direction
+PAYLOAD_NAMES = ('a2b.payload', 'b2a.payload')
+
+
+class ConnectionTableBuilder:
+    """
+        Collect connection records (as decoded from tcptrace JSON) column by
+        column, so that the nested dicts can be dropped as soon as possible.
+    """
+    def __init__(self, payloads=None):
+        self.size = 0
+        self.scalars = {}
+        self.series_values = {}
+        self.series_lengths = {}
+        self.payloads = payloads or PayloadStore()
+        self._names = {}
+
+    def _flatten(self, record):
+        for key, val in record.iteritems():
+            if isinstance(val, dict):
+                names = self._names.get(key)
+                if names is None:
+                    names = self._names[key] = {}
+                for sub_key, sub_val in val.iteritems():
+                    name = names.get(sub_key)
+                    if name is None:
+                        name = names[sub_key] = '%s.%s' % (key, sub_key)
+                    yield name, sub_key, sub_val
+            else:
+                yield key, key, val
+
+    def append(self, record):
+        scalars = self.scalars
+        added = 0
+        for name, key, val in self._flatten(record):
+            added += 1
+            if key in PAYLOAD_FIELDS:
+                offset, length = self.payloads.append(val)
+                prefix = name[:-len(key)]
+                for name, val in ((prefix + 'payload_offset', offset),
+                                  (prefix + 'payload_length', length)):
+                    if name not in scalars:
+                        scalars[name] = [None] * self.size
+                    scalars[name].append(val)
+                # one field, two columns
+                added += 1
+            elif key in SERIES_FIELDS:
+                if name not in self.series_values:
+                    self.series_values[name] = []
+                    self.series_lengths[name] = [0] * self.size
+                self.series_values[name].extend(val)
+                self.series_lengths[name].append(len(val))
+            else:
+                if name not in scalars:
+                    scalars[name] = [None] * self.size
+                # tcptrace wraps most of the per-direction metrics into a list
+                if isinstance(val, list):
+                    val = val[0] if val else None
+                scalars[name].append(val)
+        self.size += 1
+        # pad the columns missing from this record
+        if added != len(scalars) + len(self.series_values):
+            for lst in scalars.values():
+                if len(lst) < self.size:
+                    lst.append(None)
+            for lst in self.series_lengths.values():
+                if len(lst) < self.size:
+                    lst.append(0)
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    @staticmethod
+    def _to_array(name, values):
+        if name.endswith('payload_length'):
+            # no payload at all, as opposed to an empty one
+            return np.array([val if val is not None else -1 for val in values], dtype=np.int64)
+        sample = next((val for val in values if val is not None), 0)
+        if isinstance(sample, basestring):
+            return np.array([val if val is not None else u'' for val in values])
+        values = [val if val is not None else 0 for val in values]
+        if name.endswith('_time'):
+            return np.array(values, dtype=np.float64)
+        return np.array(values)
+
+    def build(self):
+        columns = {}
+        for name, values in self.scalars.items():
+            columns[name] = self._to_array(name, values)
+        series = {}
+        for name, values in self.series_values.items():
+            offsets = np.zeros(self.size + 1, dtype=np.int64)
+            np.cumsum(self.series_lengths[name], out=offsets[1:])
+            series[name] = (np.array(values, dtype=np.float64), offsets)
+        return ConnectionTable(columns, series, self.size, self.payloads)
+
+
+class ConnectionTable(object):
+    """
+        Columnar storage of all connections: one NumPy array per scalar field,
+        per-direction fields are named like 'a2b.unique_bytes_sent', and the
+        per-packet time series are stored as (values, offsets) pairs where the
+        data of row i is values[offsets[i]:offsets[i + 1]].
+    """
+    def __init__(self, columns, series, size, payloads=None):
+        self.columns = columns
+        self.series = series
+        self.size = size
+        self.payloads = payloads
+        # arrays with spare room behind the columns, see extend
+        self._buffers = {}
+
+    @staticmethod
+    def from_records(records):
+        builder = ConnectionTableBuilder()
+        builder.extend(records)
+        return builder.build()
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, table):
+        """
+            Append the rows of `table`, built on the same PayloadStore, e.g.
+            connections arriving while the first ones are shown. Arrays grow
+            geometrically and columns are views of their first rows.
+        """
+        if self.payloads is None:
+            self.payloads = table.payloads
+        elif table.payloads is not None and table.payloads is not self.payloads:
+            raise ValueError('tables must share their payloads')
+        size = self.size + table.size
+        for name in set(self.columns) | set(table.columns):
+            current, values = self.columns.get(name), table.columns.get(name)
+            if values is None:
+                values = self._missing(name, current.dtype, table.size)
+            if current is None:
+                current = self._missing(name, values.dtype, self.size)
+            self.columns[name] = self._grow(name, current, values, size)
+        for name in set(self.series) | set(table.series):
+            cur_values, cur_offsets = self.series.get(name) or (
+                np.zeros(0), np.zeros(self.size + 1, dtype=np.int64))
+            values, offsets = table.series.get(name) or (
+                np.zeros(0), np.zeros(table.size + 1, dtype=np.int64))
+            values = values[offsets[0]:offsets[-1]]
+            self.series[name] = (
+                self._grow(('values', name), cur_values, values, len(cur_values) + len(values)),
+                self._grow(('offsets', name), cur_offsets, offsets[1:] - offsets[0] + cur_offsets[-1],
+                           size + 1))
+        self.size = size
+
+    @staticmethod
+    def _missing(name, dtype, size):
+        if name.endswith('payload_length'):
+            return np.full(size, -1, dtype=np.int64)
+        return np.zeros(size, dtype=dtype)
+
+    def _grow(self, key, current, values, size):
+        buf = self._buffers.get(key)
+        dtype = np.result_type(current.dtype, values.dtype)
+        # the column may have been replaced since, e.g. by add_http_features
+        if buf is None or current.base is not buf or buf.dtype != dtype or len(buf) < size:
+            buf = np.empty(max(size, 2 * len(current)), dtype=dtype)
+            buf[:len(current)] = current
+            self._buffers[key] = buf
+        buf[len(current):size] = values
+        return buf[:size]
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError('connection index out of range')
+        return ConnectionView(self, index)
+
+    def __iter__(self):
+        for index in xrange(self.size):
+            yield ConnectionView(self, index)
+
+    def has_column(self, name):
+        return name in self.columns
+
+    def column(self, name):
+        return self.columns[name]
+
+    def get_series(self, name, index):
+        values, offsets = self.series[name]
+        return values[offsets[index]:offsets[index + 1]]
+
+    def has_payload(self, direction, index):
+        name = '%s.payload_length' % direction
+        return name in self.columns and self.columns[name][index] >= 0
+
+    def get_payload_ref(self, direction, index):
+        """ (offset, length) of a payload in the blob, None if there is none """
+        if not self.has_payload(direction, index):
+            return None
+        return (int(self.columns['%s.payload_offset' % direction][index]),
+                int(self.columns['%s.payload_length' % direction][index]))
+
+    def get_payload(self, direction, index):
+        """ payload of one half-connection, '' if there is none """
+        ref = self.get_payload_ref(direction, index)
+        return self.payloads.get(*ref) if ref else ''
+
+    def get_payload_view(self, direction, index):
+        """ zero-copy view of the payload of one half-connection, None if there is none """
+        ref = self.get_payload_ref(direction, index)
+        return self.payloads.view(*ref) if ref else None
+
+    def get_payload_span(self, direction, index):
+        """ (data, start, end) of the payload of one half-connection, None if there is none """
+        ref = self.get_payload_ref(direction, index)
+        return self.payloads.span(*ref) if ref else None
+
+    def find_payload(self, direction, index, needle):
+        """ position of `needle` in the payload of one half-connection, -1 if absent """
+        ref = self.get_payload_ref(direction, index)
+        return self.payloads.find(ref[0], ref[1], needle) if ref else -1
+
+    def get_value(self, name, index):
+        """ value of a dotted field for one row, as seen by the filter """
+        if name in self.columns:
+            return self.columns[name][index]
+        elif name in self.series:
+            # the first value, as filters read the lists of tcptrace output, None if empty
+            values = self.get_series(name, index)
+            return values[0] if len(values) else None
+        elif name in PAYLOAD_NAMES:
+            return self.get_payload(name.split('.')[0], index)
+        raise KeyError(name)
+
+
+class ConnectionView(object):
+    """ dict-like view of a single row, compatible with the decoded JSON """
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+        if key in DIRECTIONS:
+            return DirectionView(self.table, self.index, key)
+        return self.table.columns[key][self.index]
+
+    def __contains__(self, key):
+        return key in DIRECTIONS or key in self.table.columns
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def field(self, name):
+        return self.table.get_value(name, self.index)
+
+
+class DirectionView(object):
+    """ dict-like view of one half-connection of a row """
+    __slots__ = ('table', 'index', 'direction')
+
+    def __init__(self, table, index, direction):
+        self.table = table
+        self.index = index
+        self.direction = direction
+
+    def __getitem__(self, key):
+        if key in PAYLOAD_FIELDS:
+            if not self.table.has_payload(self.direction, self.index):
+                raise KeyError(key)
+            return self.table.get_payload(self.direction, self.index)
+        name = '%s.%s' % (self.direction, key)
+        if name in self.table.series:
+            return self.table.get_series(name, self.index)
+        val = self.table.columns[name][self.index]
+        # keep the one element list of tcptrace output
+        return [val]
+
+    def __contains__(self, key):
+        if key in PAYLOAD_FIELDS:
+            return self.table.has_payload(self.direction, self.index)
+        name = '%s.%s' % (self.direction, key)
+        return name in self.table.series or name in self.table.columns
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def get_payload_view(self):
+        return self.table.get_payload_view(self.direction, self.index)
+
+    def get_payload_span(self):
+        return self.table.get_payload_span(self.direction, self.index)
+
+
+class TestConnectionTable(unittest.TestCase):
+    def test_extend(self):
+        payloads = PayloadStore()
+        batches = []
+        for records in (self.records[:1], self.records[1:], self.records, [{'host_a': u'10.0.0.100'}]):
+            builder = ConnectionTableBuilder(payloads)
+            builder.extend(records)
+            batches.append(builder.build())
+        table = batches[0]
+        for batch in batches[1:]:
+            table.extend(batch)
+        self.assertEqual(len(table), 5)
+        self.assertEqual(list(table.column('host_a')),
+                         [u'10.0.0.1', u'10.0.0.2', u'10.0.0.1', u'10.0.0.2', u'10.0.0.100'])
+        self.assertEqual(list(table.column('port_a')), [1234, 80, 1234, 80, 0])
+        self.assertEqual([list(table.get_series('a2b.points_time', idx)) for idx in range(5)],
+                         [[1.0, 2.0], [], [1.0, 2.0], [], []])
+        self.assertEqual([list(table.get_series('b2a.time', idx)) for idx in range(5)],
+                         [[], [3.0], [], [3.0], []])
+        self.assertEqual(table.get_payload('a2b', 2), 'abc')
+        self.assertFalse(table.has_payload('a2b', 4))
+        # later batches are copied into spare room, not reallocated every time
+        self.assertTrue(table.column('port_a').base is table._buffers['port_a'])
+
+    records = [
+        {'host_a': u'10.0.0.1', 'port_a': 1234, 'first_packet_time': 1,
+         'a2b': {'unique_bytes_sent': [10], 'points_time': [1.0, 2.0], 'base64_data': 'YWJj'},
+         'b2a': {'unique_bytes_sent': [20], 'points_time': [1.5]}},
+        {'host_a': u'10.0.0.2', 'port_a': 80, 'first_packet_time': 2.5,
+         'a2b': {'unique_bytes_sent': [30], 'points_time': []},
+         'b2a': {'unique_bytes_sent': [40], 'points_time': [3.0, 4.0, 5.0], 'time': [3.0]}},
+    ]
+
+    def test_columns(self):
+        table = ConnectionTable.from_records(self.records)
+        self.assertEqual(len(table), 2)
+        self.assertEqual(list(table.column('a2b.unique_bytes_sent')), [10, 30])
+        self.assertEqual(table.column('first_packet_time').dtype, np.float64)
+        self.assertEqual(list(table.series['b2a.points_time'][1]), [0, 1, 4])
+        self.assertEqual(list(table.series['b2a.time'][1]), [0, 0, 1])
+
+    def test_view(self):
+        table = ConnectionTable.from_records(self.records)
+        conn = table[1]
+        self.assertEqual(conn['host_a'], u'10.0.0.2')
+        self.assertEqual(conn['b2a']['unique_bytes_sent'][0], 40)
+        self.assertEqual(list(conn['b2a']['points_time']), [3.0, 4.0, 5.0])
+        self.assertEqual(conn['a2b'].get('base64_data', ''), '')
+        self.assertEqual(table[0]['a2b']['base64_data'], 'abc')
+        self.assertEqual(list(table.column('a2b.payload_length')), [3, -1])
+        self.assertEqual(bytes(table[0]['a2b'].get_payload_view()), 'abc')
+        self.assertTrue('base64_data' not in table[0]['b2a'])
+        self.assertEqual(conn.field('a2b.unique_bytes_sent'), 30)
+        self.assertEqual(table[0].field('a2b.payload'), 'abc')
+        self.assertEqual(table.find_payload('a2b', 0, 'bc'), 1)
+        self.assertEqual(table.find_payload('b2a', 0, 'bc'), -1)
+        data, start, end = table[0]['a2b'].get_payload_span()
+        self.assertEqual(data[start:end], 'abc')
+        self.assertEqual(table.get_payload_span('b2a', 0), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
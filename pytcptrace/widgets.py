@@ -1,6 +1,11 @@
 import ttk
-import tkFont
+import time
+import Queue
+import base64
+import unittest
 import inspect
+import multiprocessing
+from collections import deque
 import Tkinter as tk
 import StringIO
 from PIL import Image, ImageTk
@@ -15,7 +20,9 @@ from matplotlib.figure import Figure
 from scipy.interpolate import interp1d
 from tkMessageBox import showerror, showinfo
 
-from http_parser import HttpParser
+from http_parser import extract_transactions
+from metrics import get_metrics
+from payload import map_blob
 
 
 __author__ = 'huangyan13@baidu.com'
@@ -62,6 +69,38 @@ class Widget(object):
         return new_selection
 
 
+def average_windows(t, val, aver_window):
+    """
+        Times and prefix sums of `val` where each averaging window starts:
+        a window ends at the first packet more than `aver_window` after its
+        start, which starts the next one. `t` is sorted, one searchsorted
+        per window instead of a Python loop per packet.
+    """
+    t = np.asarray(t, dtype=np.float64)
+    if not len(t):
+        return t, np.zeros(0)
+    bounds = [0]
+    while True:
+        # at least one packet further, e.g. for a negative window
+        idx = max(int(t.searchsorted(t[bounds[-1]] + aver_window, side='right')), bounds[-1] + 1)
+        if idx >= len(t):
+            break
+        bounds.append(idx)
+    bounds = np.array(bounds, dtype=np.int64)
+    return t[bounds], np.cumsum(val)[bounds]
+
+
+def throughput(windows, cumulative=False):
+    """ middle of each window and its throughput, or the average since the first packet """
+    times, sums = windows
+    x_val = (times[1:] + times[:-1]) / 2.
+    if cumulative:
+        y_val = (sums[1:] - sums[0]) / (times[1:] - times[0])
+    else:
+        y_val = np.diff(sums) / np.diff(times)
+    return x_val, y_val
+
+
 class ThroughputGraph(Widget):
     def __init__(self, master):
         Widget.__init__(self, master, 'Throughput Graph')
@@ -70,9 +109,11 @@ class ThroughputGraph(Widget):
         self.aver_window = tk.StringVar()
         self.aver_window.set('0.2')
         self.smooth = tk.IntVar()
+        # average_windows by (connection, direction, aver_window), kept while the window is open
+        self.windows = {}
 
     def smoothing(self, x_val, y_val):
-        if not x_val or not y_val:
+        if not len(x_val) or not len(y_val):
             return np.array([]), np.array([])
         x_val = np.array(x_val)
         y_val = np.array(y_val)
@@ -82,35 +123,26 @@ class ThroughputGraph(Widget):
         new_y[new_y < 0] = 0
         return new_x, new_y
 
-    def instant_average(self, t, val, aver_window):
-        x_val = []
-        y_val = []
-        prev_idx = 0
-        cumsum = np.cumsum(val)
-        for i in xrange(1, len(t)):
-            if t[i] - t[prev_idx] > aver_window:
-                x_val.append((t[i] + t[prev_idx]) / 2.)
-                y_val.append((cumsum[i] - cumsum[prev_idx]) / (t[i] - t[prev_idx]))
-                prev_idx = i
+    def get_windows(self, t, val, aver_window, key=None):
+        if key is None:
+            return average_windows(t, val, aver_window)
+        if key not in self.windows:
+            self.windows[key] = average_windows(t, val, aver_window)
+        return self.windows[key]
+
+    def instant_average(self, t, val, aver_window, key=None):
+        x_val, y_val = throughput(self.get_windows(t, val, aver_window, key))
         if self.smooth.get():
             return self.smoothing(x_val, y_val)
         else:
-            return np.array(x_val), np.array(y_val)
-
-    def total_average(self, t, val, aver_window):
-        x_val = []
-        y_val = []
-        prev_idx = 0
-        cumsum = np.cumsum(val)
-        for i in xrange(1, len(t)):
-            if t[i] - t[prev_idx] > aver_window:
-                x_val.append((t[i] + t[prev_idx]) / 2.)
-                y_val.append((cumsum[i] - cumsum[0]) / (t[i] - t[0]))
-                prev_idx = i
+            return x_val, y_val
+
+    def total_average(self, t, val, aver_window, key=None):
+        x_val, y_val = throughput(self.get_windows(t, val, aver_window, key), cumulative=True)
         if self.smooth.get():
             return self.smoothing(x_val, y_val)
         else:
-            return np.array(x_val), np.array(y_val)
+            return x_val, y_val
 
     def plot_data(self, plot_type):
         # first clear the figure
@@ -132,9 +164,10 @@ class ThroughputGraph(Widget):
                 else:
                     title = title_r + ' -> ' + title_l
                 sub_conn = self.connections[select[0]][idx2name[select[1]]]
-                t = np.array(sub_conn['points_time'])
-                val = np.array(sub_conn['points_data'])
+                t = np.asarray(sub_conn['points_time'])
+                val = np.asarray(sub_conn['points_data'])
                 aver_window = float(self.aver_window.get())
+                key = (select[0], select[1], aver_window)
 
                 def set_axis(ax):
                     ax.legend(loc='upper right')
@@ -143,13 +176,13 @@ class ThroughputGraph(Widget):
 
                 if len(t) and len(val):
                     if plot_type == 'instant':
-                        x_val, y_val = self.instant_average(t, val, aver_window)
+                        x_val, y_val = self.instant_average(t, val, aver_window, key)
                         if len(x_val) > 1:
                             axis.plot(x_val, y_val, label=title)
                             axis.set_title('Instant Throughput')
                             set_axis(axis)
                     elif plot_type == 'average':
-                        x_val, y_val = self.total_average(t, val, aver_window)
+                        x_val, y_val = self.total_average(t, val, aver_window, key)
                         if len(x_val) > 1:
                             axis.plot(x_val, y_val, label=title)
                             axis.set_title('Cumulative Average Throughput')
@@ -194,6 +227,7 @@ class ThroughputGraph(Widget):
         Widget.activate(self, connections, selection)
         # proceed the selection items
         self.selection = self.selection_filter(self.selection)
+        self.windows = {}
         self.figure = Figure(figsize=(15, 5))
         self.init_canvas()
         self.init_buttons()
@@ -282,9 +316,12 @@ class ConnectionData(Widget):
         # first delete all previous data
         self.text.delete(1.0, tk.END)
         # then insert real data into it
-        if 'base64_data' in sub_conn:
-            data = sub_conn['base64_data'].replace('\r\n', '\n')
-            max_len = min(len(data), self.preview_size.get() * 1024)
+        payload = sub_conn.get_payload_view()
+        if payload is not None:
+            # only copy the previewed part out of the payload blob
+            max_len = min(len(payload), self.preview_size.get() * 1024)
+            data = bytes(payload[0:max_len]).replace('\r\n', '\n')
+            max_len = len(data)
             new_data = ''.join(map(lambda c:
                                    c if curses.ascii.isprint(c) or curses.ascii.isspace(c)
                                    else '\\x%X' % ord(c), list(data[0:max_len])))
@@ -300,14 +337,45 @@ class ConnectionData(Widget):
         self.init_listbox()
 
 
+def _extract_http(args):
+    # runs in a worker process of HttpDetail, the payloads are mapped from the blob file
+    index, path, spans, start, stop = args
+    end = max(span[1] for span in spans)
+    try:
+        return index, extract_transactions(map_blob(path, end) if end else '', spans, start, stop)
+    except Exception:
+        # the result must come back whatever happens, or the row would stay pending
+        return index, []
+
+
 class HttpDetail(Widget):
+    """
+        List of the HTTP transactions of the selected connections. They are
+        parsed by `pool`, see create_pool, or on the Tk thread a slice of
+        time at a look when there is none.
+    """
     ON_REQUEST = 0
     ON_RESPONSE = 1
+    # processes parsing the selected connections
+    WORKERS = multiprocessing.cpu_count()
+    # milliseconds between two looks at the connections parsed so far
+    POLL_INTERVAL = 50
+    # seconds spent inserting parsed connections per look
+    POLL_BUDGET = 0.05
 
     def _sort_func_default(self, x):
         return self.connections[x[0]]['first_packet_time']
 
-    def __init__(self, master):
+    @classmethod
+    def create_pool(cls):
+        """
+            Pool for HttpDetail, to be created before Tk starts: python 2
+            only forks, and a child forked from a process running Tk (Cocoa
+            on macOS) may crash.
+        """
+        return multiprocessing.Pool(cls.WORKERS)
+
+    def __init__(self, master, pool=None):
         self.Headers = [
             ('Method', self._sort_func_default),
             ('Host', self._sort_func_default),
@@ -323,20 +391,29 @@ class HttpDetail(Widget):
         self.preview_size.set(1)
         self.cursor = 0
         self.preview_status = self.ON_REQUEST
-        self.request_list = None
-        self.response_list = None
-        self.connection_list = None
+        self.status = tk.StringVar()
         self.sort_status = {}
+        # HttpTransaction lists of each connection parsed, kept while the table is the same
+        self.parsed = {}
+        self.parsed_table = None
+        # connections sent to the pool and not received yet
+        self.pending = set()
+        # tasks parsed on this thread, without a pool
+        self.waiting = deque()
+        self.results = Queue.Queue()
+        self.polling = False
+        self.pool = pool
+        self.widths = {}
 
     @staticmethod
     def selection_filter(selection):
+        # each connection once, whichever of its rows are selected
         new_selection = []
+        seen = set()
         for select in selection:
-            if select[1] == 1 or select[1] == 2:
-                if [select[0], 0] not in selection:
-                    new_selection.append([select[0], 0])
-            else:
-                new_selection.append(select)
+            if select[0] not in seen:
+                seen.add(select[0])
+                new_selection.append([select[0], 0])
         return new_selection
     
     def init_interface(self):
@@ -359,6 +436,7 @@ class HttpDetail(Widget):
         self.listbox.pack(side=tk.LEFT, expand=True, fill=tk.BOTH)
         self.listbox.bind('<<TreeviewSelect>>', self.on_select)
         new_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+        tk.Label(master=listbox_frame, textvariable=self.status).pack(side=tk.TOP, anchor=tk.W)
 
         listbox_frame.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
@@ -404,94 +482,114 @@ class HttpDetail(Widget):
             self.update_treeview()
             self.sort_status[header] = not self.sort_status[header]
 
-    @staticmethod
-    def parse_http_list(raw_data):
-        result_list = []
-        start = 0
-        end = len(raw_data)
-        while start < end:
-            r = HttpParser(decompress=True)
-            ret = r.execute(raw_data[start:])
-            if ret < 0:
-                break
-            start += ret
-            result_list.append(r)
-
-        return result_list
-
     def update_treeview(self):
-        # clear previous status
-        self.request_list = []
-        self.response_list = []
-        self.connection_list = []
+        """ rows of the connections parsed, the others are sent to the pool and come later """
         for iid in self.listbox.get_children():
             self.listbox.delete(iid)
-        
-        key_map = {
-            'a2b': 'b2a',
-            'b2a': 'a2b',
-        }
-        num_unknown = 0
+        self.widths = dict((header, 0) for header, _ in self.Headers)
+        if self.parsed_table is not self.connections:
+            self.parsed = {}
+            self.parsed_table = self.connections
+        tasks = []
+        shown = set()
         for select in self.selection:
-            conn = self.connections[select[0]]
-            found = False
-            for key in ('a2b', 'b2a'):
-                sub_conn = conn[key]
-                data = sub_conn.get('base64_data', '')
-                other_data = conn[key_map[key]].get('base64_data', '')
-                # this is a response
-                if data[0:4] == 'HTTP':
-                    try:
-                        req = self.parse_http_list(other_data)
-                        reply = self.parse_http_list(data)
-                    except RuntimeError:
-                        continue
-                    if len(req) == 0 or len(reply) == 0:
-                        continue
-                    self.request_list.append(req)
-                    self.response_list.append(reply)
-                    self.connection_list.append(conn)
-                    found = True
-            if not found:
-                num_unknown += 1
-        showinfo('Loading Complete', 'Non-HTTP Connection: %d' % num_unknown)
-
-        data_list = [map(lambda x: x[0], self.Headers)]
-        # first fill content into each row
-        for idx, req in enumerate(self.request_list):
-            conn = self.connection_list[idx]
-            data = (req[0].get_method(), req[0].get_headers()['Host'],
-                    req[0].get_url(), '%.2f' % conn['first_packet_time'],
+            index = select[0]
+            # rows are inserted once per connection, Tk refuses the same iid twice
+            if index in shown:
+                continue
+            shown.add(index)
+            if index in self.parsed:
+                self.insert_rows(index)
+            elif index not in self.pending:
+                self.pending.add(index)
+                tasks.append(self.make_task(index))
+        if tasks:
+            # the workers read what has been appended to the blob so far
+            self.connections.payloads.flush()
+            for task in tasks:
+                if self.pool:
+                    self.pool.apply_async(_extract_http, (task, ), callback=self.results.put)
+                else:
+                    self.waiting.append(task)
+            if not self.polling:
+                self.polling = True
+                self.window.after(self.POLL_INTERVAL, self.poll_results)
+        self.update_status()
+
+    def make_task(self, index):
+        conn = self.connections[index]
+        spans = []
+        for key in ('a2b', 'b2a'):
+            span = conn[key].get_payload_span()
+            spans.append(span[1:] if span else (0, 0))
+        return (index, self.connections.payloads.path, spans,
+                conn['first_packet_time'], conn['last_packet_time'])
+
+    def poll_results(self):
+        """ insert the rows of the connections parsed since the last look """
+        if not self.is_active:
+            self.polling = False
+            return
+        started = time.time()
+        try:
+            while time.time() - started < self.POLL_BUDGET:
+                if self.waiting:
+                    index, transaction_lists = _extract_http(self.waiting.popleft())
+                else:
+                    index, transaction_lists = self.results.get_nowait()
+                self.pending.discard(index)
+                # records come back without their data, the blob as mapped here
+                data = self.connections.payloads.blob()
+                for transactions in transaction_lists:
+                    for t in transactions:
+                        t.data = data
+                self.parsed[index] = transaction_lists
+                self.insert_rows(index)
+        except Queue.Empty:
+            pass
+        finally:
+            # keep on draining whatever happened to this look
+            self.polling = bool(self.pending)
+            if self.polling:
+                self.window.after(self.POLL_INTERVAL, self.poll_results)
+        self.update_status()
+
+    def insert_rows(self, index):
+        conn = self.connections[index]
+        metrics = get_metrics()
+        for group, transactions in enumerate(self.parsed[index]):
+            data = (transactions[0].method, transactions[0].host,
+                    transactions[0].url, '%.2f' % conn['first_packet_time'],
                     '%.2f' % conn['last_packet_time'], '%.2f' % conn['elapsed_time'])
-            self.listbox.insert('', tk.END, str(idx), values=data)
-            data_list.append(data)
-
-        # then adjust column width
-        for idx, header in enumerate(map(lambda x: x[0], self.Headers)):
-            # calculate max length
-            len_list = map(lambda x: tkFont.Font().measure(x[idx].title()) + 10, data_list)
-            if len(len_list) == 0:
-                break
-            elif len(len_list) == 1:
-                max_len = len_list[0]
-            else:
-                max_len = max(*len_list)
-            if header == 'Path' and max_len > 500:
-                max_len = 500
-            self.listbox.column(header, width=max_len)
+            self.listbox.insert('', tk.END, '%d-%d' % (index, group), values=data)
+            # columns only ever grow while rows come in
+            for header, value in zip(map(lambda x: x[0], self.Headers), data):
+                width = metrics.max_width([value.title() if value else '', header.title()]) + 10
+                if header == 'Path' and width > 500:
+                    width = 500
+                if width > self.widths[header]:
+                    self.widths[header] = width
+                    self.listbox.column(header, width=width)
+
+    def update_status(self):
+        selected = [select[0] for select in self.selection]
+        parsed = [self.parsed[index] for index in selected if index in self.parsed]
+        self.status.set('Parsed: %d/%d  Non-HTTP Connection: %d  HTTP Transactions: %d' % (
+            len(parsed), len(selected), sum(1 for lists in parsed if not lists),
+            sum(len(transactions) for lists in parsed for transactions in lists)))
 
     def show(self, show_type='request'):
         self.text.delete(1.0, tk.END)
         try:
-            idx = int(self.listbox.selection()[0])
-        except ValueError:
+            index, group = map(int, self.listbox.selection()[0].split('-'))
+        except (IndexError, ValueError):
             return
         if show_type == 'request':
             self.preview_status = self.ON_REQUEST
-            data = self.request_list[idx]
+            data = [t.get_request() for t in self.parsed[index][group] if t.request_header]
         else:
             self.preview_status = self.ON_RESPONSE
-            data = self.response_list[idx]
+            data = [t.get_response() for t in self.parsed[index][group] if t.response_header]
         self.show_headers(data, show_type)
 
     def show_headers(self, data, show_type):
@@ -593,6 +691,95 @@ class HttpDetail(Widget):
         self.init_interface()
         self.sort_by(self._sort_func_default, 'Start')
 
+    def window_close(self):
+        # connections still being parsed are dropped, the ones parsed stay cached
+        self.pending.clear()
+        self.waiting.clear()
+        self.results = Queue.Queue()
+        Widget.window_close(self)
+
 
 class TimeSequenceGraph(Widget):
     pass
+
+
+class TestHttpDetail(unittest.TestCase):
+    class Tree(object):
+        """ stands in for ttk.Treeview, refusing an iid twice like Tk does """
+        def __init__(self):
+            self.rows = []
+
+        def get_children(self):
+            return list(self.rows)
+
+        def delete(self, iid):
+            self.rows.remove(iid)
+
+        def insert(self, parent, index, iid, values):
+            if iid in self.rows:
+                raise tk.TclError('Item %s already exists' % iid)
+            self.rows.append(iid)
+
+        def column(self, header, width):
+            pass
+
+    class Window(object):
+        def __init__(self):
+            self.callbacks = []
+
+        def after(self, ms, func):
+            self.callbacks.append(func)
+
+    class Var(object):
+        def __init__(self, *args, **kwargs):
+            self.value = None
+
+        def set(self, value):
+            self.value = value
+
+        def get(self):
+            return self.value
+
+    class Metrics(object):
+        def max_width(self, texts):
+            return 10
+
+    def setUp(self):
+        global get_metrics
+        self.saved = tk.IntVar, tk.StringVar, get_metrics
+        tk.IntVar = tk.StringVar = self.Var
+        get_metrics = self.Metrics
+
+    def tearDown(self):
+        global get_metrics
+        tk.IntVar, tk.StringVar, get_metrics = self.saved
+
+    def test_both_children_selected(self):
+        from table import ConnectionTable
+        table = ConnectionTable.from_records([
+            {'first_packet_time': 1.0, 'last_packet_time': 2.0, 'elapsed_time': 1.0,
+             'a2b': {'base64_data': base64.b64encode('GET /%d HTTP/1.1\r\nHost: a.com\r\n\r\n' % idx)},
+             'b2a': {'base64_data': base64.b64encode('HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n')}}
+            for idx in range(2)])
+        widget = HttpDetail(None)
+        widget.window = self.Window()
+        widget.listbox = self.Tree()
+        widget.connections = table
+        widget.is_active = True
+        # both rows of connection 0 and one of connection 1
+        widget.selection = widget.selection_filter([[0, 1], [0, 2], [1, 2], [0, 0]])
+        self.assertEqual(widget.selection, [[0, 0], [1, 0]])
+        widget.update_treeview()
+        self.assertEqual(widget.pending, set([0, 1]))
+        while widget.window.callbacks:
+            widget.window.callbacks.pop(0)()
+        self.assertEqual(widget.listbox.rows, ['0-0', '1-0'])
+        self.assertFalse(widget.polling)
+        # parsed already, a selection listing a connection twice still inserts it once
+        widget.selection = [[1, 0], [1, 0], [0, 0]]
+        widget.update_treeview()
+        self.assertEqual(widget.listbox.rows, ['1-0', '0-0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
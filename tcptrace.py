@@ -1,12 +1,15 @@
 import Tkinter as tk
-from pytcptrace import PyTcpTrace
-from pytcptrace import ThroughputGraph, ConnectionData, HttpDetail
+from pytcptrace.container import PyTcpTrace
+from pytcptrace.widgets import ThroughputGraph, ConnectionData, HttpDetail
 
 __author__ = 'huangyan13@baidu.com'
 
 if __name__ == '__main__':
+    # forked before Tk is started, see HttpDetail.create_pool
+    http_pool = HttpDetail.create_pool()
     gui = PyTcpTrace(tk.Tk())
     gui.add_widget('Raw Data', ConnectionData)
     gui.add_widget('Throughput', ThroughputGraph)
-    gui.add_widget('HTTP Detail', HttpDetail)
+    gui.add_widget('HTTP Detail', HttpDetail, http_pool)
     gui.mainloop()
+    http_pool.terminate()